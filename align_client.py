@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""
+Client of the resident alignment service (spectral_align.py --serve)
+
+Takes the arguments of spectral_align.py and has the service run them, so
+that a submission neither starts torch nor decomposes the reference again:
+
+python align_client.py --socket /tmp/align.sock -r REF -s SUB -o OUT --eig 5
+python align_client.py --socket /tmp/align.sock --stats
+
+Exits with the status of the job: 1 if a subject failed or the service
+rejected the job (e.g. bad arguments), 2 if the service cannot be reached
+or its queue is full.
+"""
+
+import os
+import json
+import argparse
+from utils.service import request
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(allow_abbrev=False,
+                                     epilog='all other arguments are passed to spectral_align.py by the service')
+    parser.add_argument('--socket', required=True, help='Unix socket of the service (--serve of spectral_align.py)')
+    parser.add_argument('--stats', default=False, action='store_true', help='print the job counts, queue depth and latencies of the service')
+    parser.add_argument('--shutdown', default=False, action='store_true', help='stop the service once its queued jobs are done')
+    parser.add_argument('--timeout', default=None, type=float, help='seconds to wait for the answer (default: until the job is done)')
+    args, job = parser.parse_known_args(argv)
+
+    if args.stats:
+        message = {'op': 'stats'}
+    elif args.shutdown:
+        message = {'op': 'shutdown'}
+    else:
+        message = {'op': 'align', 'argv': job, 'cwd': os.getcwd()}
+
+    try:
+        response = request(args.socket, message, args.timeout)
+    except OSError as e:
+        print('Cannot reach the alignment service on {}: {}'.format(args.socket, e))
+        return 2
+
+    if args.stats:
+        print(json.dumps(response, indent=1, sort_keys=True))
+        return 0
+    if 'error' in response:
+        print('Job failed: {}'.format(response['error']))
+        return 2 if response['error'] == 'queue full' else 1
+    if args.shutdown:
+        print('Alignment service stopping')
+        return 0
+    for sub, error in response['failed']:
+        print('{} failed: {}'.format(sub, error))
+    print('Job done in {:.1f} s ({:.1f} s queued, {:.1f} s running)'.format(response['latency'], response['wait'], response['run']))
+    return response['status']
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
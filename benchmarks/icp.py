@@ -0,0 +1,53 @@
+"""
+Per-iteration overhead of the ICP controller over the bare ICP engine
+
+Runs the same number of KD-tree ICP iterations (no early stopping) on random
+point sets with the engine alone and under ICPController, which traces every
+iteration and checks the time budget. The overhead is the difference.
+
+python -m benchmarks.icp --points 2000,20000 --iterations 30
+"""
+
+import sys
+import argparse
+import numpy as np
+import torch
+from utils.icp import kdtree_icp, ICPController
+from benchmarks.run import measure
+
+
+def point_sets(points, dims, seed=0):
+        """
+        Source points and a rotated, shifted and noisy copy as target (1 x n x dims)
+        """
+        rng = np.random.default_rng(seed)
+        X = rng.standard_normal((points, dims)) * np.linspace(3, 1, dims)
+        Q, _ = np.linalg.qr(np.eye(dims) + 0.1 * rng.standard_normal((dims, dims)))
+        Y = X @ Q + 0.1 + 0.01 * rng.standard_normal((points, dims))
+        return torch.from_numpy(X[None]).float(), torch.from_numpy(rng.permutation(Y)[None]).float()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ICP controller overhead per iteration')
+    parser.add_argument('--points', default='2000,20000', help='comma separated point counts')
+    parser.add_argument('--dims', default=6, type=int, help='point dimension (sulcal depth + eigen vectors)')
+    parser.add_argument('--iterations', default=30, type=int, help='ICP iterations of every run')
+    parser.add_argument('--repeat', default=3, type=int, help='timed runs (the fastest is reported)')
+    args = parser.parse_args(argv)
+
+    runs = {
+        'engine': lambda X, Y: kdtree_icp(X, Y, max_iterations=args.iterations, relative_rmse_thr=-1),
+        'controller': lambda X, Y: ICPController(kdtree_icp, args.iterations, relative_rmse_thr=-1)(X, Y),
+    }
+    print('{:>8} {:<20} {:>14} {:>9}'.format('points', 'run', 'ms/iteration', 'overhead'))
+    for points in args.points.split(','):
+        X, Y = point_sets(int(points), args.dims)
+        times = {name: min(measure(run, lambda: (X, Y), args.repeat)[1]) * 1000 / args.iterations
+                 for name, run in runs.items()}
+        for name, t in times.items():
+            print('{:>8} {:<20} {:>14.3f} {:>8.1f}%'.format(points, name, t, 100 * (t / times['engine'] - 1)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
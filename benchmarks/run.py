@@ -0,0 +1,255 @@
+"""
+Per-stage benchmark of the alignment pipeline on synthetic surfaces
+
+Every stage of the pipeline is timed separately on a reference and a subject
+of each size (see benchmarks.synthetic): loading, weight adjacency, Laplacian
+build, eigen decomposition, sign flipping, partial and complete ICP, and
+saving. The results are written as JSON and compared against a baseline (a
+previous results file); the run fails when a stage got slower than the
+tolerance allows.
+
+python -m benchmarks.run --sizes 10000,100000 --out bench.json
+python -m benchmarks.run --sizes 10000,100000 --baseline bench.json
+python -m benchmarks.run --icp kdtree --baseline benchmarks/baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+import scipy
+import torch
+from utils.load_mesh import LoadMesh
+from utils.embedding import Embedding
+from utils.weight_adjaceny import weight_adjacency_matrix, weight_adjacency_csr
+from utils.graph_spectrum import eigen_values_spectrum, SOLVERS
+from utils.flip_eigen import flip_eigen_sign
+from benchmarks.synthetic import make_cohort
+from spectral_align import save_embedding
+
+STAGES = ['load', 'weight_adjacency', 'laplacian', 'eigen_values_spectrum', 'flip_eigen_sign',
+          'align_partial', 'align_complete', 'save']
+# complete ICP matches every vertex (the --robust mode), too slow for the default run
+DEFAULT_STAGES = [stage for stage in STAGES if stage != 'align_complete']
+
+
+def measure(run, setup=None, repeat=3):
+        """
+        Wall times of `repeat` calls of run(*setup()), setup is not timed
+
+        returns: result of the last call, list of times (s)
+        """
+        times = []
+        for _ in range(repeat):
+            args = setup() if setup is not None else ()
+            start = time.perf_counter()
+            result = run(*args)
+            times.append(time.perf_counter() - start)
+        return result, times
+
+
+def summary(times):
+        return {'median': float(np.median(times)), 'min': float(np.min(times)), 'times': times}
+
+
+def benchmark_size(data, vertices, args, stages):
+        """
+        Times the selected stages on the reference and subject of one size
+
+        returns: dict stage -> {median, min, times}, plus the number of vertices
+        """
+        ref, sub = make_cohort(data, vertices, subjects=2)
+        dtype = getattr(torch, args.dtype)
+        results = {}
+
+        def load(name):
+            mesh = LoadMesh()
+            mesh.load_mesh(data, name, 'lh', 'cpu', dtype=dtype)
+            return mesh
+
+        ref_data = load(ref)
+        sub_data, times = measure(lambda: load(sub), repeat=args.repeat)
+        results['load'] = summary(times)
+        results['vertices'] = int(sub_data.coords.shape[0])
+
+        settings = {'solver': args.solver, 'tol': args.tol, 'maxiter': 5000}
+        ref_embedding = Embedding(ref_data)
+        ref_embedding.spectral(args.eig, **settings)
+
+        _, times = measure(lambda: weight_adjacency_matrix(sub_data.coords, sub_data.faces), repeat=args.repeat)
+        results['weight_adjacency'] = summary(times)
+
+        weights, degree = weight_adjacency_csr(sub_data.coords, sub_data.faces)
+        laplace, times = measure(lambda: (degree - weights).tocsr(), repeat=args.repeat)
+        results['laplacian'] = summary(times)
+
+        (eig_vals, eig_vecs, info), times = measure(lambda: eigen_values_spectrum(laplace, degree, args.eig, **settings),
+                                                    repeat=args.repeat)
+        results['eigen_values_spectrum'] = summary(times)
+        results['eigen_values_spectrum']['iterations'] = info['iterations'] # None when the solver does not report it
+
+        # subject embedding rebuilt from the timed decomposition before every stage that changes it
+        embedding = Embedding(sub_data)
+        embedding.spectral(args.eig, **settings)
+        state = {key: value.clone() for key, value in embedding.state_dict().items()}
+
+        def fresh():
+            embedding.load_state_dict({key: value.clone() for key, value in state.items()})
+            return ()
+
+        if 'flip_eigen_sign' in stages:
+            _, times = measure(lambda: flip_eigen_sign(ref_embedding, embedding, args.eig, False), fresh, args.repeat)
+            results['flip_eigen_sign'] = summary(times)
+
+        for mode in ('partial', 'complete'):
+            if 'align_' + mode not in stages:
+                continue
+            samples = args.samples if mode == 'partial' else []
+            _, times = measure(lambda: embedding.align(ref_embedding, args.eig, samples, True, two_step=False,
+                                                       matching_mode=mode, verbose=False, icp_engine=args.icp),
+                               fresh, args.repeat)
+            results['align_' + mode] = summary(times)
+
+        if 'save' in stages:
+            out = tempfile.mkdtemp(prefix='bench_save')
+            try:
+                os.makedirs(os.path.join(out, 'spectral_data'))
+                os.makedirs(os.path.join(out, 'mesh_data'))
+                _, times = measure(lambda: save_embedding(embedding, out, sub, 'lh', embedding.X, args.format),
+                                   repeat=args.repeat)
+                results['save'] = summary(times)
+            finally:
+                shutil.rmtree(out, ignore_errors=True)
+
+        return {key: value for key, value in results.items() if key == 'vertices' or key in stages}
+
+
+def environment():
+        """
+        Machine and library versions stored with the results
+        """
+        return {'python': platform.python_version(), 'platform': platform.platform(),
+                'cpus': os.cpu_count(), 'threads': torch.get_num_threads(),
+                'numpy': np.__version__, 'scipy': scipy.__version__, 'torch': torch.__version__,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(results, baseline, tolerance=0.25, min_delta=0.01):
+        """
+        Compares the median time of every stage of results against the baseline
+
+        A stage regresses when it is more than `tolerance` (relative) and
+        `min_delta` seconds slower than the baseline, and is faster when it is
+        as much faster.
+
+        returns: list of (size, stage, baseline time, time, ratio, status), status
+                 'regression', 'faster' or '' (baseline time and ratio are None
+                 for stages missing in the baseline)
+        """
+        rows = []
+        for size, stages in results['results'].items():
+            base = baseline['results'].get(size, {})
+            for stage in STAGES:
+                if stage not in stages:
+                    continue
+                if stage not in base: # new stage or size, nothing to compare
+                    rows.append((size, stage, None, stages[stage]['median'], None, ''))
+                    continue
+                old, new = base[stage]['median'], stages[stage]['median']
+                ratio = new / old if old > 0 else float('inf')
+                status = ''
+                if new > old * (1 + tolerance) and new - old > min_delta:
+                    status = 'regression'
+                elif old > new * (1 + tolerance) and old - new > min_delta:
+                    status = 'faster'
+                rows.append((size, stage, old, new, ratio, status))
+        return rows
+
+
+# settings that change the timings, compared with the ones of the baseline
+TIMED_SETTINGS = ['eig', 'solver', 'tol', 'icp', 'samples', 'dtype', 'format', 'repeat']
+
+
+def differences(results, baseline):
+        """
+        Settings and machine properties of results that differ from the baseline
+
+        returns: list of (name, baseline value, value)
+        """
+        rows = [(name, baseline['settings'].get(name), results['settings'][name]) for name in TIMED_SETTINGS]
+        rows += [(name, baseline['environment'].get(name), results['environment'][name]) for name in ('cpus', 'threads')]
+        return [row for row in rows if row[1] != row[2]]
+
+
+def print_table(results, rows=None):
+        print('{:>8} {:<22} {:>10} {:>10} {:>7}'.format('size', 'stage', 'baseline', 'time (s)', 'ratio'))
+        if rows is None:
+            rows = [(size, stage, None, stages[stage]['median'], None, '')
+                    for size, stages in results['results'].items() for stage in STAGES if stage in stages]
+        for size, stage, old, new, ratio, status in rows:
+            print('{:>8} {:<22} {:>10} {:>10.4f} {:>7}{}'.format(
+                size, stage, '-' if old is None else '{:.4f}'.format(old), new,
+                '-' if ratio is None else '{:.2f}'.format(ratio), '  ' + status.upper() if status else ''))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='per-stage benchmark on synthetic surfaces')
+    parser.add_argument('--sizes', default='10000,40000', help='comma separated vertex counts (10000 to 500000)')
+    parser.add_argument('--stages', default=','.join(DEFAULT_STAGES), help='comma separated stages to time: ' + ', '.join(STAGES))
+    parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(), 'spectral_align_bench'), help='directory of the synthetic subjects (generated once)')
+    parser.add_argument('--out', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='results JSON file to compare against')
+    parser.add_argument('--tolerance', default=0.25, type=float, help='relative slowdown of a stage reported as a regression')
+    parser.add_argument('--min_delta', default=0.01, type=float, help='absolute slowdown (s) below which a stage never regresses')
+    parser.add_argument('--repeat', default=3, type=int, help='timed runs of every stage (the median is compared)')
+    parser.add_argument('--eig', default=5, type=int, help='number of eigenvectors')
+    parser.add_argument('--solver', default='eigs', choices=sorted(SOLVERS), help='eigensolver')
+    parser.add_argument('--tol', default=1e-3, type=float, help='eigensolver tolerance')
+    parser.add_argument('--icp', default='pytorch3d', choices=['pytorch3d', 'kdtree'], help='ICP engine')
+    parser.add_argument('--samples', default=10000, type=int, help='partial matching sample count')
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'], help='pipeline precision')
+    parser.add_argument('--format', default='torch', choices=['torch', 'store', 'both'], help='output format of the save stage')
+    args = parser.parse_args(argv)
+    unknown = set(args.stages.split(',')) - set(STAGES)
+    if unknown:
+        parser.error('unknown stages: ' + ', '.join(sorted(unknown)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stages = args.stages.split(',')
+    results = {'environment': environment(), 'settings': vars(args), 'results': {}}
+    for vertices in args.sizes.split(','):
+        print('Benchmarking {} vertices'.format(vertices))
+        results['results'][vertices] = benchmark_size(args.data, int(vertices), args, stages)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline is None:
+        print_table(results)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    for name, old, new in differences(results, baseline):
+        print('Note: {} is {} here and {} in the baseline, the times are not comparable'.format(name, new, old))
+    rows = compare(results, baseline, args.tolerance, args.min_delta)
+    print_table(results, rows)
+    faster = [row for row in rows if row[-1] == 'faster']
+    regressions = [row for row in rows if row[-1] == 'regression']
+    if faster:
+        print('{} stage(s) faster than the baseline'.format(len(faster)))
+    if regressions:
+        print('{} stage(s) slower than the baseline'.format(len(regressions)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
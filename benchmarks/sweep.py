@@ -0,0 +1,241 @@
+"""
+Accuracy vs speed sweep of the alignment settings
+
+Aligns every subject of a list to one reference with each setting of a grid
+(matching mode and sample count, number of eigenvectors, two_step, eigensolver
+tolerance) and measures the cost (wall time and peak memory of the subject
+decomposition and alignment) and the quality (Dice of the reference
+parcellation transferred through the aligned spectral embedding, see
+utils.correspondence, and residual ICP RMSE). The settings that no other
+setting beats on all the objectives at once (--objectives, time and Dice by
+default) are reported as the Pareto front.
+
+Without --ref, the sweep runs on synthetic subjects (see benchmarks.synthetic),
+whose 8 parcels stand for the DKT labels:
+
+python -m benchmarks.sweep --vertices 10000 --subjects 4 --out sweep.json --table sweep.csv
+python -m benchmarks.sweep --ref /data/HLN-12-1 --list subjects.txt --data /data --modes partial --samples 2000,5000,10000
+"""
+
+import os
+import sys
+import csv
+import json
+import argparse
+import itertools
+import tempfile
+import numpy as np
+from utils.load_mesh import LoadMesh
+from utils.embedding import Embedding
+from utils.graph_spectrum import SOLVERS
+from utils.instrument import StageRecorder
+from utils.correspondence import CorrespondenceIndex, spectral_points, vote_labels, match_labels, transfer_accuracy
+from utils.utils import read_file_list
+from benchmarks.synthetic import make_cohort
+from benchmarks.run import environment
+
+# objectives of the Pareto front, minimized or not
+OBJECTIVES = {'time': True, 'max_time': True, 'peak_rss_mb': True, 'dice': False, 'min_label_dice': False,
+              'accuracy': False, 'rmse': True}
+
+
+def grid(modes, samples, eigs, two_steps, tols):
+        """
+        Settings of the sweep, the sample count only varies in partial mode
+
+        returns: list of dicts of mode, samples, eig, two_step, tol
+        """
+        configs = []
+        for mode, eig, two_step, tol in itertools.product(modes, eigs, two_steps, tols):
+            for n in (samples if mode == 'partial' else [None]):
+                configs.append({'mode': mode, 'samples': n, 'eig': eig, 'two_step': two_step, 'tol': tol})
+        return configs
+
+
+def label(config):
+        return '{}{} eig={} two_step={} tol={:g}'.format(
+            config['mode'], '' if config['samples'] is None else '({})'.format(config['samples']),
+            config['eig'], int(config['two_step']), config['tol'])
+
+
+def pareto(rows, objectives=('time', 'dice')):
+        """
+        Indices of the rows not dominated by another row (no worse on every
+        objective and better on one)
+        """
+        def key(row):
+            return [row[name] if OBJECTIVES[name] else -row[name] for name in objectives]
+
+        keys = [key(row) for row in rows]
+        return [i for i, a in enumerate(keys)
+                if not any(all(x <= y for x, y in zip(b, a)) and b != a for b in keys)]
+
+
+class References:
+    """
+    Reference embeddings (per eigenvector count and tolerance) and their
+    correspondence indices, computed once for the whole sweep
+    """
+
+    def __init__(self, mesh, args):
+        self.mesh = mesh
+        self.args = args
+        self.embeddings = {}
+
+    def get(self, eig, tol):
+        key = (eig, tol)
+        if key not in self.embeddings:
+            embedding = Embedding(self.mesh)
+            embedding.spectral(eig, tol=tol, solver=self.args.solver, maxiter=5000)
+            embedding.correspondence = CorrespondenceIndex.from_embedding(embedding, eig, 1)
+            self.embeddings[key] = embedding
+        return self.embeddings[key]
+
+
+def run_config(config, references, subjects, args):
+        """
+        Aligns every subject with one setting
+
+        returns: row of the setting with the mean time, peak memory, Dice,
+                 accuracy and RMSE over the subjects, the worst label Dice and
+                 the mean Dice of every label
+        """
+        ref = references.get(config['eig'], config['tol'])
+        times, peaks, dice, accuracy, rmse, iterations = [], [], [], [], [], []
+        per_label = {}
+        for name, mesh in subjects:
+            recorder = StageRecorder(name)
+            embedding = Embedding(mesh)
+            with recorder.stage('spectral'):
+                embedding.spectral(config['eig'], tol=config['tol'], solver=args.solver, maxiter=5000)
+            with recorder.stage('align'):
+                embedding.align(ref, config['eig'], config['samples'] or [], True, two_step=config['two_step'],
+                                matching_mode=config['mode'], verbose=False, icp_engine=args.icp, seed=args.seed)
+            stages = recorder.record['stages']
+            times.append(stages['spectral']['wall'] + stages['align']['wall'])
+            peaks.append(max(stages['spectral']['peak_rss_mb'], stages['align']['peak_rss_mb']))
+            rmse.append(embedding.alignment_info['rmse'])
+            iterations.append(embedding.alignment_info['icp_iterations'])
+
+            dist, idx = ref.correspondence.query(spectral_points(embedding, config['eig'], 1), args.transfer_k)
+            # in the label indices of the subject, per label Dice keyed by annotation id
+            labels, ids = match_labels(ref.P, ref.P_ids, mesh.P_ids)
+            scores = transfer_accuracy(vote_labels(labels, idx, dist), mesh.P)
+            dice.append(scores['dice'])
+            accuracy.append(scores['accuracy'])
+            for key, value in scores['dice_per_label'].items():
+                per_label.setdefault(int(ids[key]), []).append(value)
+
+        per_label = {key: float(np.mean(values)) for key, values in sorted(per_label.items())}
+        return dict(config, label=label(config), time=float(np.mean(times)), max_time=float(np.max(times)),
+                    peak_rss_mb=float(np.max(peaks)), dice=float(np.mean(dice)), min_label_dice=min(per_label.values()),
+                    accuracy=float(np.mean(accuracy)), rmse=float(np.mean(rmse)),
+                    icp_iterations=float(np.mean(iterations)), dice_per_label=per_label)
+
+
+def print_table(rows, front, objectives):
+        print('{:<42} {:>9} {:>9} {:>7} {:>9} {:>9} {:>9}'.format(
+            'setting', 'time (s)', 'peak MB', 'dice', 'min dice', 'accuracy', 'rmse'))
+        for i, row in enumerate(rows):
+            print('{:<42} {:>9.3f} {:>9.0f} {:>7.4f} {:>9.4f} {:>9.4f} {:>9.5f}{}'.format(
+                row['label'], row['time'], row['peak_rss_mb'], row['dice'], row['min_label_dice'],
+                row['accuracy'], row['rmse'], '  *' if i in front else ''))
+        print('* Pareto optimal ({})'.format(', '.join(objectives)))
+
+
+def write_table(path, rows, front):
+        """
+        Writes the rows as CSV, without the per label Dice
+        """
+        columns = ['mode', 'samples', 'eig', 'two_step', 'tol', 'time', 'max_time', 'peak_rss_mb', 'dice',
+                   'min_label_dice', 'accuracy', 'rmse', 'icp_iterations', 'pareto']
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, columns, extrasaction='ignore')
+            writer.writeheader()
+            for i, row in enumerate(rows):
+                writer.writerow(dict(row, pareto=int(i in front)))
+
+
+def load_subjects(args):
+        """
+        Reference and subject meshes, synthetic unless --ref is given
+
+        returns: reference mesh, list of (name, mesh)
+        """
+        if args.ref is None:
+            names = make_cohort(args.data, args.vertices, args.subjects + 1)
+            ref_path, ref, path = args.data, names[0], args.data
+        else:
+            ref_path, ref = os.path.split(os.path.normpath(args.ref))
+            names = read_file_list(args.list)
+            path = args.data or ref_path
+
+        def load(root, name):
+            mesh = LoadMesh()
+            mesh.load_mesh(root, name, args.hemi, 'cpu')
+            return mesh
+
+        return load(ref_path, ref), [(name, load(path, name)) for name in names if name != ref]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='accuracy vs speed sweep of the alignment settings')
+    parser.add_argument('--ref', default=None, help='reference subject directory (default: synthetic subjects)')
+    parser.add_argument('--list', default=None, help='with --ref: text file with one subject per line')
+    parser.add_argument('--data', default=None, help='directory of the listed subjects, or of the synthetic subjects (generated once)')
+    parser.add_argument('--hemi', default='lh', help='hemisphere')
+    parser.add_argument('--vertices', default=10000, type=int, help='synthetic subjects: vertex count')
+    parser.add_argument('--subjects', default=3, type=int, help='synthetic subjects: number of subjects besides the reference')
+    parser.add_argument('--modes', default='partial,complete', help='comma separated matching modes (partial = fast, complete = --robust)')
+    parser.add_argument('--samples', default='2000,10000', help='comma separated partial matching sample counts')
+    parser.add_argument('--eig', default='3,5', help='comma separated numbers of eigenvectors')
+    parser.add_argument('--two_step', default='0,1', help='comma separated two_step settings (0 or 1)')
+    parser.add_argument('--tol', default='1e-3,1e-5', help='comma separated eigensolver tolerances')
+    parser.add_argument('--solver', default='eigs', choices=sorted(SOLVERS), help='eigensolver')
+    parser.add_argument('--icp', default='pytorch3d', choices=['pytorch3d', 'kdtree'], help='ICP engine')
+    parser.add_argument('--seed', default=0, type=int, help='random seed of the partial matching sampling')
+    parser.add_argument('--transfer_k', default=3, type=int, help='number of nearest reference vertices voting for a transferred label')
+    parser.add_argument('--objectives', default='time,dice', help='comma separated objectives of the Pareto front: ' + ', '.join(OBJECTIVES))
+    parser.add_argument('--out', default=None, help='write the settings, rows and Pareto front to this JSON file')
+    parser.add_argument('--table', default=None, help='write the rows to this CSV file')
+    args = parser.parse_args(argv)
+    if args.ref is not None and args.list is None:
+        parser.error('--ref needs --list')
+    if args.data is None and args.ref is None:
+        args.data = os.path.join(tempfile.gettempdir(), 'spectral_align_bench')
+    unknown = set(args.modes.split(',')) - {'partial', 'complete'}
+    if unknown:
+        parser.error('unknown modes: ' + ', '.join(sorted(unknown)))
+    unknown = set(args.objectives.split(',')) - set(OBJECTIVES)
+    if unknown:
+        parser.error('unknown objectives: ' + ', '.join(sorted(unknown)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configs = grid(args.modes.split(','), [int(n) for n in args.samples.split(',')],
+                   [int(n) for n in args.eig.split(',')], [bool(int(n)) for n in args.two_step.split(',')],
+                   [float(t) for t in args.tol.split(',')])
+    ref_mesh, subjects = load_subjects(args)
+    references = References(ref_mesh, args)
+
+    rows = []
+    for config in configs:
+        print('Sweeping {} over {} subjects'.format(label(config), len(subjects)))
+        rows.append(run_config(config, references, subjects, args))
+    objectives = args.objectives.split(',')
+    front = pareto(rows, objectives)
+    print_table(rows, front, objectives)
+
+    if args.table:
+        write_table(args.table, rows, front)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'environment': environment(), 'settings': vars(args), 'rows': rows,
+                       'pareto': [rows[i]['label'] for i in front]}, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
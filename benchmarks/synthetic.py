@@ -0,0 +1,164 @@
+"""
+Deterministic synthetic cortical-like surfaces written as FreeSurfer files
+
+Every surface is a geodesic icosphere (each icosahedron face split into f^2
+triangles, 10 f^2 + 2 vertices) scaled to a brain-like ellipsoid and folded
+by a sum of random plane waves. The fold pattern is shared by all subjects
+and slightly jittered per seed, so subjects of a cohort have similar but not
+identical geometry, like real brains.
+
+python -m benchmarks.synthetic out_dir --vertices 40000 --subjects 3
+"""
+
+import os
+import argparse
+import numpy as np
+import nibabel.freesurfer.io as fsio
+
+
+def icosahedron():
+        """
+        Unit icosahedron
+
+        returns: vertices (12 x 3), faces (20 x 3, outward oriented)
+        """
+        t = (1 + 5 ** 0.5) / 2
+        v = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                      [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                      [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=np.float64)
+        f = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+                      [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                      [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+                      [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]], dtype=np.int64)
+        return v / np.linalg.norm(v, axis=1, keepdims=True), f
+
+
+def geodesic_sphere(frequency):
+        """
+        Unit geodesic icosphere, every icosahedron face split into frequency^2 triangles
+
+        returns: vertices (10 f^2 + 2 x 3), faces (20 f^2 x 3, int32)
+        """
+        v, f = icosahedron()
+        n = frequency
+        # barycentric grid (i, j) of one face, i + j <= n
+        i, j = np.nonzero(np.add.outer(np.arange(n + 1), np.arange(n + 1)) <= n)
+        grid = {(a, b): k for k, (a, b) in enumerate(zip(i.tolist(), j.tolist()))}
+        up = [(grid[a, b], grid[a + 1, b], grid[a, b + 1]) for a, b in grid if a + b < n]
+        down = [(grid[a + 1, b], grid[a + 1, b + 1], grid[a, b + 1]) for a, b in grid if a + b < n - 1]
+        local = np.array(up + down, dtype=np.int64)
+
+        # points of every face, points shared by neighbouring faces merged by position
+        A, B, C = v[f[:, 0]], v[f[:, 1]], v[f[:, 2]]
+        points = (A[:, None] + (i / n)[None, :, None] * (B - A)[:, None] + (j / n)[None, :, None] * (C - A)[:, None])
+        points = points.reshape(-1, 3)
+        _, first, index = np.unique(np.round(points, 9), axis=0, return_index=True, return_inverse=True)
+        index = index.reshape(-1)
+        # keep the vertices in order of first appearance
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.shape[0])
+        vertices = points[first[order]]
+        faces = rank[index[(local[None] + (np.arange(f.shape[0]) * i.shape[0])[:, None, None]).reshape(-1, 3)]]
+        return vertices / np.linalg.norm(vertices, axis=1, keepdims=True), faces.astype(np.int32)
+
+
+def frequency_for(vertices):
+        """
+        Smallest geodesic frequency with at least the given number of vertices
+        """
+        return max(1, int(np.ceil(np.sqrt(max(vertices - 2, 0) / 10))))
+
+
+def synthetic_surface(vertices, seed=0, folds=24, depth=0.08, jitter=0.05):
+        """
+        Folded brain-like surface and its surface data
+
+        vertices : minimum number of vertices (rounded up to a geodesic sphere)
+        seed     : subject seed (jitters the shared fold pattern)
+        folds    : number of plane waves of the fold pattern
+        depth    : relative fold amplitude
+        jitter   : relative amplitude of the subject variation
+
+        returns: dict of coords (n x 3), faces (m x 3, int32), sulc, thickness,
+                 curv (n, float32) and labels (n, int32)
+        """
+        v, faces = geodesic_sphere(frequency_for(vertices))
+
+        # fold pattern shared by every subject, jittered per subject
+        shared = np.random.RandomState(2 ** 31 - 1)
+        directions = shared.normal(size=(folds, 3))
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        frequencies = shared.uniform(3, 9, folds)
+        phases = shared.uniform(0, 2 * np.pi, folds)
+        rng = np.random.RandomState(seed)
+        directions = directions + jitter * rng.normal(size=directions.shape)
+        phases = phases + 2 * np.pi * jitter * rng.normal(size=folds)
+
+        waves = np.sin((v @ directions.T) * frequencies + phases)
+        fold = waves.sum(1) / np.sqrt(folds)
+        fold /= np.abs(fold).max()
+        coords = v * np.array([70.0, 90.0, 60.0]) * (1 + depth * fold)[:, None]
+
+        # sulci are the inward folds: deep, thin, positively curved
+        sulc = -10 * fold
+        curv = -0.3 * (fold - waves.mean(1))
+        thickness = 2.5 - 0.5 * fold
+
+        # 8 parcels: hemisphere octants
+        labels = 1 + (v[:, 0] > 0) + 2 * (v[:, 1] > 0) + 4 * (v[:, 2] > 0)
+        return {'coords': coords, 'faces': faces, 'sulc': sulc.astype(np.float32),
+                'thickness': thickness.astype(np.float32), 'curv': curv.astype(np.float32),
+                'labels': labels.astype(np.int32)}
+
+
+def write_subject(root, name, surface, hemi='lh'):
+        """
+        Writes a synthetic surface as the FreeSurfer files read by LoadMesh
+        (<root>/<name>/surf/<hemi>.white, sulc, thickness, curv and the DKT annotation)
+        """
+        surf = os.path.join(root, name, 'surf')
+        label = os.path.join(root, name, 'label')
+        os.makedirs(surf, exist_ok=True)
+        os.makedirs(label, exist_ok=True)
+        fsio.write_geometry(os.path.join(surf, hemi + '.white'), surface['coords'].astype(np.float32), surface['faces'])
+        for key in ('sulc', 'thickness', 'curv'):
+            fsio.write_morph_data(os.path.join(surf, hemi + '.' + key), surface[key])
+
+        names = [b'unknown'] + ['parcel{}'.format(k).encode() for k in range(1, 9)]
+        ctab = np.zeros((len(names), 5), dtype=np.int32)
+        ctab[:, 0] = np.arange(len(names)) * 25
+        ctab[:, 1] = 255 - np.arange(len(names)) * 25
+        ctab[:, 2] = 100
+        fsio.write_annot(os.path.join(label, hemi + '.labels.DKT31.manual.2.annot'), surface['labels'], ctab, names)
+
+
+def make_cohort(root, vertices, subjects=2, hemi='lh', prefix='synth'):
+        """
+        Writes a cohort of synthetic subjects, skipping the ones already written
+
+        returns: subject names (<prefix>_<vertices>_<seed>)
+        """
+        names = []
+        for seed in range(subjects):
+            name = '{}_{}_{}'.format(prefix, vertices, seed)
+            if not os.path.exists(os.path.join(root, name, 'label', hemi + '.labels.DKT31.manual.2.annot')):
+                write_subject(root, name, synthetic_surface(vertices, seed), hemi)
+            names.append(name)
+        return names
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='write synthetic FreeSurfer subjects')
+    parser.add_argument('out', help='output directory')
+    parser.add_argument('--vertices', default='40000', help='comma separated vertex counts, e.g. 10000,100000,500000')
+    parser.add_argument('--subjects', default=2, type=int, help='number of subjects per vertex count')
+    parser.add_argument('--hemi', default='lh', help='hemisphere prefix of the files')
+    args = parser.parse_args(argv)
+    for vertices in args.vertices.split(','):
+        for name in make_cohort(args.out, int(vertices), args.subjects, args.hemi):
+            print(os.path.join(args.out, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,3 +10,4 @@ conda install -c fvcore -c iopath -c conda-forge fvcore iopath
 conda install pytorch3d -c pytorch3d
 conda install pyg -c pyg
 pip install nibabel
+pip install pyamg
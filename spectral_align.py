@@ -3,6 +3,12 @@
 """
 Script to perform spectral aligmnet between given and reference brain surface
 
+Aligns a single subject (-s) or, in batch mode, every subject of a list (-l)
+to the reference. Batch mode keeps the reference embedding in memory and
+spreads the subjects over a pool of worker processes. With --atlas, every
+subject is decomposed once and aligned to many references. With --serve, the
+script stays resident and aligns the jobs submitted with align_client.py.
+
 If this code is useful to you, please cite:
 
 Herve paper
@@ -11,85 +17,384 @@ Karthik paper
 
 import os
 import argparse
+import contextlib
+import threading
 import timeit
+from collections import OrderedDict
+from concurrent.futures import Future
 import torch
+import torch.multiprocessing as mp
 from torch_geometric.data import Data
 from utils.load_mesh import LoadMesh
 from utils.embedding import Embedding
+from utils.graph_spectrum import SOLVERS
+from utils.sampling import SAMPLERS
+from utils.cohort import align_cohort
+from utils.atlas import align_references
+from utils.flip_eigen import reference_poles
+from utils.pipeline import StreamingExecutor
+from utils.manifest import Manifest
+from utils.service import AlignmentService, serve
+from utils.cache import EmbeddingCache, SpectrumCache
+from utils.store import SpectralStore
+from utils.instrument import StageRecorder, no_stage
+from utils.correspondence import CorrespondenceIndex, spectral_points, vote_labels, interpolate, match_labels, transfer_accuracy
+from utils.utils import read_file_list
+
+# maximum number of eigensolver iterations
+eig_maxiter = 5000
+
+
+class _JobParser(argparse.ArgumentParser):
+    # argument errors of a service job are reported to its client, not fatal
+
+    def error(self, message):
+        raise ValueError(message)
+
+
+def parse_args(argv=None, parser_class=argparse.ArgumentParser):
+    """
+    Parses the command line arguments (argv defaults to sys.argv)
+    """
+    parser = parser_class()
+    parser.add_argument('-r', '--ref', default=None, help='directory for the reference brain')
+    parser.add_argument('--atlas', default=None, help='multi-reference mode: text file with one reference directory per line, replacing -r (outputs <sub>_to_<ref>_<hemi>)')
+    parser.add_argument('-s', '--sub', default=None, help='directory for the subj/to be aligned brain')
+    parser.add_argument('-l', '--list', default=None, help='batch mode: text file with one subject per line')
+    parser.add_argument('-d', '--data', default=None, help='batch mode: directory of the listed subjects (default: directory of the reference)')
+    parser.add_argument('-o', '--out', required=True, help='outut directory for saving data')
+    parser.add_argument('--format', default='torch', choices=['torch', 'store', 'both'], help='output format: torch.save files, memory-mappable store (<out>/store) or both')
+    parser.add_argument('--hemi', default='lh', help='hemisphere to align (`lr` or `rh`)')
+    parser.add_argument('--eig', default=5, type=int, help='number of eigenvectors to decompose')
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'], help='precision of the loaded surfaces, embeddings and alignment (the eigensolver always runs in float64)')
+    parser.add_argument('--solver', default='eigs', choices=sorted(SOLVERS), help='eigensolver: eigs (random walk Laplacian), eigsh, lobpcg or multilevel (generalized L v = lambda D v)')
+    parser.add_argument('--precond', default='amg', choices=['amg', 'lu', 'ilu'], help='lobpcg preconditioner: algebraic multigrid (pyamg, exact LU without it), exact LU or incomplete LU')
+    parser.add_argument('--tol', default=1e-3, type=float, help='eigensolver tolerance')
+    parser.add_argument('--levels', default=4, type=int, help='multilevel solver: number of coarsening levels')
+    parser.add_argument('--refine_tol', default=None, type=float, help='multilevel solver: refinement tolerance (default --tol)')
+    parser.add_argument('--sul', default=True, action='store_true', help='use sulcal depth for alignment matching')
+    parser.add_argument('--two_step', default=False, action='store_true', help='use first 3 less ambiguous eigenvectors to align')
+    parser.add_argument('--gpu', default=False, action='store_true', help='GPU or CPU')
+    parser.add_argument('--robust', default=False, action='store_true', help='robust vs faster alignment. fast - uses few eigen and partial matching')
+    parser.add_argument('--icp', default='pytorch3d', choices=['pytorch3d', 'kdtree'], help='ICP engine: pytorch3d (brute force KNN) or kdtree (multithreaded CPU queries)')
+    parser.add_argument('--sampling', default='random', choices=sorted(SAMPLERS), help='partial matching sampling: random, fps (farthest point), area or curvature (stratified)')
+    parser.add_argument('--schedule', default=None, help='partial matching coarse-to-fine sample counts, e.g. 1000,4000,10000')
+    parser.add_argument('--seed', default=0, type=int, help='random seed of the partial matching sampling')
+    parser.add_argument('--icp_iterations', default=100, type=int, help='maximum ICP iterations of every alignment stage (two_step, each --schedule stage)')
+    parser.add_argument('--icp_tol', default=1e-6, type=float, help='ICP stops once the relative RMSE improvement of an iteration is below this')
+    parser.add_argument('--icp_budget', default=None, type=float, help='wall clock budget in seconds of the ICP stages of one subject (default: unbounded)')
+    parser.add_argument('--hypotheses', default=False, action='store_true', help='resolve eigenvector signs and near degenerate swaps by scoring candidates with a batched ICP')
+    parser.add_argument('--transfer', default=False, action='store_true', help='transfer the reference parcellation, depth and thickness to every subject through its aligned embedding')
+    parser.add_argument('--transfer_k', default=3, type=int, help='number of nearest reference vertices voting for a transferred label')
+    parser.add_argument('--verbose', default=False, action='store_true', help='Verbose mode')
+    parser.add_argument('--mem_report', default=False, action='store_true', help='print the time and peak resident memory of every stage (load, spectral, align, save)')
+    parser.add_argument('--log', default=None, help='JSON lines file receiving one record of stage times, memory and iterations per subject (default: <out>/stages.jsonl)')
+    parser.add_argument('--profile', default=None, help='directory receiving a cProfile dump of every stage of every subject (off by default)')
+    parser.add_argument('--cache', default=None, help='reference embedding cache directory (default: <out>/ref_cache)')
+    parser.add_argument('--cache_size', default=2048, type=int, help='maximum size of the reference cache in MB')
+    parser.add_argument('--mesh_cache', default=None, help='directory caching the converted FreeSurfer arrays of every subject (off by default)')
+    parser.add_argument('--spectra', default=None, help='directory keeping the eigen pairs of every decomposed mesh by Laplacian: a smaller --eig slices them, a larger one only computes the missing pairs (off by default, bounded by --cache_size)')
+    parser.add_argument('--no_cache', default=False, action='store_true', help='always recompute the reference embedding')
+    parser.add_argument('--force', default=False, action='store_true', help='recompute every subject, even the ones up to date in <out>/manifest.json')
+    parser.add_argument('--workers', default=1, type=int, help='batch mode: number of worker processes')
+    parser.add_argument('--threads', default=None, type=int, help='batch mode: threads per worker (default: cores / workers)')
+    parser.add_argument('--stream', default=False, action='store_true', help='batch mode: overlap the loading and writing of subjects with the computation (in the main process)')
+    parser.add_argument('--prefetch', default=2, type=int, help='streaming mode: number of subjects loaded ahead and of outputs waiting to be written')
+    parser.add_argument('--cohort', default=0, type=int, help='batch mode: align groups of this many subjects with one batched ICP (partial matching, in the main process)')
+    parser.add_argument('--serve', default=None, help='run as a resident service aligning the jobs of align_client.py submitted on this Unix socket (the reference of -r is loaded at startup)')
+    parser.add_argument('--queue', default=16, type=int, help='service: maximum number of jobs waiting, further jobs are rejected')
+    parser.add_argument('--concurrency', default=1, type=int, help='service: number of jobs running at once (each with --threads threads, default: cores / concurrency)')
+    parser.add_argument('--resident', default=2, type=int, help='service: number of reference embeddings kept in memory')
+    args = parser.parse_args(argv)
+    if (args.ref is None) == (args.atlas is None):
+        parser.error('exactly one of --ref or --atlas is required')
+    if args.atlas is not None:
+        if args.robust or args.hypotheses:
+            parser.error('--atlas aligns with partial matching and pole based signs, it cannot be used with --robust or --hypotheses')
+        if args.cohort or args.stream or args.serve is not None or args.workers > 1:
+            parser.error('--atlas batches the references of one subject in the main process, it cannot be used with --cohort, --stream, --serve or --workers')
+    if args.serve is not None:
+        if args.sub is not None or args.list is not None:
+            parser.error('--serve takes its subjects from the submitted jobs, not --sub or --list')
+    elif (args.sub is None) == (args.list is None):
+        parser.error('exactly one of --sub or --list is required')
+    if args.cohort and args.robust:
+        parser.error('--cohort batches the partial matching samples, it cannot be used with --robust')
+    return args
+
+
+def matching_parameters(args):
+    """
+    Returns the (matching_samples, matching_mode) of robust vs fast alignment
+    """
+    if args.robust:
+        return [], 'complete' #  using all points for matching
+    if args.schedule:
+        return [int(n) for n in args.schedule.split(',')], 'partial' # coarse-to-fine sample counts
+    return 10000, 'partial' #  number of points used to find transformation #5000
+
+
+def output_parameters(args):
+    """
+    Parameters changing the aligned outputs, recorded in the manifest
+    """
+    matching_samples, matching_mode = matching_parameters(args)
+    return {'eig': args.eig, 'sul': args.sul, 'two_step': args.two_step, 'matching_samples': matching_samples,
+            'matching_mode': matching_mode, 'sampling': args.sampling, 'seed': args.seed, 'hypotheses': args.hypotheses,
+            'icp': args.icp, 'icp_iterations': args.icp_iterations, 'icp_tol': args.icp_tol, 'icp_budget': args.icp_budget, 'dtype': args.dtype, 'transfer': args.transfer, 'transfer_k': args.transfer_k,
+            'spectral': spectral_settings(args)}
+
+
+def atlas_name(sub, ref):
+    """
+    Output name of a subject aligned to one reference of the atlas
+    """
+    return '{}_to_{}'.format(sub, ref)
+
+
+def output_files(sub, args, refs=None):
+    """
+    Output files of a subject, relative to the output directory; with the
+    references of the atlas, one spectral output per reference and the mesh once
+    """
+    names = ['{}_{}'.format(sub, args.hemi)] if refs is None else ['{}_{}'.format(atlas_name(sub, ref), args.hemi) for ref in refs]
+    files = []
+    if args.format in ('torch', 'both'):
+        files += [os.path.join('spectral_data', name + '.pt') for name in names]
+        files += [os.path.join('mesh_data', '{}_{}.pt'.format(sub, args.hemi))]
+    if args.format in ('store', 'both'):
+        files += [os.path.join('store', 'spectral', name) for name in names]
+    return files
+
+
+def plan_subjects(manifest, references, sub_path, subjects, args):
+    """
+    Subjects whose outputs are missing or stale (all of them with --force);
+    reports why each subject is processed or skipped
+
+    references : (directory, id) of the reference, or of every reference of the atlas
+    """
+    reference = [manifest.reference(ref, LoadMesh.surface_files(ref_path, ref, args.hemi)) for ref_path, ref in references]
+    refs = [ref for _, ref in references] if args.atlas else None
+    parameters = output_parameters(args)
+    todo = []
+    for sub in subjects:
+        name = '{}_{}'.format(sub, args.hemi)
+        entry = manifest.entry(LoadMesh.surface_files(sub_path, sub, args.hemi), reference, parameters, output_files(sub, args, refs))
+        reason = 'forced' if args.force else manifest.stale(name, entry)
+        if reason is None:
+            print('{} up to date - skipping'.format(sub))
+            continue
+        print('{} to align: {}'.format(sub, reason))
+        manifest.plan(sub, name, entry)
+        todo.append(sub)
+    return todo
 
 
-# parse the input arguments
-parser = argparse.ArgumentParser()
-parser.add_argument('-r', '--ref', required=True, help='directory for the reference brain')
-parser.add_argument('-s', '--sub', required=True, help='directory for the subj/to be aligned brain')
-parser.add_argument('-o', '--out', required=True, help='outut directory for saving data')
-parser.add_argument('--hemi', default='lh', help='hemisphere to align (`lr` or `rh`)')
-parser.add_argument('--eig', default=5, help='number of eigenvectors to decompose')
-parser.add_argument('--sul', default='True', action='store_true', help='use sulcal depth for alignment matching')
-parser.add_argument('--two_step', default='False', action='store_true', help='use first 3 less ambiguous eigenvectors to align')
-parser.add_argument('--gpu', default='False', action='store_true', help='GPU or CPU')
-parser.add_argument('--robust', default='False', action='store_true', help='robust vs faster alignment. fast - uses few eigen and partial matching')
-parser.add_argument('--verbose', default='False', action='store_true', help='Verbose mode')
-args = parser.parse_args()
-
-# set robust vs fast parameters
-if args.robust == True:
-    matching_samples = [] #  using all points for matching
-    matching_mode = 'complete' #partial or complete
-    print('Using robust alignment with all points')
-else:
-    matching_samples = 10000  #  number of points used to find transformation #5000
-    matching_mode = 'partial' #partial or complete    
-    print('Using faster alignment with {}'.format(matching_samples))
-
-if args.gpu:
-    print('Using GPU')
-    device = 'cuda'
-else:
-    print('Using CPU')
-    device = 'cpu'
-
-# set the reference, subject and output directories
-ref_path, ref = os.path.split(args.ref)
-sub_path, sub = os.path.split(args.sub)
-
-out_path = args.out
-if not os.path.exists(out_path):
-    print('Creating output directory')
-    os.makedirs(out_path)
-if not os.path.exists(os.path.join(out_path, 'spectral_data')):
-    os.makedirs(os.path.join(out_path, 'spectral_data'))
-if not os.path.exists(os.path.join(out_path, 'mesh_data')):
-    os.makedirs(os.path.join(out_path, 'mesh_data'))
-
-start = timeit.default_timer()
-st = start
-
-# check for self alignment
-if ref == sub:
-    print('Self alignment - Skipping computation')
+def spectral_settings(args):
+    """
+    Returns the eigensolver settings (keyword arguments of Embedding.spectral)
+    """
+    settings = {'solver': args.solver, 'precond': args.precond, 'tol': args.tol, 'maxiter': eig_maxiter}
+    if args.solver == 'multilevel':
+        settings.update(levels=args.levels, refine_tol=args.refine_tol)
+    return settings
+
+
+def reference_cache(args):
+    """
+    Reference embedding cache of args (None with --no_cache)
+    """
+    if args.no_cache:
+        return None
+    return EmbeddingCache(args.cache or os.path.join(args.out, 'ref_cache'), max_bytes=args.cache_size * 2**20)
+
+
+def spectrum_cache(args):
+    """
+    Eigen pair cache of args (None without --spectra)
+    """
+    if args.spectra is None:
+        return None
+    return SpectrumCache(args.spectra, max_bytes=args.cache_size * 2**20)
+
+
+def log_path(args):
+    """
+    JSON lines file of the per-subject stage records
+    """
+    return args.log or os.path.join(args.out, 'stages.jsonl')
+
+
+def reference_embedding(path, id, hemi, ne, device, cache=None, settings=None, verbose=False, mesh_cache=None,
+                        dtype=torch.float64, stage=no_stage, spectra=None):
+    """
+    Loads the reference mesh and computes its spectral embedding, or restores
+    it from the cache when the same surface was decomposed before
+
+    cache    : EmbeddingCache or None (always recompute)
+    settings : eigensolver settings (see spectral_settings), part of the cache key
+    mesh_cache : converted-array cache directory of LoadMesh (optional)
+    dtype    : precision of the mesh and embedding, part of the cache key
+    stage    : stage context of the instrumentation (see StageRecorder.stage)
+    spectra  : SpectrumCache of the eigen pairs by Laplacian (optional, not part of the cache key)
+    """
+    settings = settings or {}
     ref_data = LoadMesh()
-    
-    print('Loading {} as reference mesh'.format(ref))
-    ref_data.load_mesh(ref_path, ref, args.hemi, device)
-    ref_spectral_embedding = Embedding(ref_data)
-    print('Computing spectral embedding of {} as reference'.format(ref))
-    ref_spectral_embedding.spectral(args.eig)
-
-    spec_data = Data(eig_vec = ref_spectral_embedding.eig_vecs,
-            eig_val = ref_spectral_embedding.eig_vals,
-            ali_spe = ref_spectral_embedding.X,
-            uni_spe = ref_spectral_embedding.X)
-
-    mesh_data = Data(depth = ref_spectral_embedding.depth,
-                curv = ref_spectral_embedding.curv,
-                thick = ref_spectral_embedding.thickness,
-                parc = ref_spectral_embedding.P,
-                edge_index = ref_spectral_embedding.edge_index,
-                edge_attr = ref_spectral_embedding.edge_attr,
-                coords = ref_spectral_embedding.coords,
-                faces = ref_spectral_embedding.faces)
-    
+    print('Loading {} as reference mesh'.format(id))
+    with stage('load'):
+        ref_data.load_mesh(path, id, hemi, device, cache_dir=mesh_cache, dtype=dtype)
+    embedding = Embedding(ref_data)
+    embedding.cache_key = None
+    if cache is None:
+        print('Computing spectral embedding of {} as reference'.format(id))
+        with stage('spectral') as stats:
+            embedding.spectral(ne, verbose=verbose, spectra=spectra, **settings)
+            stats.update(spectrum_stats(embedding))
+        return embedding
+
+    files = LoadMesh.surface_files(path, id, hemi)
+    key = cache.key([files['white'], files['sulc']], eig=ne, dtype=dtype, **settings)
+    embedding.cache_key = key
+    with cache.lock(key), stage('spectral') as stats:
+        state = cache.load(key, device)
+        if state is None:
+            print('Computing spectral embedding of {} as reference'.format(id))
+            embedding.spectral(ne, verbose=verbose, spectra=spectra, **settings)
+            cache.store(key, embedding.state_dict())
+            stats.update(spectrum_stats(embedding))
+        else:
+            print('Using cached spectral embedding of {} as reference'.format(id))
+            embedding.load_state_dict(state)
+            stats.update(cached=True)
+    return embedding
+
+
+def spectrum_stats(embedding):
+    """
+    Eigensolver metrics of a computed embedding, for the stage records
+    """
+    info = embedding.spectrum_info
+    stats = {'solver': info['solver'], 'iterations': info['iterations'],
+             'max_residual': float(info['residuals'].max())}
+    if info.get('levels'): # multilevel solver: vertices, iterations and time of every level
+        stats['levels'] = [{key: getattr(value, 'item', lambda: value)() for key, value in level.items()}
+                           for level in info['levels']]
+    return stats
+
+
+def correspondence_index(embedding, args, cache=None):
+    """
+    Correspondence index of the reference embedding (see utils.correspondence),
+    kept next to its cache entry when the reference is cached
+    """
+    path = None
+    if cache is not None and embedding.cache_key is not None:
+        path = cache.companion(embedding.cache_key, 'index_{}_{}.pkl'.format(args.eig, int(args.sul)))
+        with cache.lock(embedding.cache_key):
+            index = CorrespondenceIndex.from_embedding(embedding, args.eig, int(args.sul), path)
+        cache.evict(keep=embedding.cache_key) # the index counts against the cache size
+        return index
+    return CorrespondenceIndex.from_embedding(embedding, args.eig, int(args.sul))
+
+
+def transfer(ref_embedding, embedding, args, nearest=None):
+    """
+    Transfers the reference parcellation (k nearest vote), depth and thickness
+    (barycentric interpolation) to the vertices of an aligned embedding
+
+    The transferred labels are in the label indices of the subject parcellation
+    when both have annotation ids (see match_labels), in the ones of the
+    reference otherwise.
+
+    nearest : distances and indices of the args.transfer_k nearest reference vertices
+              of the embedding points, queried if None (see CorrespondenceIndex.query_many)
+
+    returns: dict of transferred fields, accuracy / dice against the subject parcellation
+    """
+    index = ref_embedding.correspondence
+    points = spectral_points(embedding, args.eig, int(args.sul))
+    dist, idx = nearest if nearest is not None else index.query(points, args.transfer_k, torch.get_num_threads())
+    vertices, weights = index.barycentric(points, idx[:, 0], torch.get_num_threads())
+    fields = {'depth': torch.from_numpy(interpolate(ref_embedding.depth, vertices, weights)),
+              'thick': torch.from_numpy(interpolate(ref_embedding.thickness, vertices, weights))}
+    scores = {}
+    if len(ref_embedding.P):
+        labels = ref_embedding.P
+        matched = len(embedding.P) and ref_embedding.P_ids is not None and embedding.P_ids is not None
+        if matched:
+            labels, _ = match_labels(labels, ref_embedding.P_ids, embedding.P_ids)
+        fields['parc'] = torch.from_numpy(vote_labels(labels, idx, dist))
+        if matched:
+            scores = transfer_accuracy(fields['parc'], embedding.P)
+    return {'transfer_' + key: value for key, value in fields.items()}, scores
+
+
+def save_embedding(embedding, out_path, name, hemi, uni_spe, fmt='torch', extra=None):
+    """
+    Saves the spectral and mesh data of an embedding in pytorch format and/or
+    in the memory-mappable store (see utils.store)
+
+    embedding : aligned Embedding
+    name      : subject id used for the output file names
+    uni_spe   : unaligned spectral embedding
+    fmt       : 'torch', 'store' or 'both'
+    extra     : additional spectral fields (e.g. transferred data)
+    """
+    spec_data, mesh_data = embedding_data(embedding, uni_spe, extra)
+    if fmt in ('torch', 'both'):
+        torch.save(spec_data, os.path.join(out_path, 'spectral_data', name + '_' + hemi + '.pt'))
+        torch.save(mesh_data, os.path.join(out_path, 'mesh_data', name + '_' + hemi + '.pt'))
+    if fmt in ('store', 'both'):
+        SpectralStore(os.path.join(out_path, 'store')).save(name + '_' + hemi, spec_data, mesh_data)
+
+
+def save_atlas(embeddings, refs, out_path, sub, hemi, uni_spe, fmt='torch', extras=None):
+    """
+    Saves a subject aligned to every reference of the atlas: one spectral
+    output per reference (<sub>_to_<ref>_<hemi>) and a single copy of the
+    subject mesh data (mesh_data/<sub>_<hemi>.pt, or shared by content hash
+    in the store)
+
+    embeddings : aligned Embedding of every reference (see utils.atlas.align_references)
+    uni_spe    : unaligned spectral embedding of every reference
+    extras     : additional spectral fields of every reference (optional)
+    """
+    store = SpectralStore(os.path.join(out_path, 'store')) if fmt in ('store', 'both') else None
+    for i, (embedding, ref) in enumerate(zip(embeddings, refs)):
+        spec_data, mesh_data = embedding_data(embedding, uni_spe[i], extras[i] if extras else None)
+        name = '{}_{}'.format(atlas_name(sub, ref), hemi)
+        if fmt in ('torch', 'both'):
+            torch.save(spec_data, os.path.join(out_path, 'spectral_data', name + '.pt'))
+            if i == 0:
+                torch.save(mesh_data, os.path.join(out_path, 'mesh_data', sub + '_' + hemi + '.pt'))
+        if store is not None:
+            store.save(name, spec_data, mesh_data)
+
+
+def embedding_data(embedding, uni_spe, extra=None):
+    """
+    Spectral and mesh data of an embedding as saved, on the CPU with float64 fields as float32
+    """
+    spec_data = Data(eig_vec = embedding.eig_vecs,
+                eig_val = embedding.eig_vals,
+                ali_spe = embedding.X,
+                uni_spe = uni_spe,
+                **(extra or {}))
+    # ICP convergence trace: iteration, rmse, transform change, elapsed time
+    trace = getattr(embedding, 'alignment_info', {}).get('trace')
+    if trace:
+        spec_data.icp_trace = torch.tensor([[t['iteration'], t['rmse'], t['transform_change'], t['time']] for t in trace])
+
+    mesh_data = Data(depth = embedding.depth,
+                curv = embedding.curv,
+                thick = embedding.thickness,
+                parc = embedding.P,
+                edge_index = embedding.edge_index,
+                edge_attr = embedding.edge_attr,
+                coords = embedding.coords,
+                faces = embedding.faces.float()) # saved as float32 as before the int32 loader
+
     # Save the spectral and mesh data
     spec_data.to('cpu'); mesh_data.to('cpu')
     # check if the value is a tensor and its dtype is float64 and change to float32
@@ -99,65 +404,565 @@ if ref == sub:
     for key, value in mesh_data.items():
         if torch.is_tensor(value) and value.dtype == torch.float64:
             mesh_data[key] = value.float()
-    torch.save(spec_data, os.path.join(out_path, 'spectral_data', ref + '_' + args.hemi + '.pt'))
-    torch.save(mesh_data, os.path.join(out_path, 'mesh_data', ref + '_' + args.hemi + '.pt'))
-    
-else:
-    # Load reference mesh and  compute the spectral embedding
-    ref_data = LoadMesh()
-    print('Loading {} as reference mesh'.format(ref))
-    ref_data.load_mesh(ref_path, ref, args.hemi, device)
-    ref_spectral_embedding = Embedding(ref_data)
-    print('Computing spectral embedding of {} as reference'.format(ref))
-    ref_spectral_embedding.spectral(args.eig)
+    return spec_data, mesh_data
+
+
+def align_subject(ref_embedding, ref, sub_path, sub, args):
+    """
+    Computes the spectral embedding of a subject, aligns it to the reference
+    and saves the result in args.out, appending the record of its stages
+    (times, memory, iterations, see utils.instrument) to the log
+
+    ref_embedding : reference Embedding (spectral already computed)
+    ref           : reference id
+    sub_path, sub : directory and id of the subject
+    args          : parsed arguments (see parse_args)
+    """
+    recorder = StageRecorder('{}_{}'.format(sub, args.hemi), args.profile, subject=sub, reference=ref, hemi=args.hemi)
+    with recorder.run(log_path(args)):
+        _align_subject(ref_embedding, ref, sub_path, sub, args, recorder.stage)
+    if args.mem_report:
+        print('\n'.join(recorder.summary()))
+
+
+def _align_subject(ref_embedding, ref, sub_path, sub, args, stage):
+    device = ref_embedding.device
+
+    # check for self alignment
+    if ref == sub:
+        print('Self alignment - Skipping computation')
+        with stage('save'):
+            save_embedding(ref_embedding, args.out, ref, args.hemi, ref_embedding.X, args.format)
+        return
 
     # Load subject mesh and compute the spectral embedding
+    sub_spectral_embedding = subject_embedding(sub_path, sub, args, device, stage)
+
+    # spectral embedding and matching for other scans
+    align_embedding(ref_embedding, ref, sub_spectral_embedding, sub, args, stage)
+    save_aligned(ref_embedding, sub_spectral_embedding, sub, args, stage)
+
+
+def load_subject(sub_path, sub, args, device, stage=no_stage):
+    """
+    Loads a subject mesh
+    """
     sub_data = LoadMesh()
     print('Loading {} as subject mesh'.format(sub))
-    sub_data.load_mesh(sub_path, sub, args.hemi, device)
+    with stage('load'):
+        sub_data.load_mesh(sub_path, sub, args.hemi, device, cache_dir=args.mesh_cache, dtype=getattr(torch, args.dtype))
+    return sub_data
+
+
+def spectral_embedding(sub_data, sub, args, stage=no_stage):
+    """
+    Computes the spectral embedding of a loaded subject mesh
+    """
     sub_spectral_embedding = Embedding(sub_data)
     print('Computing subject spectral embedding of {} as subject'.format(sub))
-    sub_spectral_embedding.spectral(args.eig)
-    
-    # spectral embedding and matching for other scans
+    with stage('spectral') as stats:
+        sub_spectral_embedding.spectral(args.eig, verbose=args.verbose, spectra=spectrum_cache(args), **spectral_settings(args))
+        stats.update(spectrum_stats(sub_spectral_embedding))
+    return sub_spectral_embedding
+
+
+def subject_embedding(sub_path, sub, args, device, stage=no_stage):
+    """
+    Loads a subject mesh and computes its spectral embedding
+    """
+    return spectral_embedding(load_subject(sub_path, sub, args, device, stage), sub, args, stage)
+
+
+def align_embedding(ref_embedding, ref, sub_spectral_embedding, sub, args, stage=no_stage):
+    """
+    Aligns a subject spectral embedding to the reference (in place)
+    """
     print('Aligning subject {} spectral embedding to {} reference'.format(sub, ref))
-    sub_spectral_embedding.align(ref_spectral_embedding, args.eig, matching_samples, args.sul, two_step=args.two_step, matching_mode=matching_mode, verbose = args.verbose)   
-
-    # Save the spectral and mesh data in pytorch format
-    spec_data = Data(eig_vec = sub_spectral_embedding.eig_vecs,
-                eig_val = sub_spectral_embedding.eig_vals,
-                ali_spe = sub_spectral_embedding.X,
-                uni_spe = torch.matmul(sub_spectral_embedding.eig_vecs, torch.diag(sub_spectral_embedding.eig_vals ** (-0.5))))
-
-    mesh_data = Data(depth = sub_spectral_embedding.depth,
-                curv = sub_spectral_embedding.curv,
-                thick = sub_spectral_embedding.thickness,
-                parc = sub_spectral_embedding.P,
-                edge_index = sub_spectral_embedding.edge_index,
-                edge_attr = sub_spectral_embedding.edge_attr,
-                coords = sub_spectral_embedding.coords,
-                faces = sub_spectral_embedding.faces)
+    matching_samples, matching_mode = matching_parameters(args)
+    with stage('align') as stats:
+        sub_spectral_embedding.align(ref_embedding, args.eig, matching_samples, args.sul, two_step=args.two_step, matching_mode=matching_mode, verbose = args.verbose, icp_engine=args.icp,
+                                     sampling=args.sampling, seed=args.seed, hypotheses=args.hypotheses, stage=stage,
+                                     max_iterations=args.icp_iterations, relative_rmse_thr=args.icp_tol, time_budget=args.icp_budget)
+        stats.update(sub_spectral_embedding.alignment_info)
 
-    # Save the spectral and mesh data
-    device = 'cpu'
-    spec_data.to(device); mesh_data.to(device)
-    # check if the value is a tensor and its dtype is float64 and change to float32
-    for key, value in spec_data.items():
-        if torch.is_tensor(value) and value.dtype == torch.float64:
-            spec_data[key] = value.float()
-    for key, value in mesh_data.items():
-        if torch.is_tensor(value) and value.dtype == torch.float64:
-            mesh_data[key] = value.float()
 
-    torch.save(spec_data, os.path.join(out_path, 'spectral_data', sub + '_' + args.hemi + '.pt'))
-    torch.save(mesh_data, os.path.join(out_path, 'mesh_data', sub + '_' + args.hemi + '.pt'))
+def transferred(ref_embedding, sub_spectral_embedding, sub, args, stage=no_stage, nearest=None):
+    """
+    Reference data transferred to an aligned subject with --transfer (see
+    transfer), None otherwise
+    """
+    if not args.transfer:
+        return None
+    with stage('transfer') as stats:
+        extra, scores = transfer(ref_embedding, sub_spectral_embedding, args, nearest)
+        stats.update(scores)
+    if scores:
+        print('{} transferred parcellation: accuracy {:.3f}, dice {:.3f}'.format(sub, scores['accuracy'], scores['dice']))
+    return extra
+
+
+def write_aligned(sub_spectral_embedding, sub, args, extra=None, stage=no_stage):
+    """
+    Saves an aligned subject with its unaligned embedding
+    """
+    with stage('save'):
+        uni_spe = torch.matmul(sub_spectral_embedding.eig_vecs, torch.diag(sub_spectral_embedding.eig_vals ** (-0.5)))
+        save_embedding(sub_spectral_embedding, args.out, sub, args.hemi, uni_spe, args.format, extra)
+
+
+def save_aligned(ref_embedding, sub_spectral_embedding, sub, args, stage=no_stage, nearest=None):
+    """
+    Transfers the reference data (with --transfer) and saves an aligned subject
+    """
+    extra = transferred(ref_embedding, sub_spectral_embedding, sub, args, stage, nearest)
+    write_aligned(sub_spectral_embedding, sub, args, extra, stage)
+
+
+# state of a batch worker process (set once by _init_worker)
+_worker = {}
+
+
+def _init_worker(ref_embedding, ref, threads):
+    torch.set_num_threads(threads)
+    _worker['ref_embedding'] = ref_embedding
+    _worker['ref'] = ref
+
+
+def _align_worker(job):
+    sub_path, sub, args = job
+    return _timed_align(_worker['ref_embedding'], _worker['ref'], sub_path, sub, args)
+
+
+def _timed_align(ref_embedding, ref, sub_path, sub, args):
+    start = timeit.default_timer()
+    try:
+        align_subject(ref_embedding, ref, sub_path, sub, args)
+    except Exception as e:
+        return sub, timeit.default_timer() - start, repr(e)
+    return sub, timeit.default_timer() - start, None
+
+
+@contextlib.contextmanager
+def blas_threads(threads):
+    """
+    Thread limits of the BLAS libraries for the processes spawned meanwhile
+    (they read them at import), restored on exit so that a long-lived process
+    such as the service does not keep them for its later jobs
+    """
+    names = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+    previous = {var: os.environ.get(var) for var in names}
+    os.environ.update({var: str(threads) for var in names})
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def align_batch(ref_embedding, ref, sub_path, subjects, args, manifest=None):
+    """
+    Aligns a list of subjects to the reference with a pool of worker processes
+
+    Each worker receives the reference embedding once and its BLAS/torch
+    threads are capped at args.threads (default: cores / workers) so that the
+    workers do not oversubscribe the cores.
+
+    returns the list of (subject, error) of the failed subjects
+    """
+    workers = max(1, min(args.workers, len(subjects)))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // workers)
+    jobs = [(sub_path, sub, args) for sub in subjects]
+    failed = []
+
+    if workers == 1:
+        torch.set_num_threads(threads)
+        for sub in subjects:
+            _report(*_timed_align(ref_embedding, ref, sub_path, sub, args), failed, manifest)
+        return failed
+
+    print('Aligning {} subjects with {} workers x {} threads'.format(len(jobs), workers, threads))
+    ctx = mp.get_context('spawn')
+    with blas_threads(threads), ctx.Pool(workers, initializer=_init_worker, initargs=(ref_embedding, ref, threads)) as pool:
+        for sub, elapsed, error in pool.imap_unordered(_align_worker, jobs):
+            _report(sub, elapsed, error, failed, manifest)
+    return failed
+
+
+def align_stream(ref_embedding, ref, sub_path, subjects, args, manifest=None):
+    """
+    Aligns a list of subjects in a streaming pipeline (see utils.pipeline):
+    upcoming subjects are loaded by prefetch threads and the outputs are
+    written by a background thread while the current subject is decomposed
+    and aligned. At most args.prefetch loaded subjects and args.prefetch
+    pending outputs are held in memory.
+
+    returns the list of (subject, error) of the failed subjects
+    """
+    device = ref_embedding.device
+    # items are list positions, a subject may be listed twice
+    recorders = [StageRecorder('{}_{}'.format(sub, args.hemi), args.profile, subject=sub, reference=ref, hemi=args.hemi)
+                 for sub in subjects]
+
+    def load(i):
+        recorders[i].start()
+        if subjects[i] == ref:
+            return None
+        return load_subject(sub_path, subjects[i], args, device, recorders[i].stage)
+
+    def compute(i, sub_data):
+        sub = subjects[i]
+        if sub == ref:
+            print('Self alignment - Skipping computation')
+            return ref_embedding, ref_embedding.X, None
+        stage = recorders[i].stage
+        embedding = spectral_embedding(sub_data, sub, args, stage)
+        align_embedding(ref_embedding, ref, embedding, sub, args, stage)
+        uni_spe = torch.matmul(embedding.eig_vecs, torch.diag(embedding.eig_vals ** (-0.5)))
+        return embedding, uni_spe, transferred(ref_embedding, embedding, sub, args, stage)
+
+    def write(i, result):
+        embedding, uni_spe, extra = result
+        with recorders[i].stage('save'):
+            save_embedding(embedding, args.out, subjects[i], args.hemi, uni_spe, args.format, extra)
+
+    failed = []
+
+    def done(i, error):
+        recorders[i].finish(log_path(args), error)
+        _report(subjects[i], recorders[i].record['wall'], None if error is None else repr(error), failed, manifest)
+
+    print('Streaming {} subjects, prefetching {}'.format(len(subjects), args.prefetch))
+    executor = StreamingExecutor(load, compute, write, prefetch=args.prefetch, pending=args.prefetch)
+    executor.run(range(len(subjects)), done)
+    return failed
+
+
+def align_cohort_batch(ref_embedding, ref, sub_path, subjects, args, manifest=None):
+    """
+    Aligns a list of subjects args.cohort at a time: the embeddings of a group
+    are computed, matched to the reference by one batched ICP (see
+    utils.cohort), their reference correspondents queried at once with
+    --transfer, and saved before the next group is loaded
+
+    returns the list of (subject, error) of the failed subjects
+    """
+    matching_samples, _ = matching_parameters(args)
+    device = ref_embedding.device
+    failed = []
+    for start in range(0, len(subjects), args.cohort):
+        group = []
+        for sub in subjects[start:start + args.cohort]:
+            if sub == ref:
+                _report(*_timed_align(ref_embedding, ref, sub_path, sub, args), failed, manifest)
+                continue
+            recorder = StageRecorder('{}_{}'.format(sub, args.hemi), args.profile, subject=sub, reference=ref, hemi=args.hemi)
+            recorder.start()
+            try:
+                group.append((sub, recorder, subject_embedding(sub_path, sub, args, device, recorder.stage)))
+            except Exception as e:
+                recorder.finish(log_path(args), e)
+                _report(sub, recorder.record['wall'], repr(e), failed)
+        if not group:
+            continue
+
+        print('Aligning {} subject spectral embeddings to {} reference in one batch'.format(len(group), ref))
+        try:
+            with contextlib.ExitStack() as stack:
+                stats = [stack.enter_context(recorder.stage('align')) for _, recorder, _ in group]
+                align_cohort(ref_embedding, [embedding for _, _, embedding in group], args.eig, matching_samples, args.sul,
+                             two_step=args.two_step, verbose=args.verbose, icp_engine=args.icp, sampling=args.sampling,
+                             seed=args.seed, hypotheses=args.hypotheses, batch_size=len(group), max_iterations=args.icp_iterations,
+                             relative_rmse_thr=args.icp_tol, time_budget=args.icp_budget)
+            for (_, _, embedding), s in zip(group, stats):
+                s.update(embedding.alignment_info)
+            nearest = [None] * len(group)
+            if args.transfer: # nearest reference vertices of the whole group in one multithreaded query
+                nearest = ref_embedding.correspondence.query_many([spectral_points(embedding, args.eig, int(args.sul))
+                                                                   for _, _, embedding in group],
+                                                                  args.transfer_k, torch.get_num_threads())
+        except Exception as e:
+            for sub, recorder, _ in group:
+                recorder.finish(log_path(args), e)
+                _report(sub, recorder.record['wall'], repr(e), failed)
+            continue
+
+        for (sub, recorder, embedding), neighbours in zip(group, nearest):
+            try:
+                save_aligned(ref_embedding, embedding, sub, args, recorder.stage, neighbours)
+                recorder.finish(log_path(args))
+                _report(sub, recorder.record['wall'], None, failed, manifest)
+            except Exception as e:
+                recorder.finish(log_path(args), e)
+                _report(sub, recorder.record['wall'], repr(e), failed)
+    return failed
+
+
+def align_atlas(ref_embeddings, refs, sub_path, subjects, args, manifest=None):
+    """
+    Aligns every subject to all the references of the atlas (see utils.atlas):
+    a subject is decomposed once, its eigen vector signs are matched to all
+    the references at once and its transforms are solved by one batched ICP,
+    then one output per reference is saved with a single copy of its mesh
+
+    returns the list of (subject, error) of the failed subjects
+    """
+    matching_samples, _ = matching_parameters(args)
+    device = ref_embeddings[0].device
+    poles = reference_poles(ref_embeddings, args.eig)
+    failed = []
+    for sub in subjects:
+        recorder = StageRecorder('{}_{}'.format(sub, args.hemi), args.profile, subject=sub, reference=refs, hemi=args.hemi)
+        try:
+            with recorder.run(log_path(args)):
+                embedding = subject_embedding(sub_path, sub, args, device, recorder.stage)
+                print('Aligning subject {} spectral embedding to {} references'.format(sub, len(refs)))
+                with recorder.stage('align') as stats:
+                    aligned = align_references(ref_embeddings, embedding, args.eig, matching_samples, args.sul, two_step=args.two_step,
+                                               verbose=args.verbose, icp_engine=args.icp, sampling=args.sampling, seed=args.seed,
+                                               poles=poles, max_iterations=args.icp_iterations, relative_rmse_thr=args.icp_tol,
+                                               time_budget=args.icp_budget)
+                    stats.update(references=len(refs), icp_iterations=aligned[0].alignment_info['icp_iterations'],
+                                 stop=aligned[0].alignment_info['stop'], rmse=[A.alignment_info['rmse'] for A in aligned])
+                extras = None
+                if args.transfer:
+                    with recorder.stage('transfer'):
+                        extras = [transferred(ref_embedding, A, '{} ({})'.format(sub, ref), args)
+                                  for ref_embedding, A, ref in zip(ref_embeddings, aligned, refs)]
+                with recorder.stage('save'):
+                    uni_spe = [torch.matmul(A.eig_vecs, torch.diag(A.eig_vals ** (-0.5))) for A in aligned]
+                    save_atlas(aligned, refs, args.out, sub, args.hemi, uni_spe, args.format, extras)
+        except Exception as e:
+            _report(sub, recorder.record['wall'], repr(e), failed)
+        else:
+            _report(sub, recorder.record['wall'], None, failed, manifest)
+        if args.mem_report:
+            print('\n'.join(recorder.summary()))
+    return failed
+
+
+def _report(sub, elapsed, error, failed, manifest=None):
+    if error is None:
+        print('{} aligned in {:.1f} s'.format(sub, elapsed))
+        if manifest is not None:
+            manifest.commit(sub)
+    else:
+        print('{} failed: {}'.format(sub, error))
+        failed.append((sub, error))
+
+
+def load_reference(args, cache=None, path=None):
+    """
+    Loads the reference of args (or the reference directory path) and computes
+    (or restores) its spectral embedding, with the correspondence index for
+    --transfer, recording the stages in the log
+    """
+    ref_path, ref = os.path.split(os.path.normpath(path or args.ref))
+    recorder = StageRecorder('{}_{}'.format(ref, args.hemi), args.profile, subject=ref, role='reference', hemi=args.hemi)
+    with recorder.run(log_path(args)):
+        embedding = reference_embedding(ref_path, ref, args.hemi, args.eig, 'cuda' if args.gpu else 'cpu', cache,
+                                        spectral_settings(args), args.verbose, args.mesh_cache,
+                                        getattr(torch, args.dtype), recorder.stage, spectrum_cache(args))
+        if args.transfer:
+            with recorder.stage('index'):
+                embedding.correspondence = correspondence_index(embedding, args, cache)
+    if args.mem_report:
+        print('\n'.join(recorder.summary()))
+    return embedding
+
+
+class ResidentReferences:
+    """
+    Reference embeddings kept in memory by the alignment service, keyed by
+    everything that changes them (surface, hemisphere, eigen vectors, solver
+    settings, dtype, device). Beyond `size` references, the least recently
+    used one is dropped.
+
+    A reference is loaded outside the lock of the table: the first job asking
+    for it loads it into a future that the jobs asking meanwhile wait on,
+    while the jobs of resident references go on.
+    """
+
+    def __init__(self, size=2):
+        self.size = max(1, size)
+        self.embeddings = OrderedDict() # key -> (future of the embedding, lock of its correspondence index)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(args):
+        settings = tuple(sorted(spectral_settings(args).items()))
+        return (os.path.abspath(os.path.normpath(args.ref)), args.hemi, args.eig, args.dtype, args.gpu, settings)
+
+    def get(self, args, cache=None):
+        """
+        Reference embedding of args, loaded (see load_reference) if it is not resident
+        """
+        key = self.key(args)
+        with self.lock:
+            entry = self.embeddings.get(key)
+            loading = entry is None
+            if loading:
+                entry = self.embeddings[key] = (Future(), threading.Lock())
+                while len(self.embeddings) > self.size:
+                    self.embeddings.popitem(last=False)
+            else:
+                self.embeddings.move_to_end(key)
+        future, index_lock = entry
+
+        if loading:
+            try:
+                future.set_result(load_reference(args, cache))
+            except BaseException as e:
+                with self.lock: # let the next job retry
+                    if self.embeddings.get(key) is entry:
+                        del self.embeddings[key]
+                future.set_exception(e)
+                raise
+        embedding = future.result()
+        if args.transfer:
+            with index_lock:
+                if getattr(embedding, 'correspondence', None) is None:
+                    embedding.correspondence = correspondence_index(embedding, args, cache)
+        return embedding
+
+
+def run(args, references=None):
+    """
+    Aligns the subject (-s) or the listed subjects (-l) of args to the reference
+
+    references : ResidentReferences of the alignment service, None to load the
+                 reference for this run only
+
+    returns the list of (subject, error) of the failed subjects
+    """
+    # set robust vs fast parameters
+    matching_samples, matching_mode = matching_parameters(args)
+    if matching_mode == 'complete':
+        print('Using robust alignment with all points')
+    else:
+        print('Using faster alignment with {}'.format(matching_samples))
+
+    if args.gpu:
+        print('Using GPU')
+    else:
+        print('Using CPU')
+
+    # set the reference(s), subject and output directories
+    if args.atlas is None:
+        atlas = [os.path.split(os.path.normpath(args.ref))]
+    else:
+        cwd = getattr(args, 'cwd', os.getcwd()) # client directory of a service job (see absolute_paths)
+        atlas = [os.path.split(os.path.normpath(os.path.join(cwd, path))) for path in read_file_list(args.atlas)]
+    ref_path, ref = atlas[0]
+
+    out_path = args.out
+    if not os.path.exists(out_path):
+        print('Creating output directory')
+    os.makedirs(os.path.join(out_path, 'spectral_data'), exist_ok=True)
+    os.makedirs(os.path.join(out_path, 'mesh_data'), exist_ok=True)
+
+    cache = reference_cache(args)
+
+    start = timeit.default_timer()
+
+    # only process the subjects whose outputs are missing or stale
+    manifest = Manifest(os.path.join(out_path, 'manifest.json'))
+    if args.list is None:
+        sub_path, sub = os.path.split(os.path.normpath(args.sub))
+        subjects = [sub]
+    else:
+        sub_path, subjects = args.data or ref_path, read_file_list(args.list)
+    subjects = plan_subjects(manifest, atlas, sub_path, subjects, args)
+    if not subjects:
+        print('All subjects up to date')
+        return []
+
+    if args.atlas is not None:
+        ref_embeddings = [load_reference(args, cache, os.path.join(path, id)) for path, id in atlas]
+        failed = align_atlas(ref_embeddings, [id for _, id in atlas], sub_path, subjects, args, manifest)
+        stop = timeit.default_timer()
+        print('Time taken: ',(stop-start),' s')
+        print("########################################################")
+        return failed
+
+    # Load reference mesh and  compute the spectral embedding
+    if references is None:
+        ref_spectral_embedding = load_reference(args, cache)
+    else:
+        ref_spectral_embedding = references.get(args, cache)
+
+    if args.list is None:
+        align_subject(ref_spectral_embedding, ref, sub_path, subjects[0], args)
+        manifest.commit(subjects[0])
+        failed = []
+    elif args.cohort:
+        failed = align_cohort_batch(ref_spectral_embedding, ref, sub_path, subjects, args, manifest)
+    elif args.stream:
+        failed = align_stream(ref_spectral_embedding, ref, sub_path, subjects, args, manifest)
+    else:
+        failed = align_batch(ref_spectral_embedding, ref, sub_path, subjects, args, manifest)
+
+    stop = timeit.default_timer()
+    print('Time taken: ',(stop-start),' s')
+
+    print("########################################################")
+    return failed
+
+
+def absolute_paths(args, cwd):
+    """
+    Resolves the paths of job arguments relative to the client directory, which
+    is kept as args.cwd for the paths listed in files (--atlas)
+    """
+    for name in ('ref', 'atlas', 'sub', 'list', 'data', 'out', 'log', 'profile', 'cache', 'mesh_cache', 'spectra'):
+        if getattr(args, name) is not None:
+            setattr(args, name, os.path.join(cwd, getattr(args, name)))
+    args.cwd = cwd
+
 
-stop = timeit.default_timer()
-print('Time taken: ',(stop-start),' s')
+def serve_alignments(args):
+    """
+    Resident alignment service (--serve): loads the reference of args once,
+    then aligns the jobs submitted on the Unix socket args.serve by
+    align_client.py. A job carries the spectral_align arguments of its client,
+    and its reference is reused while resident (see ResidentReferences), so
+    a job costs the subject eigensolve and ICP only. At most args.queue jobs
+    wait and args.concurrency run at once (see utils.service).
+    """
+    threads = args.threads or max(1, (os.cpu_count() or 1) // max(1, args.concurrency))
+    torch.set_num_threads(threads)
+    references = ResidentReferences(args.resident)
+    os.makedirs(args.out, exist_ok=True) # stage log of the reference
+    references.get(args, reference_cache(args))
 
-print("########################################################")
+    def handler(message):
+        try:
+            job = parse_args(message.get('argv', []), _JobParser)
+        except (ValueError, SystemExit) as e:
+            return {'status': 1, 'error': 'invalid arguments: {}'.format(e)}
+        if job.serve is not None:
+            return {'status': 1, 'error': 'invalid arguments: a job cannot --serve'}
+        absolute_paths(job, message.get('cwd', os.getcwd()))
+        job.threads = threads # thread budget of the service
+        failed = run(job, references)
+        return {'status': 1 if failed else 0, 'failed': failed}
 
+    service = AlignmentService(handler, args.queue, args.concurrency)
+    print('Serving alignments on {}: {} concurrent jobs of {} threads, {} queued at most'.format(
+        args.serve, args.concurrency, threads, args.queue))
+    serve(args.serve, service)
+    print('Alignment service stopped')
+    return 0
 
 
+def main(argv=None):
+    args = parse_args(argv)
+    if args.serve is not None:
+        return serve_alignments(args)
+    return 1 if run(args) else 0
 
 
+if __name__ == '__main__':
+    raise SystemExit(main())
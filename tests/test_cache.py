@@ -0,0 +1,134 @@
+import os
+import fcntl
+import threading
+import numpy as np
+import scipy.sparse as sp
+import torch
+from utils.cache import EmbeddingCache, SpectrumCache
+
+
+def state(n=100, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return {'eig_vals': torch.rand(5, generator=g, dtype=torch.float64),
+            'eig_vecs': torch.rand(n, 5, generator=g, dtype=torch.float64),
+            'X': torch.rand(n, 5, generator=g, dtype=torch.float64),
+            'edge_index': torch.randint(n, (2, 3 * n), generator=g),
+            'edge_attr': torch.rand(3 * n, generator=g, dtype=torch.float64)}
+
+
+def test_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    surface = tmp_path / 'lh.white'
+    surface.write_bytes(b'surface')
+    key = cache.key([str(surface)], eig=5, tol=1e-3)
+    assert key == cache.key([str(surface)], tol=1e-3, eig=5)
+    assert key != cache.key([str(surface)], eig=6, tol=1e-3)
+    # a missing optional input (e.g. no sulcal depth) is part of the key
+    missing = cache.key([str(surface), str(tmp_path / 'lh.sulc')], eig=5, tol=1e-3)
+    (tmp_path / 'lh.sulc').write_bytes(b'sulc')
+    assert missing not in (key, cache.key([str(surface), str(tmp_path / 'lh.sulc')], eig=5, tol=1e-3))
+    assert cache.load(key) is None
+
+    cache.store(key, state())
+    loaded = cache.load(key)
+    for name, value in state().items():
+        assert torch.equal(loaded[name], value)
+
+
+def test_corrupt_entry_is_a_miss(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.store('a', state())
+    with open(cache.path('a'), 'r+b') as f: # truncated
+        f.truncate(os.path.getsize(cache.path('a')) // 2)
+    assert cache.load('a') is None
+    with open(cache.path('a'), 'wb') as f: # not a torch file
+        f.write(b'\x80\x02corrupt')
+    assert cache.load('a') is None
+
+
+def test_eviction_counts_companions(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.store('a', state())
+    entry = os.path.getsize(cache.path('a'))
+    with open(cache.companion('a', 'index.pkl'), 'wb') as f:
+        f.write(bytes(4 * entry))
+    os.utime(cache.path('a'), (1, 1)) # least recently used
+
+    cache.max_bytes = 3 * entry # fits both entries, not the companion of a
+    cache.store('b', state(seed=1))
+    assert sorted(os.listdir(str(tmp_path))) == ['b.pt', 'locks']
+
+
+def test_eviction_removes_lock_files(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_bytes=0)
+    for key in ('a', 'b'):
+        with cache.lock(key):
+            cache.store(key, state())
+    with cache.lock('c'):
+        pass # a computation that stored nothing
+    cache.evict()
+    assert os.listdir(str(tmp_path / 'locks')) == ['evict.lock']
+
+
+def test_locked_entries_are_kept(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_bytes=0)
+    cache.store('a', state())
+    with cache.lock('a'):
+        cache.evict()
+        assert os.path.exists(cache.path('a'))
+        # a key being computed (locked, no entry yet) keeps its lock file
+        with cache.lock('b'):
+            cache.evict()
+            assert os.path.exists(cache.lock_path('b'))
+    cache.evict()
+    assert not os.path.exists(cache.path('a')) and not os.path.exists(cache.lock_path('a'))
+
+
+def test_laplacian_key(tmp_path):
+    cache = SpectrumCache(str(tmp_path))
+    rng = np.random.default_rng(0)
+    weights = sp.random(50, 50, density=0.1, random_state=0)
+    weights = weights + weights.T
+    degree = sp.diags(np.asarray(weights.sum(1)).ravel())
+    laplace = degree - weights
+    key = cache.laplacian_key(laplace, degree, tol=1e-3)
+    # the same matrix in another sparse format or index order has the same key
+    shuffled = laplace.tocoo()
+    order = rng.permutation(shuffled.nnz)
+    shuffled = sp.coo_matrix((shuffled.data[order], (shuffled.row[order], shuffled.col[order])), shape=laplace.shape)
+    assert cache.laplacian_key(shuffled, degree, tol=1e-3) == key
+    assert cache.laplacian_key(laplace, degree, tol=1e-4) != key
+    assert cache.laplacian_key(laplace * 2, degree * 2, tol=1e-3) != key
+
+
+def test_spectrum_round_trip(tmp_path):
+    cache = SpectrumCache(str(tmp_path))
+    cache.store('a', state()) # only the eigen pairs are kept
+    loaded = cache.load('a')
+    assert sorted(loaded) == ['eig_vals', 'eig_vecs']
+    assert torch.equal(loaded['eig_vecs'], state()['eig_vecs'])
+
+
+def test_lock_removed_while_waiting(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    held, done = threading.Event(), threading.Event()
+
+    def waiter():
+        with cache.lock('a'):
+            # the lock is on the file now at the lock path, not on the removed one
+            with open(cache.lock_path('a')) as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    held.set() # not exclusive
+                except BlockingIOError:
+                    pass
+            done.set()
+
+    with open(cache.lock_path('a'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        thread.join(0.2) # waiting on the lock
+        os.remove(cache.lock_path('a')) # as evict does
+    thread.join()
+    assert done.is_set() and not held.is_set()
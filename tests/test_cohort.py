@@ -0,0 +1,88 @@
+import pytest
+import torch
+from benchmarks.synthetic import synthetic_surface, write_subject
+from utils.load_mesh import LoadMesh
+from utils.embedding import Embedding, sample_count
+from utils.flip_eigen import flip_eigen_sign
+from utils.cohort import align_cohort, build_template
+from utils.atlas import align_references
+
+KROT = 3
+SCHEDULE = [200, 800]
+SETTINGS = dict(sulc=True, icp_engine='kdtree', sampling='area', seed=0)
+
+
+@pytest.fixture(scope='module')
+def decomposed(tmp_path_factory):
+    # two surfaces above the largest stage, one below it (fewer sampled vertices);
+    # decomposed once, so that every alignment starts from the same eigen vectors
+    root = str(tmp_path_factory.mktemp('cohort'))
+    meshes = {}
+    for name, vertices, seed in [('ref', 1002, 0), ('big', 1002, 1), ('small', 642, 2), ('other', 642, 3)]:
+        write_subject(root, name, synthetic_surface(vertices, seed=seed))
+        mesh = LoadMesh()
+        mesh.load_mesh(root, name, 'lh', 'cpu', dtype=torch.float64)
+        E = Embedding(mesh)
+        E.spectral(KROT + 1, tol=1e-8)
+        meshes[name] = (mesh, E.state_dict())
+    return meshes
+
+
+def embedding(decomposed, name):
+    mesh, state = decomposed[name]
+    E = Embedding(mesh)
+    E.load_state_dict({key: value.clone() for key, value in state.items()})
+    return E
+
+
+def aligned_alone(decomposed, name, ref, settings=SETTINGS):
+    M = embedding(decomposed, name)
+    M.align(ref, KROT, SCHEDULE, two_step=False, matching_mode='partial', verbose=False, **settings)
+    return M
+
+
+def test_sample_count(decomposed):
+    ref, big, small = (embedding(decomposed, name) for name in ('ref', 'big', 'small'))
+    assert sample_count(SCHEDULE, ref, big) == 800
+    assert sample_count(SCHEDULE, ref, small) == 642
+    assert sample_count([5000], ref) == 1002
+
+
+@pytest.mark.parametrize('engine', ['kdtree', 'pytorch3d'])
+def test_cohort_matches_per_subject(decomposed, engine):
+    if engine == 'pytorch3d':
+        pytest.importorskip('pytorch3d')
+    settings = dict(SETTINGS, icp_engine=engine)
+    ref = embedding(decomposed, 'ref')
+    cohort = [embedding(decomposed, 'big'), embedding(decomposed, 'small')]
+    align_cohort(ref, cohort, KROT, SCHEDULE, batch_size=4, **settings)
+    for M, name in zip(cohort, ('big', 'small')):
+        alone = aligned_alone(decomposed, name, ref, settings)
+        torch.testing.assert_close(M.X[:, 0:KROT], alone.X[:, 0:KROT])
+        assert M.alignment_info['icp_iterations'] == alone.alignment_info['icp_iterations']
+
+
+def test_references_match_per_reference(decomposed):
+    refs = [embedding(decomposed, 'ref'), embedding(decomposed, 'small')]
+    aligned = align_references(refs, embedding(decomposed, 'big'), KROT, SCHEDULE, **SETTINGS)
+    for A, ref in zip(aligned, refs):
+        alone = aligned_alone(decomposed, 'big', ref)
+        torch.testing.assert_close(A.X[:, 0:KROT], alone.X[:, 0:KROT])
+        assert A.alignment_info['icp_iterations'] == alone.alignment_info['icp_iterations']
+
+
+def test_template_converges_and_ignores_subject_order(decomposed):
+    ref = embedding(decomposed, 'ref')
+    cohort = [embedding(decomposed, name) for name in ('big', 'small', 'other')]
+    for M in cohort:
+        flip_eigen_sign(ref, M, KROT, False)
+    settings = dict(samples=500, icp_engine='kdtree', sampling='area')
+    templates = [build_template(ref, cohort, KROT, iterations=iterations, **settings)[0] for iterations in range(1, 8)]
+    assert templates[-1].shape == (500, KROT + 1)
+    shift = [float(((b - a) ** 2).sum(1).mean().sqrt()) for a, b in zip(templates, templates[1:])]
+    assert shift[-1] < 0.5 * shift[0] # the template moves less and less
+
+    template, best = build_template(ref, cohort[::-1], KROT, iterations=7, **settings)
+    torch.testing.assert_close(template, templates[-1])
+    _, forward = build_template(ref, cohort, KROT, iterations=7, **settings)
+    torch.testing.assert_close(best.RTs.R.flip(0), forward.RTs.R)
@@ -0,0 +1,57 @@
+import numpy as np
+from benchmarks.synthetic import synthetic_surface, write_subject
+from utils.load_mesh import LoadMesh
+from utils.correspondence import CorrespondenceIndex, vote_labels, match_labels, transfer_accuracy
+
+
+def test_vote_labels():
+    labels = np.array([0, 1, 1, 2])
+    idx = np.array([[0, 1, 2], [3, 0, 3], [1, 2, 0]])
+    assert vote_labels(labels, idx).tolist() == [1, 2, 1]
+    assert vote_labels(labels, idx[:, :1]).tolist() == [0, 2, 1]
+    # inverse distance weights: the nearest vertex outweighs two far ones
+    dist = np.array([[0.1, 1.0, 1.0], [1.0, 0.1, 1.0], [1.0, 1.0, 0.1]])
+    assert vote_labels(labels, idx, dist).tolist() == [0, 0, 0]
+
+
+def test_match_labels():
+    # reference labels ids 10, 20, 30, the subject lacks 20 and has 40
+    labels, ids = match_labels(np.array([0, 1, 2, 2]), np.array([10, 20, 30]), np.array([10, 30, 40]))
+    assert labels.tolist() == [0, 3, 1, 1]
+    assert ids.tolist() == [10, 30, 40, 20]
+
+
+def test_transfer_to_a_subject_missing_a_label(tmp_path):
+    surface = synthetic_surface(642)
+    write_subject(str(tmp_path), 'ref', surface)
+    partial = dict(surface, labels=np.where(surface['labels'] == 1, 2, surface['labels']).astype(np.int32))
+    write_subject(str(tmp_path), 'sub', partial)
+    ref, sub = LoadMesh(), LoadMesh()
+    ref.load_mesh(str(tmp_path), 'ref', 'lh', 'cpu')
+    sub.load_mesh(str(tmp_path), 'sub', 'lh', 'cpu')
+    assert len(ref.P_ids) == len(sub.P_ids) + 1
+
+    # identical surfaces: every subject vertex is its own reference correspondent
+    coords = surface['coords']
+    dist, idx = CorrespondenceIndex(coords).query(coords, k=1)
+    truth = np.where(surface['labels'] == 1, -1, sub.P.numpy().astype(np.int64))
+    labels, _ = match_labels(ref.P, ref.P_ids, sub.P_ids)
+    predicted = vote_labels(labels, idx, dist)
+    keep = truth >= 0 # vertices whose label the subject has
+    assert (predicted[keep] == truth[keep]).all()
+    assert (predicted[~keep] >= len(sub.P_ids)).all()
+
+    # without matching, every label after the missing one is shifted
+    raw = vote_labels(ref.P, idx, dist)
+    assert transfer_accuracy(raw, sub.P)['accuracy'] < 0.5
+    assert transfer_accuracy(predicted, sub.P)['accuracy'] == keep.mean()
+
+
+def test_query_many_matches_query():
+    rng = np.random.default_rng(0)
+    index = CorrespondenceIndex(rng.standard_normal((500, 4)))
+    batch = [rng.standard_normal((n, 4)) for n in (120, 1, 300)]
+    for (dist, idx), points in zip(index.query_many(batch, k=3, chunk_size=64), batch):
+        expected = index.query(points, k=3)
+        np.testing.assert_array_equal(idx, expected[1])
+        np.testing.assert_array_equal(dist, expected[0])
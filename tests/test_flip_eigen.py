@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+import torch
+from utils.flip_eigen import flip_eigen_sign, flip_signs, reference_poles
+
+
+def embedding(n=500, ne=6, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    X = torch.randn(n, ne, generator=g, dtype=torch.float64)
+    return SimpleNamespace(coords=torch.randn(n, 3, generator=g, dtype=torch.float64), X=X, eig_vecs=X.clone())
+
+
+def loop_signs(M1, M2, ne):
+    # the original per eigen vector loop of flip_eigen_sign
+    X1 = M1.coords[:, 0:3] - M1.coords[:, 0:3].mean(0)
+    X2 = M2.coords[:, 0:3] - M2.coords[:, 0:3].mean(0)
+    signs = []
+    for i in range(ne):
+        poles = []
+        for X, x in ((X1, M1.X[:, i]), (X2, M2.X[:, i])):
+            w = torch.sign(x) * abs(x ** 3)
+            wp, wm = w.clamp(min=0), w.clamp(max=0)
+            poles.append(((X * (wp / wp.sum()).unsqueeze(-1)).sum(0), (X * (wm / wm.sum()).unsqueeze(-1)).sum(0)))
+        (p1, m1), (p2, m2) = poles
+        distp = (p1 - p2).pow(2).sum() + (m1 - m2).pow(2).sum()
+        distm = (p1 - m2).pow(2).sum() + (m1 - m2).pow(2).sum()
+        signs.append(-1.0 if distm < distp else 1.0)
+    return torch.tensor(signs, dtype=torch.float64)
+
+
+def test_matches_the_loop():
+    M1 = embedding()
+    for seed in range(1, 6):
+        M2 = embedding(seed=seed)
+        signs = loop_signs(M1, M2, 6)
+        X = M2.X.clone()
+        flip_eigen_sign(M1, M2, 6, False)
+        assert torch.equal(M2.X, X * signs)
+        assert torch.equal(M2.eig_vecs, X * signs)
+
+
+def test_flip_signs_matches_flip_eigen_sign():
+    refs = [embedding(seed=seed) for seed in range(3)]
+    M2 = embedding(seed=10)
+    signs = flip_signs(reference_poles(refs, 6), M2, 6)
+    for ref, s in zip(refs, signs):
+        assert torch.equal(s, loop_signs(ref, M2, 6))
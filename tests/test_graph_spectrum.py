@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic import synthetic_surface
+from utils.weight_adjaceny import weight_adjacency_csr
+from utils.graph_spectrum import eigen_values_spectrum, residuals
+from utils.multilevel import hierarchy
+
+NE = 5
+TOL = 1e-3
+
+
+@pytest.fixture(scope='module')
+def problem():
+    surface = synthetic_surface(2562)
+    weights, degree = weight_adjacency_csr(surface['coords'], surface['faces'])
+    return (degree - weights).tocsr(), degree
+
+
+@pytest.fixture(scope='module')
+def reference(problem):
+    laplace, degree = problem
+    eig_vals, eig_vecs, _ = eigen_values_spectrum(laplace, degree, 2 * NE, solver='eigsh', tol=1e-10)
+    return eig_vals.numpy(), eig_vecs.numpy()
+
+
+def assert_agree(eig_vals, eig_vecs, reference):
+    ref_vals, ref_vecs = reference
+    k = eig_vals.shape[0]
+    # eigs starts ARPACK from a random vector and stops at tol, so allow a margin over it
+    np.testing.assert_allclose(eig_vals, ref_vals[:k], rtol=10 * TOL)
+    assert np.abs((eig_vecs * ref_vecs[:, :k]).sum(0)).min() > 0.99
+
+
+@pytest.mark.parametrize('solver, precond', [('eigs', 'amg'), ('eigsh', 'amg'), ('lobpcg', 'amg'), ('lobpcg', 'lu'),
+                                             ('lobpcg', 'ilu'), ('multilevel', 'amg'), ('multilevel', 'lu')])
+def test_solvers_agree(problem, reference, solver, precond):
+    laplace, degree = problem
+    options = {'levels': 2} if solver == 'multilevel' else {}
+    eig_vals, eig_vecs, info = eigen_values_spectrum(laplace, degree, NE, solver=solver, tol=TOL, precond=precond, **options)
+    assert_agree(eig_vals.numpy(), eig_vecs.numpy(), reference)
+    if solver in ('lobpcg', 'multilevel'):
+        assert 'fallback' not in info
+        # --tol is relative to the eigen values, not scipy's absolute bound
+        assert info['residuals'].max() <= TOL * eig_vals.max().item()
+
+
+def test_hierarchy_coarsens(problem):
+    laplace, degree = problem
+    problems, prolongations = hierarchy(laplace, degree, 4, min_size=20)
+    sizes = [L.shape[0] for L, _ in problems]
+    assert len(sizes) >= 3
+    assert all(fine >= 3 * coarse for fine, coarse in zip(sizes, sizes[1:]))
+    for P in prolongations:
+        assert (np.asarray(P.sum(1)).ravel() == 1).all()
+
+
+def test_known_pairs_are_sliced_or_extended(problem, reference):
+    laplace, degree = problem
+    known = tuple(x[:, :3] if x.ndim == 2 else x[:3] for x in reference)
+    eig_vals, eig_vecs, info = eigen_values_spectrum(laplace, degree, 2, tol=TOL, known=known)
+    assert info['solver'] == 'cached' and info['iterations'] == 0
+    assert_agree(eig_vals.numpy(), eig_vecs.numpy(), reference)
+
+    eig_vals, eig_vecs, info = eigen_values_spectrum(laplace, degree, 2 * NE, tol=TOL, known=known)
+    assert info['solver'] == 'extend' and info['reused'] == 3
+    assert_agree(eig_vals.numpy(), eig_vecs.numpy(), reference)
+    new = residuals(laplace, degree, eig_vals.numpy()[3:], eig_vecs.numpy()[:, 3:])
+    assert new.max() <= TOL * eig_vals.max().item()
@@ -0,0 +1,97 @@
+import warnings
+import functools
+import numpy as np
+import torch
+from scipy.spatial.transform import Rotation
+from utils.icp import kdtree_icp, ICPController
+
+
+def umeyama(X, Y):
+    # rigid least squares transform X @ R + T ~ Y
+    mx, my = X.mean(0), Y.mean(0)
+    U, _, Vt = np.linalg.svd((X - mx).T @ (Y - my))
+    E = np.diag([1, 1, np.sign(np.linalg.det(U @ Vt))])
+    R = U @ E @ Vt
+    return R, my - mx @ R
+
+
+def brute_force_icp(X, Y, iterations):
+    # nearest neighbours from the full distance matrix
+    R, T = np.eye(3), np.zeros(3)
+    for _ in range(iterations):
+        Xt = X @ R + T
+        idx = ((Xt[:, None] - Y[None]) ** 2).sum(2).argmin(1)
+        R, T = umeyama(X, Y[idx])
+    return R, T, X @ R + T
+
+
+def point_clouds(batch=2, n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((batch, n, 3)) * np.array([3.0, 2.0, 1.0])
+    Y, R = [], []
+    for b in range(batch):
+        R.append(Rotation.from_rotvec(rng.standard_normal(3) * 0.15).as_matrix())
+        Y.append(rng.permutation(X[b] @ R[b] + rng.standard_normal(3)))
+    return X, np.stack(Y), np.stack(R)
+
+
+def test_matches_brute_force():
+    X, Y, _ = point_clouds()
+    solution = kdtree_icp(torch.from_numpy(X), torch.from_numpy(Y), max_iterations=15, relative_rmse_thr=-1)
+    for b in range(X.shape[0]):
+        R, T, Xt = brute_force_icp(X[b], Y[b], 15)
+        np.testing.assert_allclose(solution.RTs.R[b].numpy(), R, atol=1e-10)
+        np.testing.assert_allclose(solution.RTs.T[b].numpy(), T, atol=1e-10)
+        np.testing.assert_allclose(solution.Xt[b].numpy(), Xt, atol=1e-10)
+
+
+def test_recovers_rigid_transform():
+    X, Y, R = point_clouds(seed=1)
+    solution = kdtree_icp(torch.from_numpy(X), torch.from_numpy(Y))
+    assert solution.converged
+    np.testing.assert_allclose(solution.RTs.R.numpy(), R, atol=1e-8)
+    assert solution.rmse.max() < 1e-8
+
+
+def test_controller_traces_every_iteration():
+    X, Y, _ = point_clouds(seed=2)
+    X, Y = torch.from_numpy(X), torch.from_numpy(Y)
+    alone = kdtree_icp(X, Y, max_iterations=15, relative_rmse_thr=-1)
+    controller = ICPController(kdtree_icp, max_iterations=15, relative_rmse_thr=-1)
+    solution = controller(X, Y, stage='test')
+    assert controller.stop == 'iterations' and controller.iterations == 15
+    assert [entry['iteration'] for entry in controller.trace] == list(range(1, 16))
+    torch.testing.assert_close(solution.RTs.R, alone.RTs.R)
+    assert controller.trace[-1]['rmse'] == solution.rmse.tolist()
+
+
+def test_controller_time_budget():
+    X, Y, _ = point_clouds(seed=3)
+    controller = ICPController(kdtree_icp, max_iterations=50, relative_rmse_thr=-1, time_budget=0)
+    solution = controller(torch.from_numpy(X), torch.from_numpy(Y))
+    assert controller.stop == 'time' and len(solution.t_history) == 1 and not solution.converged
+
+
+def test_controller_calls_other_engines_per_iteration():
+    # an engine other than kdtree_icp itself is called one iteration at a time
+    X, Y, _ = point_clouds(seed=2)
+    X, Y = torch.from_numpy(X), torch.from_numpy(Y)
+    engine = functools.partial(kdtree_icp)
+    controller = ICPController(engine, max_iterations=15, relative_rmse_thr=-1)
+    controller(X, Y)
+    assert [entry['iteration'] for entry in controller.trace] == list(range(1, 16))
+    controller = ICPController(engine, max_iterations=15, relative_rmse_thr=-1, time_budget=0)
+    assert len(controller(X, Y).t_history) == 1 and controller.stop == 'time'
+    controller = ICPController(engine, max_iterations=15, relative_rmse_thr=-1, chunk=5)
+    controller(X, Y)
+    assert [entry['iteration'] for entry in controller.trace] == [5, 10, 15]
+
+
+def test_identical_point_sets_converge():
+    # a grid matched to itself: the RMSE is exactly 0 from the first iteration
+    X = np.stack(np.meshgrid(np.arange(4.0), np.arange(3.0), np.arange(2.0)), -1).reshape(1, -1, 3)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        solution = kdtree_icp(torch.from_numpy(X), torch.from_numpy(X.copy()), max_iterations=20)
+    assert solution.converged and len(solution.t_history) == 2
+    assert solution.rmse.max() == 0
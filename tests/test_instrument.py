@@ -0,0 +1,41 @@
+import threading
+from utils import instrument
+from utils.instrument import StageRecorder
+
+
+def test_nested_stages_reset_the_peak(monkeypatch):
+    resets = []
+    monkeypatch.setattr(instrument, 'reset_peak_rss', lambda: resets.append(1))
+    recorder = StageRecorder('a')
+    with recorder.stage('align'):
+        with recorder.stage('icp'):
+            pass
+    assert len(resets) == 2
+    assert not any('peak_rss_shared' in s for s in recorder.record['stages'].values())
+    assert recorder.record['stages']['align']['peak_rss_mb'] >= recorder.record['stages']['icp']['peak_rss_mb']
+
+
+def test_concurrent_stages_share_the_peak(monkeypatch):
+    resets = []
+    monkeypatch.setattr(instrument, 'reset_peak_rss', lambda: resets.append(1))
+    a, b = StageRecorder('a'), StageRecorder('b')
+    entered, release = threading.Event(), threading.Event()
+
+    def run():
+        with b.stage('spectral'):
+            entered.set()
+            release.wait()
+
+    with a.stage('spectral'):
+        thread = threading.Thread(target=run)
+        thread.start()
+        entered.wait()
+        release.set()
+        thread.join()
+    assert len(resets) == 1 # only the first stage, the second one would wipe its peak
+    assert a.record['stages']['spectral']['peak_rss_shared']
+    assert b.record['stages']['spectral']['peak_rss_shared']
+
+    with a.stage('save'):
+        pass
+    assert len(resets) == 2 and 'peak_rss_shared' not in a.record['stages']['save']
@@ -0,0 +1,45 @@
+import os
+from utils.manifest import Manifest
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def test_up_to_date_until_something_changes(tmp_path):
+    root = str(tmp_path)
+    files = {'surf': os.path.join(root, 'lh.white'), 'sulc': os.path.join(root, 'lh.sulc')}
+    for path in files.values():
+        write(path, os.path.basename(path))
+    manifest = Manifest(os.path.join(root, 'manifest.json'))
+    reference = manifest.reference('ref', {'surf': files['surf']})
+    entry = manifest.entry(files, reference, {'eig': 5}, ['sub_lh.pt'])
+    assert manifest.stale('sub_lh', entry) == 'not in the manifest'
+
+    manifest.plan('sub', 'sub_lh', entry)
+    manifest.commit('sub')
+    assert manifest.stale('sub_lh', entry).startswith('output missing')
+    write(os.path.join(root, 'sub_lh.pt'), '')
+
+    # a new manifest object reads the committed entries
+    manifest = Manifest(os.path.join(root, 'manifest.json'))
+    assert manifest.stale('sub_lh', manifest.entry(files, reference, {'eig': 5}, ['sub_lh.pt'])) is None
+    assert manifest.stale('sub_lh', manifest.entry(files, reference, {'eig': 6}, ['sub_lh.pt'])) == 'parameters changed (eig)'
+    other = manifest.reference('other', {'surf': files['surf']})
+    assert manifest.stale('sub_lh', manifest.entry(files, other, {'eig': 5}, ['sub_lh.pt'])) == 'reference changed'
+    write(files['sulc'], 'changed')
+    assert manifest.stale('sub_lh', manifest.entry(files, reference, {'eig': 5}, ['sub_lh.pt'])) == 'inputs changed (sulc)'
+
+
+def test_digests_are_memoized(tmp_path):
+    path = os.path.join(str(tmp_path), 'lh.white')
+    write(path, 'surface')
+    manifest = Manifest(os.path.join(str(tmp_path), 'manifest.json'))
+    digest = manifest.digest(path)
+    # same mtime and size: the memoized hash is returned without reading the file
+    manifest.digests[path][2] = 'memo'
+    assert manifest.digest(path) == 'memo'
+    os.utime(path, ns=(0, 0))
+    assert manifest.digest(path) == digest
+    assert manifest.digest(path + '.missing') is None
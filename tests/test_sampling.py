@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import torch
+from scipy.spatial import cKDTree
+from benchmarks.synthetic import synthetic_surface
+from utils.sampling import SAMPLERS, sample_order
+
+
+@pytest.fixture(scope='module')
+def surface():
+    surface = synthetic_surface(2562)
+    return torch.from_numpy(surface['coords']), torch.from_numpy(surface['faces']), torch.from_numpy(surface['curv'])
+
+
+@pytest.mark.parametrize('method', sorted(SAMPLERS))
+def test_orders_are_seeded_samples(surface, method):
+    order = sample_order(*surface, 500, method, seed=3)
+    assert order.dtype == torch.long and order.shape == (500,)
+    assert len(torch.unique(order)) == 500
+    assert 0 <= order.min() and order.max() < surface[0].shape[0]
+    assert torch.equal(order, sample_order(*surface, 500, method, seed=3))
+    assert not torch.equal(order, sample_order(*surface, 500, method, seed=4))
+
+
+def test_order_is_capped_by_the_mesh(surface):
+    n = surface[0].shape[0]
+    for method in SAMPLERS:
+        assert torch.equal(torch.sort(sample_order(*surface, 2 * n, method)).values, torch.arange(n))
+
+
+def coverage(coords, order):
+    # farthest vertex from the sample
+    return cKDTree(coords[order]).query(coords)[0].max()
+
+
+def test_fps_covers_better_than_random(surface):
+    coords = surface[0].numpy()
+    fps = np.mean([coverage(coords, sample_order(*surface, 200, 'fps', seed)) for seed in range(3)])
+    random = np.mean([coverage(coords, sample_order(*surface, 200, 'random', seed)) for seed in range(3)])
+    assert fps < 0.85 * random
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import torch
+from utils.store import SpectralStore
+
+
+def mesh_data(seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return {'faces': torch.randint(100, (50, 3), generator=g, dtype=torch.int32),
+            'coords': torch.rand(100, 3, generator=g), 'name': 'lh'}
+
+
+def spec_data(seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return {'eig_vec': torch.rand(100, 5, generator=g, dtype=torch.float64), 'eig_val': torch.rand(5, generator=g)}
+
+
+def test_round_trip(tmp_path):
+    store = SpectralStore(str(tmp_path))
+    store.save('S1_lh', spec_data(), mesh_data())
+    record = store.load('S1_lh')
+    assert sorted(record) == ['coords', 'eig_val', 'eig_vec', 'faces'] # tensors only
+    for name, value in {**mesh_data(), **spec_data()}.items():
+        if torch.is_tensor(value):
+            assert record[name].dtype == value.dtype
+            assert torch.equal(record[name], value)
+
+
+def test_fields_are_memory_mapped_copy_on_write(tmp_path):
+    store = SpectralStore(str(tmp_path))
+    store.save('S1_lh', spec_data(), mesh_data())
+    record = store.load('S1_lh')
+    assert 'eig_vec' not in record.loaded # mapped on first access
+    record['eig_vec'][:] = 0
+    assert torch.equal(store.load('S1_lh')['eig_vec'], spec_data()['eig_vec'])
+
+
+def test_mesh_is_shared_and_runs_are_replaced(tmp_path):
+    store = SpectralStore(str(tmp_path))
+    store.save('S1_lh', spec_data(), mesh_data())
+    store.save('S1_to_R_lh', spec_data(1), mesh_data())
+    store.save('S2_lh', spec_data(), mesh_data(2))
+    assert len(os.listdir(os.path.join(str(tmp_path), 'mesh'))) == 2
+    assert store.names() == ['S1_lh', 'S1_to_R_lh', 'S2_lh']
+
+    store.save('S1_lh', spec_data(3), mesh_data())
+    assert torch.equal(store.load('S1_lh')['eig_vec'], spec_data(3)['eig_vec'])
+    assert store.names() == ['S1_lh', 'S1_to_R_lh', 'S2_lh']
+    assert not [n for n in os.listdir(os.path.join(str(tmp_path), 'spectral')) if n.startswith('.')]
+    assert isinstance(np.load(os.path.join(str(tmp_path), 'spectral', 'S1_lh', 'eig_vec.npy'), mmap_mode='r'), np.memmap)
@@ -0,0 +1,33 @@
+import numpy as np
+import torch
+from benchmarks.synthetic import synthetic_surface
+from utils.weight_adjaceny import weight_adjacency_csr, weight_adjacency_matrix
+
+
+def torch_unique_weights(coords, faces):
+    # former assembly: 6F directed edges deduplicated by a row-wise torch.unique
+    faces = faces.long()
+    rows = torch.cat((faces[:, 0], faces[:, 0], faces[:, 1], faces[:, 1], faces[:, 2], faces[:, 2]))
+    cols = torch.cat((faces[:, 1], faces[:, 2], faces[:, 0], faces[:, 2], faces[:, 0], faces[:, 1]))
+    weights = 1 / (coords[rows] - coords[cols]).pow(2).sum(1).sqrt()
+    unique, inverse = torch.unique(torch.stack((rows, cols), 1), sorted=True, return_inverse=True, dim=0)
+    perm = torch.arange(inverse.size(0))
+    index = inverse.new_empty(unique.size(0)).scatter_(0, inverse.flip([0]), perm.flip([0]))
+    return unique.t(), weights[index]
+
+
+def test_csr_matches_torch_unique():
+    surface = synthetic_surface(642)
+    coords, faces = torch.from_numpy(surface['coords']), torch.from_numpy(surface['faces'])
+    edge_index, edge_attr = weight_adjacency_matrix(coords, faces)
+    ref_index, ref_attr = torch_unique_weights(coords, faces)
+    assert torch.equal(edge_index, ref_index)
+    # equal to rounding, not bitwise (squared lengths summed from either end)
+    np.testing.assert_allclose(edge_attr.numpy(), ref_attr.numpy(), rtol=1e-14, atol=0)
+
+
+def test_degree_is_row_sum():
+    surface = synthetic_surface(642)
+    weights, degree = weight_adjacency_csr(surface['coords'], surface['faces'])
+    assert (weights != weights.T).nnz == 0
+    np.testing.assert_allclose(degree.diagonal(), np.asarray(weights.sum(1)).ravel(), rtol=1e-12)
@@ -0,0 +1,73 @@
+import torch
+from utils.embedding import Embedding, ICP_ENGINES, matching_points, transform_embedding, sample_count
+from utils.flip_eigen import reference_poles, flip_signs
+from utils.cohort import batched_icp, item
+from utils.icp import ICPController
+
+
+def signed_copy(M, signs):
+        """
+        Embedding sharing the mesh and graph of M, with its first eigen vectors
+        multiplied by signs (a copy of the eigen vectors and X)
+        """
+        A = Embedding(M)
+        A.edge_index, A.edge_attr = M.edge_index, M.edge_attr
+        A.eig_vals = M.eig_vals
+        full = torch.ones(M.X.shape[1], dtype=M.X.dtype, device=M.X.device)
+        full[0:signs.shape[0]] = signs
+        A.eig_vecs = M.eig_vecs * full.to(M.eig_vecs.dtype)
+        A.X = M.X * full
+        return A
+
+
+def align_references(refs, M, krot, matching_samples, sulc, two_step=False, verbose=False, icp_engine='pytorch3d',
+                     sampling='random', seed=0, poles=None, max_iterations=100, relative_rmse_thr=1e-6, time_budget=None):
+        """
+        Aligns one subject embedding to many references (multi-atlas alignment)
+
+        The subject is decomposed once: its eigen vector signs are matched to
+        all the references at once (see flip_eigen.flip_signs), its sample is
+        repeated with the signs of each reference and matched to the samples
+        of all the references by one batched ICP per stage (partial matching on
+        the samples and schedule of Embedding.align, the references sampling
+        the same number of vertices batched together). The cost per reference
+        is a flip and an ICP item, not an eigen decomposition.
+
+        refs             : reference embeddings (spectral computed)
+        M                : subject embedding (spectral computed), not modified
+        poles            : pole barycenters of the references (see flip_eigen.reference_poles),
+                           computed if None, pass them when aligning many subjects
+        others           : see Embedding.align
+
+        returns: one aligned embedding per reference, sharing the mesh and graph of M,
+                 each with its alignment_info
+        """
+        icp = ICP_ENGINES[icp_engine]
+        w_sulcal = 1 if sulc else 0
+        c = 1 if w_sulcal else 0
+        schedule = matching_samples if isinstance(matching_samples, (list, tuple)) else [matching_samples]
+        signs = flip_signs(poles if poles is not None else reference_poles(refs, krot), M, krot) # R x krot
+        if verbose:
+            for r, s in enumerate(signs):
+                print('Reference {}: flip {}'.format(r, torch.nonzero(s < 0).flatten().tolist()))
+
+        # references smaller than the largest stage sample fewer vertices (and so does the subject)
+        counts = [sample_count(schedule, ref, M) for ref in refs]
+        aligned = [None] * len(refs)
+        for n in sorted(set(counts), reverse=True):
+            group = [r for r, count in enumerate(counts) if count == n]
+            E2 = matching_points(M, krot, w_sulcal, M.sample_order(n, sampling, seed + 1)).repeat(len(group), 1, 1)
+            E2[:, :, c:] *= signs[group, None, :].to(E2)
+            E1 = torch.cat([matching_points(refs[r], krot, w_sulcal, refs[r].sample_order(n, sampling, seed)) for r in group])
+            controller = ICPController(icp, max_iterations, relative_rmse_thr, time_budget)
+            best, iterations = batched_icp(E2, E1, controller, schedule, c, two_step, verbose)
+            del(E1); del(E2)
+
+            for b, r in enumerate(group):
+                A = signed_copy(M, signs[r])
+                transform_embedding(A, item(best.RTs, b), krot, w_sulcal)
+                A.alignment_info = {'icp_iterations': iterations, 'rmse': float(best.rmse[b]),
+                                    'converged': bool(best.converged), 'stop': controller.stop,
+                                    'trace': controller.item_trace(b), 'flips': int((signs[r] < 0).sum())}
+                aligned[r] = A
+        return aligned
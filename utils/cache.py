@@ -0,0 +1,218 @@
+import os
+import fcntl
+import hashlib
+import tempfile
+import contextlib
+import numpy as np
+import torch
+
+
+def file_digest(path, chunk_size=1 << 20):
+        """
+        Content hash (sha1) of a file, read in chunks
+
+        path       : file to hash
+        chunk_size : bytes read per chunk
+
+        returns: hex digest string
+        """
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk, content-addressed cache of spectral embedding states
+
+    Entries are keyed by the hash of the input files plus the spectral settings
+    (number of eigenvectors, solver parameters). Writes are atomic (temporary
+    file + rename) and a per-key lock makes concurrent jobs sharing the cache
+    wait for a single computation instead of repeating it. The least recently
+    used entries are evicted once the cache grows beyond max_bytes.
+    """
+
+    FIELDS = ('eig_vals', 'eig_vecs', 'X', 'edge_index', 'edge_attr')
+
+    def __init__(self, root, max_bytes=1 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(self.root, 'locks'), exist_ok=True)
+
+    def key(self, paths, **settings):
+        """
+        Cache key from the contents of the input files and the settings
+
+        paths    : input files (surface, sulcal depth, ...), a missing one
+                   (optional input, as LoadMesh tolerates) hashed as missing
+        settings : parameters that change the result (eig, tol, ...)
+        """
+        h = hashlib.sha1()
+        for path in paths:
+            try:
+                h.update(file_digest(path).encode())
+            except FileNotFoundError:
+                h.update(b'missing')
+        for name in sorted(settings):
+            h.update('{}={}'.format(name, settings[name]).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.pt')
+
+    def companion(self, key, name):
+        """
+        Path of a file derived from the entry key (e.g. a correspondence index),
+        evicted together with the entry
+        """
+        return os.path.join(self.root, key + '.' + name)
+
+    def lock_path(self, key):
+        return os.path.join(self.root, 'locks', key + '.lock')
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """
+        Exclusive lock on a cache key, held while the entry is computed
+
+        evict removes the lock file of an evicted entry: a lock taken on a file
+        removed meanwhile is dropped and taken again on the new file.
+        """
+        path = self.lock_path(key)
+        while True:
+            f = open(path, 'a')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def _remove_lock(self, key):
+        """
+        Removes the lock file of a key unless the key is locked, returns False when it is
+        """
+        try:
+            f = open(self.lock_path(key), 'r')
+        except FileNotFoundError:
+            return True
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            os.remove(self.lock_path(key))
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return True
+
+    def load(self, key, device='cpu'):
+        """
+        Returns the cached state (dict of tensors) or None on a miss
+
+        A truncated or corrupt entry is a miss: it is recomputed and replaced.
+        """
+        path = self.path(key)
+        try:
+            state = torch.load(path, map_location=device)
+            os.utime(path) # mark as recently used
+        except Exception: # missing, or unreadable (the exception depends on the torch version)
+            return None
+        return state
+
+    def store(self, key, state):
+        """
+        Atomically writes a state (dict of tensors) and evicts old entries
+        """
+        state = {name: state[name].detach().cpu() for name in self.FIELDS}
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(state, f)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits in max_bytes
+
+        An entry is its .pt file and its companion files (key.*), counted and
+        removed together with its lock file. Its use time is the one of the
+        .pt file (or of the newest companion left without one). Entries locked
+        by another job are kept, and the lock files of keys without an entry
+        (e.g. a failed computation) are removed.
+        """
+        with open(os.path.join(self.root, 'locks', 'evict.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            entries = {} # key -> [use time, bytes, file names]
+            for name in os.listdir(self.root):
+                key, dot, suffix = name.partition('.')
+                if not dot or suffix == 'tmp':
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    continue
+                entry = entries.setdefault(key, [0, 0, []])
+                entry[1] += st.st_size
+                entry[2].append(name)
+                if suffix == 'pt':
+                    entry[0] = st.st_mtime
+                elif key + '.pt' not in entry[2]:
+                    entry[0] = max(entry[0], st.st_mtime)
+            total = sum(e[1] for e in entries.values())
+            for key, (_, size, names) in sorted(entries.items(), key=lambda e: e[1][0]):
+                if total <= self.max_bytes:
+                    break
+                if key == keep or not self._remove_lock(key):
+                    continue
+                for name in names:
+                    try:
+                        os.remove(os.path.join(self.root, name))
+                    except FileNotFoundError:
+                        pass
+                total -= size
+            for name in os.listdir(os.path.join(self.root, 'locks')):
+                key, _, suffix = name.rpartition('.')
+                if suffix == 'lock' and key not in entries and key not in ('evict', keep):
+                    self._remove_lock(key)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SpectrumCache(EmbeddingCache):
+    """
+    On-disk cache of the eigen pairs of graph Laplacians
+
+    Entries are keyed by a fingerprint of the Laplacian itself (its sparse
+    structure and values, and the degrees) and the solver tolerance, not by
+    the input files, the solver or the number of eigen vectors: every
+    decomposition of the same mesh reuses the pairs computed before, sliced
+    when fewer are requested and extended when more are (see
+    graph_spectrum.eigen_values_spectrum). Locking, atomic writes and
+    eviction are the ones of EmbeddingCache.
+    """
+
+    FIELDS = ('eig_vals', 'eig_vecs')
+
+    def laplacian_key(self, laplace, degree, **settings):
+        """
+        Cache key from the Laplacian (scipy sparse) and degree matrices and the settings (tol)
+        """
+        laplace = laplace.tocsr()
+        laplace.sort_indices()
+        h = hashlib.sha1('{}x{}'.format(*laplace.shape).encode())
+        for array in (laplace.indptr, laplace.indices, laplace.data, degree.diagonal()):
+            h.update(np.ascontiguousarray(array).tobytes())
+        for name in sorted(settings):
+            h.update('{}={}'.format(name, settings[name]).encode())
+        return h.hexdigest()
@@ -0,0 +1,152 @@
+import torch
+import numpy as np
+from scipy.spatial import cKDTree
+from utils.embedding import ICP_ENGINES, matching_points, transform_embedding, sample_count
+from utils.flip_eigen import flip_eigen_sign, resolve_eigen_ambiguity
+from utils.icp import SimilarityTransform, ICPController, lift_transform
+
+
+def cohort_samples(embeddings, krot, w_sulcal, n, sampling='random', seed=0):
+        """
+        Matching points of n sampled vertices of every embedding, as one batch
+
+        The vertices of every subject are sampled as in Embedding.align (seed + 1),
+        so that a subject aligned alone or in a cohort uses the same points.
+
+        returns: B x n x d float32 tensor
+        """
+        return torch.cat([matching_points(M, krot, w_sulcal, M.sample_order(n, sampling, seed + 1)[0:n])
+                          for M in embeddings])
+
+
+def batched_icp(E2, E1, icp, schedule, c=1, two_step=False, verbose=False):
+        """
+        Similarity transforms of a batch of point sets to their targets, in one ICP per stage
+
+        E2       : subject samples (B x n x d), every prefix a valid sample
+        E1       : target sample shared by the batch (n x d or 1 x n x d), or
+                   one target per item (B x n x d)
+        icp      : ICPController of the ICP engine (records the stage of every run)
+        schedule : coarse-to-fine sample counts, each stage warm started from the previous one
+        c        : first eigen vector column of the points (1 with the sulcal depth, 0 without)
+
+        returns: ICP solution of the last stage, total number of iterations
+        """
+        E1 = E1.reshape(-1, E1.shape[-2], E2.shape[2])
+        if E1.shape[0] == 1:
+            E1 = E1.expand(E2.shape[0], -1, -1)
+        best = None
+        iterations = 0
+        for samples in schedule:
+            m = min(samples, E2.shape[1], E1.shape[1])
+            X, Y = E2[:, 0:m], E1[:, 0:m].contiguous()
+            init_transform = best.RTs if best is not None else None
+            if two_step and best is None: # start with 3 (less ambiguous), seeding the full ICP with the transform
+                init = icp(X[:, :, c:c+3].contiguous(), Y[:, :, c:c+3].contiguous(), stage='two_step')
+                init_transform = lift_transform(init.RTs, X.shape[2], c)
+                iterations += len(init.t_history)
+            best = icp(X, Y, init_transform=init_transform, verbose=verbose, stage='partial_{}'.format(m))
+            iterations += len(best.t_history)
+            if verbose:
+                print('Cohort matching with {} points: rmse {}'.format(m, best.rmse.tolist()))
+        return best, iterations
+
+
+def item(RTs, b):
+        """
+        Transform of item b of a batched SimilarityTransform, as a batch of one
+        """
+        return SimilarityTransform(RTs.R[b:b + 1], RTs.T[b:b + 1], RTs.s[b:b + 1])
+
+
+def align_cohort(ref, embeddings, krot, matching_samples, sulc, two_step=False, verbose=False, icp_engine='pytorch3d',
+                 sampling='random', seed=0, hypotheses=False, batch_size=16, max_iterations=100, relative_rmse_thr=1e-6,
+                 time_budget=None):
+        """
+        Aligns many subject embeddings to the reference with batched ICP
+
+        Matches every subject on the same samples and schedule as Embedding.align
+        in partial mode, but batch_size subjects at a time by one ICP against the
+        shared reference sample (subjects sampling the same number of vertices
+        are batched together), and the transforms are then applied to the full
+        embeddings one subject at a time. The ICP budgets (iterations, relative
+        RMSE threshold, time) apply to each batch, which stops once all its
+        subjects converged, so the transforms agree with Embedding.align up to
+        the ICP convergence.
+
+        ref              : reference embedding
+        embeddings       : subject embeddings (spectral computed), aligned in place
+        krot             : number of eigen vectors used for transformation
+        matching_samples : number of points, or coarse-to-fine schedule (see Embedding.align)
+        others           : see Embedding.align
+
+        returns: embeddings, each with its alignment_info
+        """
+        icp = ICP_ENGINES[icp_engine]
+        w_sulcal = 1 if sulc else 0
+        c = 1 if w_sulcal else 0
+        schedule = matching_samples if isinstance(matching_samples, (list, tuple)) else [matching_samples]
+        # subjects smaller than the largest stage sample fewer vertices (and so does the reference)
+        counts = [sample_count(schedule, ref, M) for M in embeddings]
+        groups = [[M for M, count in zip(embeddings, counts) if count == n] for n in sorted(set(counts), reverse=True)]
+        batches = [group[start:start + batch_size] for group in groups for start in range(0, len(group), batch_size)]
+
+        for batch in batches:
+            for M in batch:
+                if hypotheses:
+                    M.eigen_scores = resolve_eigen_ambiguity(ref, M, krot, icp, w_sulcal=w_sulcal, seed=seed, verbose=verbose)[1]
+                else:
+                    flip_eigen_sign(ref, M, krot, verbose)
+
+            n = sample_count(schedule, ref, batch[0])
+            E1 = matching_points(ref, krot, w_sulcal, ref.sample_order(n, sampling, seed))
+            E2 = cohort_samples(batch, krot, w_sulcal, n, sampling, seed)
+            controller = ICPController(icp, max_iterations, relative_rmse_thr, time_budget)
+            best, iterations = batched_icp(E2, E1, controller, schedule, c, two_step, verbose)
+            del(E2)
+
+            # streaming pass: one full embedding at a time
+            for b, M in enumerate(batch):
+                transform_embedding(M, item(best.RTs, b), krot, w_sulcal)
+                M.alignment_info = {'icp_iterations': iterations, 'rmse': float(best.rmse[b]),
+                                    'converged': bool(best.converged), 'stop': controller.stop,
+                                    'trace': controller.item_trace(b), 'batch': len(batch)}
+        return embeddings
+
+
+def build_template(ref, embeddings, krot, samples=10000, sulc=True, iterations=3, icp_engine='pytorch3d',
+                   sampling='random', seed=0, verbose=False):
+        """
+        Group-wise template of a cohort in the spectral space
+
+        The template starts as the reference sample. Every iteration aligns the
+        samples of all subjects to the template with one batched ICP, then
+        moves every template point to the mean of its nearest aligned subject
+        points. The subjects must have their eigen vector signs resolved
+        against the reference (see align_cohort / flip_eigen_sign).
+
+        returns: template points (n x d), ICP solution of the subject samples
+                 to the final template (apply with embedding.transform_embedding)
+        """
+        icp = ICP_ENGINES[icp_engine]
+        w_sulcal = 1 if sulc else 0
+        n = min([samples, ref.coords.shape[0]] + [M.coords.shape[0] for M in embeddings])
+        template = matching_points(ref, krot, w_sulcal, ref.sample_order(n, sampling, seed)[0:n])[0]
+        E2 = cohort_samples(embeddings, krot, w_sulcal, n, sampling, seed)
+
+        best = None
+        for iteration in range(iterations):
+            best, _ = batched_icp(E2, template, ICPController(icp), [n], c=w_sulcal)
+            aligned = best.Xt.detach().cpu().numpy().astype(np.float64)
+            target = template.detach().cpu().numpy().astype(np.float64)
+            mean = np.zeros_like(target)
+            for points in aligned:
+                mean += points[cKDTree(points).query(target, workers=-1)[1]]
+            mean /= len(aligned)
+            shift = np.sqrt(((mean - target) ** 2).sum(1).mean())
+            template = torch.from_numpy(mean).to(template)
+            if verbose:
+                print('Template iteration {}: rmse {:.4f}, template shift {:.4f}'.format(iteration, float(best.rmse.mean()), shift))
+
+        best, _ = batched_icp(E2, template, ICPController(icp), [n], c=w_sulcal)
+        return template, best
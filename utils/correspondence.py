@@ -0,0 +1,246 @@
+import os
+import pickle
+import tempfile
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+
+def spectral_points(embedding, krot, w_sulcal=1):
+        """
+        Points of an embedding in the aligned spectral space, [w_sulcal * depth, X[:, 0:krot]]
+        as matched by Embedding.align
+
+        returns: n x (krot + 1) (n x krot without sulcal depth) float64 numpy array
+        """
+        X = embedding.X[:, 0:krot].detach().cpu().to(torch.float64)
+        if w_sulcal:
+            depth = embedding.depth.detach().cpu().to(torch.float64)
+            X = torch.hstack((w_sulcal * depth.unsqueeze(1), X))
+        return X.numpy()
+
+
+def _numpy(x):
+        return x.detach().cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+
+
+class CorrespondenceIndex:
+    """
+    KD-tree over the aligned spectral points of the reference
+
+    Maps the vertices of aligned subjects to their reference correspondents,
+    to transfer labels (voting over the k nearest vertices) or surface data
+    (barycentric interpolation on the reference triangle closest in the
+    spectral space). The tree is built once per reference and can be saved
+    next to the reference cache entry.
+    """
+
+    def __init__(self, points, faces=None, tree=None, leafsize=16):
+        self.tree = tree if tree is not None else cKDTree(np.ascontiguousarray(points, dtype=np.float64), leafsize=leafsize)
+        self.faces = None if faces is None else _numpy(faces).astype(np.int64)
+        self._incidence = None
+
+    @property
+    def points(self):
+        return self.tree.data
+
+    def save(self, path):
+        """
+        Atomically writes the index (tree and faces)
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'tree': self.tree, 'faces': self.faces}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads an index saved with save, None if missing or unreadable
+        """
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        return cls(None, state['faces'], tree=state['tree'])
+
+    @classmethod
+    def from_embedding(cls, embedding, krot, w_sulcal=1, path=None):
+        """
+        Index of the reference embedding, loaded from path when it was saved
+        before and saved to path after being built
+
+        embedding : reference Embedding
+        krot      : number of eigen vectors used by the alignment
+        w_sulcal  : weight of the sulcal depth (0 when the alignment ignores it)
+        """
+        index = cls.load(path) if path is not None else None
+        if index is None or index.points.shape != (embedding.X.shape[0], krot + (1 if w_sulcal else 0)):
+            index = cls(spectral_points(embedding, krot, w_sulcal), embedding.faces)
+            if path is not None:
+                index.save(path)
+        return index
+
+    def query(self, points, k=1, workers=-1, chunk_size=65536):
+        """
+        k nearest reference vertices of every point, on `workers` threads and
+        chunk_size points at a time
+
+        returns: distances, indices (n x k)
+        """
+        points = np.asarray(points, dtype=np.float64)
+        dist = np.empty((points.shape[0], k))
+        idx = np.empty((points.shape[0], k), dtype=np.int64)
+        for i in range(0, points.shape[0], chunk_size):
+            d, j = self.tree.query(points[i:i + chunk_size], k=k, workers=workers)
+            dist[i:i + chunk_size] = d.reshape(-1, k)
+            idx[i:i + chunk_size] = j.reshape(-1, k)
+        return dist, idx
+
+    def query_many(self, batch, k=1, workers=-1, chunk_size=65536):
+        """
+        query for the points of many subjects in one multithreaded pass
+
+        returns: list of (distances, indices), one per subject
+        """
+        sizes = [len(points) for points in batch]
+        dist, idx = self.query(np.concatenate(batch), k, workers, chunk_size)
+        bounds = np.cumsum(sizes)[:-1]
+        return list(zip(np.split(dist, bounds), np.split(idx, bounds)))
+
+    def incidence(self):
+        """
+        Triangles around every reference vertex, padded with -1 (n x max valence)
+        """
+        if self._incidence is None:
+            if self.faces is None:
+                raise ValueError('barycentric interpolation needs the reference faces')
+            vertex = self.faces.reshape(-1)
+            face = np.repeat(np.arange(self.faces.shape[0]), 3)
+            order = np.argsort(vertex, kind='stable')
+            vertex, face = vertex[order], face[order]
+            count = np.bincount(vertex, minlength=self.points.shape[0])
+            start = np.cumsum(count) - count
+            self._incidence = np.full((self.points.shape[0], max(1, count.max())), -1, dtype=np.int64)
+            self._incidence[vertex, np.arange(vertex.shape[0]) - start[vertex]] = face
+        return self._incidence
+
+    def barycentric(self, points, nearest=None, workers=-1, chunk_size=16384):
+        """
+        Reference triangle and barycentric coordinates of every point
+
+        Every point is projected on the triangles around its nearest reference
+        vertex (in the spectral space), the closest projection is kept.
+
+        points  : aligned subject points (n x d)
+        nearest : nearest reference vertex of every point (computed if None)
+
+        returns: triangle vertices (n x 3), barycentric weights (n x 3)
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if nearest is None:
+            nearest = self.query(points, 1, workers)[1][:, 0]
+        incidence = self.incidence()
+        Y = self.points
+        vertices = np.empty((points.shape[0], 3), dtype=np.int64)
+        weights = np.empty((points.shape[0], 3))
+        for i in range(0, points.shape[0], chunk_size):
+            p = points[i:i + chunk_size]
+            faces = incidence[nearest[i:i + chunk_size]] # c x v
+            tri = self.faces[faces] # c x v x 3
+            A, B, C = Y[tri[..., 0]], Y[tri[..., 1]], Y[tri[..., 2]]
+            # least squares (u, v) of p - A = u (B - A) + v (C - A), clipped to the triangle
+            e1, e2, r = B - A, C - A, p[:, None, :] - A
+            d11, d12, d22 = (e1 * e1).sum(-1), (e1 * e2).sum(-1), (e2 * e2).sum(-1)
+            r1, r2 = (r * e1).sum(-1), (r * e2).sum(-1)
+            det = np.maximum(d11 * d22 - d12 ** 2, 1e-300)
+            w = np.stack((np.zeros_like(det), (d22 * r1 - d12 * r2) / det, (d11 * r2 - d12 * r1) / det), -1)
+            w[..., 0] = 1 - w[..., 1] - w[..., 2]
+            w = np.clip(w, 0, None)
+            w /= w.sum(-1, keepdims=True)
+            proj = w[..., 0:1] * A + w[..., 1:2] * B + w[..., 2:3] * C
+            dist = ((proj - p[:, None, :]) ** 2).sum(-1)
+            dist[faces < 0] = np.inf
+            best = dist.argmin(1)
+            rows = np.arange(p.shape[0])
+            vertices[i:i + chunk_size] = tri[rows, best]
+            weights[i:i + chunk_size] = w[rows, best]
+        return vertices, weights
+
+
+def vote_labels(labels, idx, dist=None, n_labels=None):
+        """
+        Label of every point by (inverse distance weighted) vote of its k nearest reference vertices
+
+        labels : reference vertex labels (integer valued)
+        idx    : nearest reference vertices (n x k, see CorrespondenceIndex.query)
+        dist   : their distances (n x k), uniform votes if None
+
+        returns: labels (n,)
+        """
+        labels = _numpy(labels).astype(np.int64)
+        candidates = labels[idx]
+        if idx.shape[1] == 1:
+            return candidates[:, 0]
+        n_labels = n_labels or int(labels.max()) + 1
+        weight = np.ones(idx.shape) if dist is None else 1 / np.maximum(dist, 1e-12)
+        rows = np.repeat(np.arange(idx.shape[0]), idx.shape[1])
+        votes = np.bincount(rows * n_labels + candidates.reshape(-1), weight.reshape(-1), minlength=idx.shape[0] * n_labels)
+        return votes.reshape(idx.shape[0], n_labels).argmax(1)
+
+
+def interpolate(features, vertices, weights):
+        """
+        Barycentric interpolation of reference surface data (see CorrespondenceIndex.barycentric)
+
+        features : reference vertex data (n_ref or n_ref x c)
+
+        returns: interpolated data (n or n x c)
+        """
+        features = _numpy(features)
+        w = weights if features.ndim == 1 else weights[..., None]
+        return (features[vertices] * w).sum(1)
+
+
+def match_labels(labels, ids, target_ids):
+        """
+        Labels of a parcellation in the label indices of another one
+
+        LoadMesh numbers the labels present in each subject consecutively, so
+        the same index is a different label in a subject missing a label. The
+        labels are matched by annotation id; the ones missing from the target
+        get indices after its own.
+
+        labels     : label indices (n,)
+        ids        : annotation id of every label index of labels
+        target_ids : annotation id of every label index of the target
+
+        returns: labels in the target indices (n,), annotation id of every
+                 target index (target_ids followed by the missing ones)
+        """
+        space = {int(i): k for k, i in enumerate(_numpy(target_ids))}
+        mapping = np.array([space.setdefault(int(i), len(space)) for i in _numpy(ids)], dtype=np.int64)
+        return mapping[_numpy(labels).astype(np.int64)], np.array(list(space), dtype=np.int64)
+
+
+def transfer_accuracy(predicted, truth):
+        """
+        Agreement of transferred labels with the subject's own labels (both in the
+        subject's label indices, see match_labels)
+
+        returns: dict of accuracy, mean dice and dice of every label
+        """
+        predicted = _numpy(predicted).astype(np.int64)
+        truth = _numpy(truth).astype(np.int64)
+        n_labels = int(max(predicted.max(), truth.max())) + 1
+        overlap = np.bincount(truth[predicted == truth], minlength=n_labels)
+        size = np.bincount(predicted, minlength=n_labels) + np.bincount(truth, minlength=n_labels)
+        present = size > 0
+        dice = 2 * overlap[present] / size[present]
+        return {'accuracy': float((predicted == truth).mean()), 'dice': float(dice.mean()),
+                'dice_per_label': dict(zip(np.nonzero(present)[0].tolist(), dice.tolist()))}
@@ -1,9 +1,60 @@
+import contextlib
 import torch 
-import torch_geometric as tg
-from pytorch3d.ops import iterative_closest_point as icp
-from utils.weight_adjaceny import weight_adjacency_matrix
+from utils.icp import kdtree_icp, ICPController, lift_transform
+from utils.weight_adjaceny import weight_adjacency_csr, edge_index_from_csr
 from utils.graph_spectrum import eigen_values_spectrum
-from utils.flip_eigen import flip_eigen_sign
+from utils.flip_eigen import flip_eigen_sign, resolve_eigen_ambiguity
+from utils.sampling import sample_order
+from utils.instrument import no_stage
+try:
+    from pytorch3d.ops import iterative_closest_point as icp
+except ImportError:
+    def icp(*args, **kwargs):
+        raise ImportError('the pytorch3d ICP engine needs pytorch3d, use the kdtree engine (--icp kdtree)')
+
+# ICP engines selectable in Embedding.align
+ICP_ENGINES = {
+    'pytorch3d': icp,
+    'kdtree': kdtree_icp,
+}
+
+def matching_points(M, krot, w_sulcal, idx=None):
+    """
+    Points matched by ICP, [w_sulcal * depth, X[:, 0:krot]] of the vertices idx
+    (all if None), written directly into one float32 (1 x n x d) tensor
+    """
+    X = M.X[:, 0:krot] if idx is None else M.X[idx, 0:krot]
+    c = 1 if w_sulcal else 0
+    E = torch.empty((1, X.shape[0], krot + c), dtype=torch.float32, device=X.device)
+    E[0, :, c:] = X
+    if c:
+        E[0, :, 0] = w_sulcal * (M.depth if idx is None else M.depth[idx])
+    return E
+
+
+def sample_count(schedule, *meshes):
+    """
+    Number of vertices sampled for partial matching: the largest stage of the
+    schedule, at most the vertex count of every matched mesh
+
+    The stratified samplers depend on it (see utils.sampling), so the batched
+    alignments (utils.cohort, utils.atlas) use it as Embedding.align does.
+    """
+    return min([max(schedule)] + [M.coords.shape[0] for M in meshes])
+
+
+def transform_embedding(M, RTs, krot, w_sulcal):
+    """
+    Applies in place to M.X[:, 0:krot] a similarity transform (R, T, s) found on
+    matching_points, without building the full [depth, X] matrix
+    """
+    c = 1 if w_sulcal else 0
+    R, T, s = RTs.R[0].to(M.X.dtype), RTs.T[0].to(M.X.dtype), RTs.s[0].to(M.X.dtype)
+    Y = M.X[:, 0:krot] @ R[c:, c:]
+    if c:
+        Y.addr_(w_sulcal * M.depth.to(M.X.dtype), R[0, c:])
+    M.X[:, 0:krot] = Y.mul_(s).add_(T[c:])
+
 
 class Embedding:
 
@@ -14,12 +65,15 @@ class Embedding:
         self.thickness = obj.thickness
         self.curv = obj.curv
         self.device = obj.device
+        self.dtype = obj.coords.dtype # precision of the embedding (eigen vectors, X)
         if hasattr(obj, 'P'):
             self.P = obj.P
         else:
             self.P=[]
+        self.P_ids = getattr(obj, 'P_ids', None) # annotation id of every label index of P
+        self.samples = {}
 
-    def spectral(self, ne):
+    def spectral(self, ne, tol=1e-3, maxiter=5000, solver='eigs', precond='amg', verbose=False, spectra=None, **options):
         
         """
         Computes the spectral embedding of the graph
@@ -29,6 +83,8 @@ class Embedding:
         self.Dinv = D^-1
         self.Lambda = eigen values
         self.vectors = eigen vectors
+        solver, tol, maxiter, precond, options : eigensolver settings (see eigen_values_spectrum)
+        spectra : SpectrumCache of the eigen pairs by Laplacian, reused for any ne (None: always solve)
 
         returns: 
             self.edge_index : Adj matrix edge index
@@ -37,19 +93,63 @@ class Embedding:
             self.eig_vals   : Eigen values  (real + sorted)
             self.eig_vecs   : Eigen vectors  (real + sorted)
             self.device     : CPU / GPU
+            self.dtype      : precision of the returned tensors (the solve is always float64)
+            self.spectrum_info : eigensolver iterations and residuals
         
         """
-        # compute the weighted adjacency matrix from the triangulated mesh(weight affinities)            
-        self.edge_index, self.edge_attr = weight_adjacency_matrix(self.coords, self.faces) 
-
-        # compute the randomwalk graphlaplacian 
-        laplace_edge_index, laplace_edge_weight = tg.utils.get_laplacian(self.edge_index, self.edge_attr, normalization='rw')
-        laplace = tg.utils.to_scipy_sparse_matrix(laplace_edge_index, laplace_edge_weight)
-        self.eig_vals, self.eig_vecs = eigen_values_spectrum(laplace, ne)
-        self.eig_vals, self.eig_vecs = self.eig_vals.to(device=self.device), self.eig_vecs.to(device=self.device)
+        # compute the weighted adjacency and degree matrices from the triangulated mesh(weight affinities)
+        weights, degree = weight_adjacency_csr(self.coords, self.faces)
+        self.edge_index, self.edge_attr = edge_index_from_csr(weights, device=self.device)
+        self.edge_attr = self.edge_attr.to(self.dtype)
+
+        # graph laplacian L = D - W, its spectrum is the randomwalk one of L v = lambda D v
+        laplace = (degree - weights).tocsr()
+        # eigen pairs of the same Laplacian computed before (any ne), sliced or extended
+        key = None if spectra is None else spectra.laplacian_key(laplace, degree, tol=tol)
+        with (contextlib.nullcontext() if key is None else spectra.lock(key)):
+            state = None if key is None else spectra.load(key)
+            known = None if state is None else (state['eig_vals'].numpy(), state['eig_vecs'].numpy())
+            self.eig_vals, self.eig_vecs, self.spectrum_info = eigen_values_spectrum(laplace, degree, ne, solver=solver, tol=tol,
+                                                                                     maxiter=maxiter, precond=precond, verbose=verbose,
+                                                                                     known=known, **options)
+            if key is not None and (known is None or known[0].shape[0] < ne):
+                # extended pairs are served to every later run: only stored when within tol
+                new = self.spectrum_info['residuals'][self.spectrum_info.get('reused', 0):]
+                if known is not None and new.max() > tol * float(self.eig_vals.max()):
+                    print('Extended eigen pairs above the tolerance - not stored')
+                else:
+                    spectra.store(key, {'eig_vals': self.eig_vals, 'eig_vecs': self.eig_vecs})
+        self.eig_vals = self.eig_vals.to(device=self.device, dtype=self.dtype)
+        self.eig_vecs = self.eig_vecs.to(device=self.device, dtype=self.dtype)
         self.X = torch.matmul(self.eig_vecs, torch.diag(self.eig_vals ** (-0.5))) 
+
+    def state_dict(self):
+        """
+        Returns the computed spectral state (see spectral) as a dict of tensors
+        """
+        return {'eig_vals': self.eig_vals, 'eig_vecs': self.eig_vecs, 'X': self.X,
+                'edge_index': self.edge_index, 'edge_attr': self.edge_attr}
+
+    def load_state_dict(self, state):
+        """
+        Restores a spectral state saved with state_dict instead of recomputing it
+        """
+        for key, value in state.items():
+            setattr(self, key, value.to(device=self.device))
     
-    def align(self, ref, krot, matching_samples, sulc, two_step, matching_mode, verbose):
+    def sample_order(self, n, method='random', seed=0):
+        """
+        Order of n vertices used for partial matching (see utils.sampling), kept
+        so that a reference aligned to many subjects is only sampled once
+        """
+        key = (n, method, seed)
+        if key not in self.samples:
+            self.samples[key] = sample_order(self.coords, self.faces, self.curv, n, method, seed).to(device=self.device)
+        return self.samples[key]
+
+    def align(self, ref, krot, matching_samples, sulc, two_step, matching_mode, verbose, icp_engine='pytorch3d',
+              sampling='random', seed=0, hypotheses=False, stage=no_stage, max_iterations=100, relative_rmse_thr=1e-6,
+              time_budget=None):
         """
         Performs spectral alignment of brain surfaces 
 
@@ -57,87 +157,88 @@ class Embedding:
             ref.depth    : sulcal depth (surface data)
         to_align         : embedding to be aligned to ref
         krot             : number of eigen vectors used for transformation
-        matching_samples : number of points used to find transformation
+        matching_samples : number of points used to find transformation, or a
+                           coarse-to-fine schedule (e.g. [1000, 4000, 10000]),
+                           each stage warm started from the previous transform
         matching_mode    : partial or complete
         two_step         : start with 3 eigen vectors(less ambiguous)
         w_sulcal         : use/not use sulcal weights 
+        icp_engine       : ICP implementation, one of ICP_ENGINES (pytorch3d brute force KNN or CPU kdtree)
+        sampling         : partial matching vertex sampling, one of utils.sampling.SAMPLERS
+        seed             : random seed of the sampling
+        hypotheses       : score sign / near degenerate ordering candidates with one
+                           batched ICP instead of only flipping signs by pole barycenters
+        stage            : context manager of the timed sub-stages, flip_eigen_sign and icp
+                           (see utils.instrument.StageRecorder.stage)
+        max_iterations   : ICP iterations of every stage (two_step, each schedule stage)
+        relative_rmse_thr: ICP stops once the relative RMSE improvement is below it
+        time_budget      : wall clock budget of all the ICP stages in seconds (None: unbounded)
 
         Returns the aligned spectral embedding
         Mw               : aligned embedding
+        Mw.alignment_info: ICP iterations, final RMSE, convergence, why ICP
+                           stopped and its trace (see utils.icp.ICPController)
         """
-        max_iterations = 100# * krot
         Mo = ref
         Mw = self        
         Mo.n = ref.coords.shape[0]
         Mw.n = Mw.coords.shape[0]
+        icp = ICP_ENGINES[icp_engine]
         if sulc:
             w_sulcal = 1
         else:
             w_sulcal = 0        
 
-        Mw = flip_eigen_sign(Mo, Mw, krot, verbose)
-
-        if matching_mode=='complete': #complete mesh
-            if w_sulcal:
-                E1 = torch.hstack((w_sulcal*Mo.depth.unsqueeze(1), Mo.X[:,0:krot])).unsqueeze(0)
-                E2 = torch.hstack((w_sulcal*Mw.depth.unsqueeze(1), Mw.X[:,0:krot])).unsqueeze(0)
-                if two_step: #start with 3 (less ambiguous)
-                    init_trans = icp(E2[:, :, 1:4].to(torch.float32), E1[:, :, 1:4].to(torch.float32))
-                    E2[:, :, 1:4] = init_trans.Xt   
+        with stage('flip_eigen_sign'):
+            if hypotheses:
+                Mw, Mw.eigen_scores = resolve_eigen_ambiguity(Mo, Mw, krot, icp, w_sulcal=w_sulcal, seed=seed, verbose=verbose)
+            else:
+                Mw = flip_eigen_sign(Mo, Mw, krot, verbose)
 
-                best_trans = icp(E2.to(torch.float32), E1.to(torch.float32), max_iterations=max_iterations, verbose=verbose)
-                
-                Mw.X[:,0:krot] = best_trans.Xt.squeeze()[:, 1:]     
+        c = 1 if w_sulcal else 0 # first eigen vector column of the matched points
 
-            else:
-                E1 = Mo.X[:,0:krot].unsqueeze(0)
-                E2 = Mw.X[:,0:krot].unsqueeze(0)
+        with stage('icp'):
+            icp = ICPController(icp, max_iterations, relative_rmse_thr, time_budget)
+            if matching_mode=='complete': #complete mesh
+                E1 = matching_points(Mo, krot, w_sulcal)
+                E2 = matching_points(Mw, krot, w_sulcal)
+                init_transform = None
+                if two_step: # start with 3 (less ambiguous), seeding the full ICP with the transform
+                    init_trans = icp(E2[:, :, c:c+3].contiguous(), E1[:, :, c:c+3].contiguous(), stage='two_step')
+                    init_transform = lift_transform(init_trans.RTs, E2.shape[2], c)
 
-                if two_step: #start with 3 (less ambiguous)
-                    init_trans = icp(E2[:, :, 1:4].to(torch.float32), E1[:, :, 1:4].to(torch.float32))
-                    E2[:, :, 1:4] = init_trans.Xt   
+                best_trans = icp(E2, E1, init_transform=init_transform, verbose=verbose, stage='complete')
+                del(E1); del(E2)
 
-                best_trans = icp(E2.to(torch.float32), E1.to(torch.float32), max_iterations=max_iterations, verbose=verbose)
-                
-                Mw.X = best_trans.Xt.squeeze()
-           
-        
-        elif matching_mode=='partial': #partial mesh
-            
-            n = torch.Tensor((matching_samples,Mo.n,Mw.n)).int().min()
-            idx1 = torch.randperm(Mo.n)
-            idx1 = idx1[0:n]
-            idx2 = torch.randperm(Mw.n)
-            idx2 = idx2[0:n]
-
-            if w_sulcal:
-                E1 = torch.hstack((w_sulcal*Mo.depth[idx1].unsqueeze(1), Mo.X[idx1,0:krot])).unsqueeze(0)
-                E2 = torch.hstack((w_sulcal*Mw.depth[idx2].unsqueeze(1), Mw.X[idx2,0:krot])).unsqueeze(0)
-
-                if two_step: # start with 3 (less ambiguous)
-                    init_trans = icp(E2[:, :, 1:4].to(torch.float32), E1[:, :, 1:4].to(torch.float32))
-                    E2[:, :, 1:4] = init_trans.Xt  
-
-                best_trans = icp(E2.to(torch.float32), E1.to(torch.float32), verbose=verbose)
-
-                E2 = torch.hstack((w_sulcal*Mw.depth.unsqueeze(1), Mw.X[:,0:krot])).unsqueeze(0)
-                X2 =  best_trans.RTs.s[:, None, None] * torch.bmm(E2, best_trans.RTs.R.to(torch.float64)) + best_trans.RTs.T[:, None, :]
-                Mw.X[:,0:krot] = X2.squeeze()[:, 1:]
-                
-            else:            
-                E1 = Mo.X[idx1,0:krot]
-                E2 = Mw.X[idx2,0:krot]
-
-                if two_step: # start with 3 (less ambiguous)
-                    init_trans = icp(E2[:, :, 1:4], E1[:, :, 1:4])
-                    E2[:, :, 1:4] = init_trans.Xt  
-
-                best_trans = icp(E2.to(torch.float32), E1.to(torch.float32), verbose=verbose)
-
-                E2 = torch.hstack((w_sulcal*Mw.depth.unsqueeze(1), Mw.X[:,0:krot])).unsqueeze(0)
-                X2 =  best_trans.RTs.s[:, None, None] * torch.bmm(E2, best_trans.RTs.R.to(torch.float64)) + best_trans.RTs.T[:, None, :]
-                Mw.X = X2.squeeze()            
+                Mw.X[:,0:krot] = best_trans.Xt[0, :, c:]
         
+            elif matching_mode=='partial': #partial mesh
+
+                schedule = matching_samples if isinstance(matching_samples, (list, tuple)) else [matching_samples]
+                n = sample_count(schedule, Mo, Mw)
+                order1 = Mo.sample_order(n, sampling, seed)
+                order2 = Mw.sample_order(n, sampling, seed + 1)
+
+                best_trans = None
+                for samples in schedule:
+                    E1 = matching_points(Mo, krot, w_sulcal, order1[0:min(samples, n)])
+                    E2 = matching_points(Mw, krot, w_sulcal, order2[0:min(samples, n)])
+
+                    # warm start from the transform of the previous (coarser) stage
+                    init_transform = best_trans.RTs if best_trans is not None else None
+                    if two_step and best_trans is None: # start with 3 (less ambiguous)
+                        init_trans = icp(E2[:, :, c:c+3].contiguous(), E1[:, :, c:c+3].contiguous(), stage='two_step')
+                        init_transform = lift_transform(init_trans.RTs, E2.shape[2], c)
+
+                    best_trans = icp(E2, E1, init_transform=init_transform, verbose=verbose, stage='partial_{}'.format(E1.shape[1]))
+                    if verbose:
+                        print('Partial matching with {} points: rmse {}'.format(E1.shape[1], best_trans.rmse))
+
+                transform_embedding(Mw, best_trans.RTs, krot, w_sulcal)
+
+            Mw.alignment_info = {'icp_iterations': icp.iterations, 'rmse': float(best_trans.rmse.max()),
+                                 'converged': bool(best_trans.converged), 'stop': icp.stop, 'trace': icp.item_trace()}
+
         self = Mw
         del(Mw); del(Mo)
 
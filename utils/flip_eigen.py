@@ -1,6 +1,41 @@
+import itertools
 import torch
 
 
+def pole_barycenters(coords, X):
+        """
+        Weighted barycenters of the positive and negative poles of every eigen vector
+
+        coords = vertex positions (n x 3)
+        X      = spectral embedding (n x ne)
+
+        returns: positive and negative pole barycenters (ne x 3 each)
+        """
+        #center the mean (zero mean)
+        C = coords[:,0:3] - coords[:,0:3].mean(0)
+        X = X.to(C.dtype)
+
+        #weighted barycenters of poles
+        w = torch.sign(X) * (abs(X**3))
+        wp = w.clamp(min=0)
+        wm = w.clamp(max=0)
+        return (wp / wp.sum(0)).t() @ C, (wm / wm.sum(0)).t() @ C
+
+
+def pole_distances(M1, M2, cols1, cols2):
+        """
+        Distances between matched poles of the eigen vectors cols1 of M1 and cols2 of M2
+
+        returns: distance keeping the sign, distance after flipping the sign (len(cols1) each)
+        """
+        p1, m1 = pole_barycenters(M1.coords, M1.X[:, cols1])
+        p2, m2 = pole_barycenters(M2.coords, M2.X[:, cols2])
+        distp = (p1 - p2).pow(2).sum(1) + (m1 - m2).pow(2).sum(1)
+        # the flipped distance pairs m1 with m2 as well, the criterion of the original per eigen vector loop
+        distm = (p1 - m2).pow(2).sum(1) + (m1 - m2).pow(2).sum(1)
+        return distp, distm
+
+
 def flip_eigen_sign(M1, M2, ne, verbose):
         """
         Flip eigen vector signs of M2 such that it matches M1
@@ -10,55 +45,133 @@ def flip_eigen_sign(M1, M2, ne, verbose):
         ne = number of eigen vectors
 
         """
-        for i in range(0, ne):
-            
-            #center the mean (zero mean)
-            X1 = M1.coords[:,0:3] - M1.coords[:,0:3].mean(0)
-            X2 = M2.coords[:,0:3] - M2.coords[:,0:3].mean(0)
-
-            
-            #reference
-            #weighted barycenters of poles
-            w1 = torch.sign(M1.X[:,i]) * (abs(M1.X[:,i]**3))
-            
-            #positive pole barycenter
-            w = w1.clone()
-            w[w<0] = 0
-            w = w/w.sum(0)
-            avgX1p = (X1 * w.unsqueeze(-1)).sum(0)
-            del(w)
-
-            #negative pole barycenter
-            w = w1.clone()
-            w[w>0] = 0
-            w = w/w.sum(0)
-            avgX1m = (X1 * w.unsqueeze(-1)).sum(0)
-            del(w)
-
-            #to transform
-            w2 = torch.sign(M2.X[:,i]) * (abs(M2.X[:,i]**3))
-
-            #positive pole barycenter
-            w = w2.clone()
-            w[w<0] = 0
-            w = w/w.sum(0)
-            avgX2p = (X2 * w.unsqueeze(-1)).sum(0)
-            del(w)
-
-            #negative pole barycenter
-            w=w2.clone()
-            w[w>0] = 0
-            w = w/w.sum(0)
-            avgX2m = (X2 * w.unsqueeze(-1)).sum(0)
-            
-            #distance betweem matched poles
-            distp = (avgX1p - avgX2p).pow(2).sum() + (avgX1m - avgX2m).pow(2).sum()
-            distm = (avgX1p - avgX2m).pow(2).sum() + (avgX1m - avgX2m).pow(2).sum()
-
-            if distm < distp:
-                if verbose:
-                    print('Flip ',str(i))
-                M2.eig_vecs[:,i] = - M2.eig_vecs[:,i]
-                M2.X[:,i] = - M2.X[:,i]
-            
-        return M2
\ No newline at end of file
+        distp, distm = pole_distances(M1, M2, list(range(ne)), list(range(ne)))
+        flip = distm < distp
+        if verbose:
+            for i in torch.nonzero(flip).flatten().tolist():
+                print('Flip ',str(i))
+
+        signs = (1 - 2 * flip.to(M2.X.dtype)).to(device=M2.X.device)
+        M2.eig_vecs[:,0:ne] *= signs.to(M2.eig_vecs.dtype)
+        M2.X[:,0:ne] *= signs
+        return M2
+
+
+def reference_poles(refs, ne):
+        """
+        Pole barycenters of the first ne eigen vectors of many references, stacked
+
+        returns: positive and negative pole barycenters (R x ne x 3 each)
+        """
+        poles = [pole_barycenters(ref.coords, ref.X[:, 0:ne]) for ref in refs]
+        return torch.stack([p for p, _ in poles]), torch.stack([m for _, m in poles])
+
+
+def flip_signs(poles, M2, ne):
+        """
+        Signs of the eigen vectors of M2 matching each of many references, as
+        flip_eigen_sign but for all the references at once (the poles of M2 are
+        computed once)
+
+        poles = pole barycenters of the references (see reference_poles)
+
+        returns: signs (R x ne), M2 is not modified
+        """
+        p1, m1 = poles
+        p2, m2 = pole_barycenters(M2.coords, M2.X[:, 0:ne])
+        p2, m2 = p2.to(p1), m2.to(m1)
+        distp = (p1 - p2).pow(2).sum(2) + (m1 - m2).pow(2).sum(2)
+        distm = (p1 - m2).pow(2).sum(2) + (m1 - m2).pow(2).sum(2) # as pole_distances
+        return (1 - 2 * (distm < distp).to(M2.X.dtype)).to(device=M2.X.device)
+
+
+def eigen_hypotheses(M1, M2, ne, gap=0.05, margin=0.2, max_hypotheses=32):
+        """
+        Candidate (permutation, signs) of the eigen vectors of M2 to match M1
+
+        Each permutation swaps some pairs of consecutive eigen vectors of M2
+        whose eigen values are closer than `gap` (relative), its signs are
+        given by the pole barycenters. Signs decided with a relative pole
+        distance margin below `margin` are also tried flipped.
+
+        returns: list of (perm, signs) tensors, fewest changes first (pole based candidate first)
+        """
+        vals = M2.eig_vals[:ne]
+        swaps = [i for i in range(ne - 1) if (vals[i + 1] - vals[i]).abs() < gap * vals[i].abs()]
+        # non overlapping sets of swaps
+        perms = []
+        for r in range(len(swaps) + 1):
+            for chosen in itertools.combinations(swaps, r):
+                if any(b - a < 2 for a, b in zip(chosen, chosen[1:])):
+                    continue
+                perm = list(range(ne))
+                for i in chosen:
+                    perm[i], perm[i + 1] = perm[i + 1], perm[i]
+                perms.append(perm)
+
+        hypotheses = []
+        for perm in perms:
+            distp, distm = pole_distances(M1, M2, list(range(ne)), perm)
+            signs = 1 - 2 * (distm < distp).to(torch.float64)
+            confidence = (distp - distm).abs() / (distp + distm)
+            unsure = torch.nonzero(confidence < margin).flatten().tolist()
+            for r in range(len(unsure) + 1):
+                for chosen in itertools.combinations(unsure, r):
+                    s = signs.clone()
+                    s[list(chosen)] *= -1
+                    changes = sum(p != i for i, p in enumerate(perm)) + r
+                    hypotheses.append((changes, len(hypotheses), torch.tensor(perm), s))
+        return [h[2:] for h in sorted(hypotheses, key=lambda h: h[:2])][:max_hypotheses]
+
+
+def resolve_eigen_ambiguity(M1, M2, ne, icp, w_sulcal=1, samples=2000, gap=0.05, margin=0.2, max_hypotheses=32,
+                            max_iterations=20, tie=0.01, seed=0, verbose=False):
+        """
+        Resolves sign flips and near degenerate swaps of the eigen vectors of M2
+
+        All candidates (see eigen_hypotheses) are scored by a single batched
+        ICP of a small subsample of M2 against M1, and the candidate with the
+        lowest RMSE is applied to M2 (eigen vectors, eigen values and X).
+
+        M1, M2   = Reference embedding, embedding to resolve
+        ne       = number of eigen vectors
+        icp      = ICP engine (see embedding.ICP_ENGINES)
+        w_sulcal = weight of the sulcal depth dimension (0 to ignore)
+        samples  = number of points used to score the candidates
+        tie      = relative RMSE difference below which the candidate with
+                   the fewest changes is kept (rotations absorb pairs of flips)
+
+        returns: M2, list of (perm, signs, rmse) of all candidates (kept first)
+        """
+        hypotheses = eigen_hypotheses(M1, M2, ne, gap, margin, max_hypotheses)
+        idx1 = M1.sample_order(samples, 'random', seed)
+        idx2 = M2.sample_order(samples, 'random', seed + 1)
+        n = min(idx1.shape[0], idx2.shape[0])
+        idx1, idx2 = idx1[:n], idx2[:n]
+
+        # reference sample and every candidate of the subject sample, as one batch
+        X2 = M2.X[idx2, 0:ne]
+        E2 = torch.stack([X2[:, perm] * signs.to(X2) for perm, signs in hypotheses])
+        E1 = M1.X[idx1, 0:ne].unsqueeze(0).expand(len(hypotheses), -1, -1)
+        if w_sulcal:
+            D1 = (w_sulcal * M1.depth[idx1]).to(E1.dtype)
+            D2 = (w_sulcal * M2.depth[idx2]).to(E2.dtype)
+            E1 = torch.cat((D1[None, :, None].expand(len(hypotheses), -1, -1), E1), 2)
+            E2 = torch.cat((D2[None, :, None].expand(len(hypotheses), -1, -1), E2), 2)
+        rmse = icp(E2.to(torch.float32), E1.contiguous().to(torch.float32), max_iterations=max_iterations).rmse
+
+        # hypotheses are ordered by number of changes, keep the first one tied with the best
+        kept = int(torch.nonzero(rmse <= (1 + tie) * rmse.min())[0])
+        ranking = [kept] + [i for i in torch.argsort(rmse).tolist() if i != kept]
+        scores = [(hypotheses[i][0], hypotheses[i][1], float(rmse[i])) for i in ranking]
+        perm, signs, _ = scores[0]
+        if verbose:
+            for i, (p, s, r) in enumerate(scores):
+                print('Eigen hypothesis perm {} signs {}: rmse {:.4f}{}'.format(p.tolist(), s.int().tolist(), r,
+                                                                             ' (kept)' if i == 0 else ''))
+
+        perm = perm.to(M2.X.device)
+        M2.eig_vecs[:, 0:ne] = M2.eig_vecs[:, perm] * signs.to(M2.eig_vecs)
+        M2.X[:, 0:ne] = M2.X[:, perm] * signs.to(M2.X)
+        M2.eig_vals[0:ne] = M2.eig_vals[perm]
+        return M2, scores
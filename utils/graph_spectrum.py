@@ -1,24 +1,305 @@
+import timeit
+import warnings
 import numpy as np
+import scipy.linalg
+import scipy.sparse as sp
 import torch
-from scipy.sparse.linalg import eigs
+from scipy.sparse.linalg import eigs, eigsh, lobpcg, splu, spilu, LinearOperator
+from utils.multilevel import hierarchy
+
+try:
+    import pyamg
+except ImportError:
+    pyamg = None
+
+
+def _counted(solve, shape, counter):
+        """
+        Wraps a linear solve as a LinearOperator counting its applications
+        """
+        def matvec(x):
+            counter[0] += 1
+            return solve(x)
+        return LinearOperator(shape, matvec=matvec, dtype=np.float64)
+
+
+def _solve_eigs(laplace, degree, k, tol, maxiter, precond, verbose):
+        """
+        Non-symmetric ARPACK on the random walk Laplacian D^-1 L (shift-invert, sigma = 0)
+        """
+        rw = sp.diags(1 / degree.diagonal()) @ laplace
+        # same LU solve as ARPACK's default shift-invert operator, counted
+        count = [0]
+        OPinv = _counted(splu(rw.tocsc()).solve, rw.shape, count)
+        eig_vals, eig_vecs = eigs(rw, k = k, sigma = 0, OPinv = OPinv, maxiter= maxiter, tol = tol)
+        return eig_vals.real, np.real(eig_vecs), {'iterations': count[0]}
+
+
+def _solve_eigsh(laplace, degree, k, tol, maxiter, precond, verbose):
+        """
+        Symmetric ARPACK on the generalized problem L v = lambda D v
+
+        Shift-invert around a small negative shift, so that L - sigma D is
+        positive definite and its real LU factorization is well posed.
+        """
+        sigma = -1e-6 * degree.diagonal().mean()
+        lu = splu((laplace - sigma * degree).tocsc())
+        count = [0]
+        OPinv = _counted(lu.solve, laplace.shape, count)
+        eig_vals, eig_vecs = eigsh(laplace, k = k, M = degree, sigma = sigma, OPinv = OPinv, maxiter = maxiter, tol = tol)
+        return eig_vals, eig_vecs, {'iterations': count[0]}
+
+
+def preconditioner(laplace, degree, precond):
+        """
+        Preconditioner of the (regularized) Laplacian for LOBPCG
+
+        precond : 'amg' (smoothed aggregation, needs pyamg, exact LU without
+                  it), 'lu' (exact sparse LU) or 'ilu' (incomplete LU, slow to
+                  converge on large meshes)
+        """
+        A = (laplace + 1e-6 * degree.diagonal().mean() * degree).tocsr()
+        if precond == 'amg':
+            if pyamg is not None:
+                return pyamg.smoothed_aggregation_solver(A).aspreconditioner()
+            print('pyamg not installed - using LU preconditioner')
+        if precond == 'ilu':
+            lu = spilu(A.tocsc(), drop_tol=1e-4, fill_factor=10)
+        else:
+            lu = splu(A.tocsc())
+        return LinearOperator(A.shape, matvec=lu.solve, dtype=np.float64)
+
+
+def residuals(laplace, degree, eig_vals, eig_vecs):
+        """
+        Relative residual norms |L v - lambda D v| / |D v| of each eigenpair
+        """
+        Dv = degree @ eig_vecs
+        return np.linalg.norm(laplace @ eig_vecs - Dv * eig_vals, axis=0) / np.linalg.norm(Dv, axis=0)
+
+
+def _project(X, Y, degree):
+        # D-orthogonal complement of the constraints Y
+        DY = degree @ Y
+        return X - Y @ np.linalg.solve(Y.T @ DY, DY.T @ X)
+
+
+def eigenvalue_scale(laplace, degree, X, M, k, Y=None, steps=3):
+        """
+        Upper estimate of the k-th smallest eigen value: Ritz value of the block
+        X after a few preconditioned inverse iterations (x <- M D x)
+        """
+        for _ in range(steps):
+            X = M @ (degree @ X)
+            if Y is not None:
+                X = _project(X, Y, degree)
+            X = np.linalg.qr(X)[0]
+        ritz = scipy.linalg.eigh(X.T @ (laplace @ X), X.T @ (degree @ X), eigvals_only=True)
+        return ritz[min(k, len(ritz)) - 1]
+
+
+def _lobpcg(laplace, degree, X, k, tol, maxiter, M, Y=None, scale=None, chunk=200):
+        """
+        LOBPCG until the residuals of the first k pairs are within tol times the
+        eigen value scale: |L v - lambda D v| / |D v| <= tol * max lambda
+
+        scipy's tol bounds the absolute residual |L x - lambda D x| of D-normalized
+        x, whose |D x| is about sqrt(mean degree): it is set to tol x the eigen
+        value scale (eigenvalue_scale, an upper estimate, hence a margin of 4) x
+        sqrt(mean degree), and tightened on the next pass when the relative
+        residuals still miss tol. The solve runs in passes of at most `chunk`
+        iterations from the last iterate and gives up at maxiter or when it
+        stagnates: a pass that does not reduce the residual, or a full pass
+        that does not halve it.
+
+        scale : eigen value scale when known (e.g. from a coarser level)
+
+        returns: eigen values (sorted), eigen vectors, iterations, converged
+        """
+        if scale is None:
+            scale = eigenvalue_scale(laplace, degree, X, M, k, Y)
+        atol = tol * scale * np.sqrt(degree.diagonal().mean()) / 4
+        iterations, best = 0, np.inf
+        while True:
+            with warnings.catch_warnings(): # non convergence is handled below
+                warnings.simplefilter('ignore', UserWarning)
+                eig_vals, X, history = lobpcg(laplace, X, B = degree, M = M, Y = Y, tol = atol,
+                                              maxiter = min(chunk, maxiter - iterations), largest = False,
+                                              retResidualNormsHistory = True)
+            iterations += len(history)
+            residual = residuals(laplace, degree, eig_vals[:k], X[:, :k]).max()
+            target = tol * np.abs(eig_vals[:k]).max()
+            if residual <= target:
+                return eig_vals, X, iterations, True
+            if iterations >= maxiter or residual >= best or (len(history) >= chunk and residual > best / 2):
+                return eig_vals, X, iterations, False
+            best = residual
+            atol *= min(0.5, target / residual)
+
+
+def _fallback(laplace, degree, k, tol, maxiter, precond, verbose, iterations):
+        """
+        eigsh solve after a LOBPCG solve that did not converge
+        """
+        print('LOBPCG did not converge in {} iterations - using eigsh'.format(iterations))
+        eig_vals, eig_vecs, info = _solve_eigsh(laplace, degree, k, tol, maxiter, precond, verbose)
+        info.update(iterations=info['iterations'] + iterations, fallback='eigsh', converged=True)
+        return eig_vals, eig_vecs, info
+
+
+def _solve_lobpcg(laplace, degree, k, tol, maxiter, precond, verbose, X=None):
+        """
+        Preconditioned LOBPCG on the generalized problem L v = lambda D v, to a
+        residual relative to the eigen values (see _lobpcg), eigsh when it does
+        not converge
+
+        X : optional initial subspace (n x m, m >= k), random otherwise
+        """
+        if X is None:
+            X = np.random.default_rng(0).standard_normal((laplace.shape[0], k + max(2, k // 2)))
+        M = preconditioner(laplace, degree, precond)
+        eig_vals, eig_vecs, iterations, ok = _lobpcg(laplace, degree, X, k, tol, maxiter, M)
+        if not ok:
+            return _fallback(laplace, degree, k, tol, maxiter, precond, verbose, iterations)
+        return eig_vals[:k], eig_vecs[:, :k], {'iterations': iterations, 'converged': True}
+
+
+def _solve_multilevel(laplace, degree, k, tol, maxiter, precond, verbose, levels=4, refine_tol=None, refine_iter=30):
+        """
+        Coarse-to-fine solve of L v = lambda D v
+
+        The mesh graph is coarsened by vertex clustering (see utils.multilevel),
+        the eigen vectors are solved on the coarsest level and prolongated as
+        the starting subspace of a few LOBPCG refinement iterations on every
+        finer level. The finest level is solved to tol (see _lobpcg), eigsh
+        when it does not converge.
+
+        levels      : maximum number of coarsening steps
+        refine_tol  : relative residual tolerance of the intermediate levels (default tol)
+        refine_iter : maximum refinement iterations per intermediate level
+        """
+        refine_tol = tol if refine_tol is None else refine_tol
+        start = timeit.default_timer()
+        problems, prolongations = hierarchy(laplace, degree, levels, min_size=20 * k)
+        timings = [{'level': 'setup', 'n': laplace.shape[0], 'time': timeit.default_timer() - start}]
+
+        # coarsest level: direct solve with a block of extra vectors for the refinement
+        start = timeit.default_timer()
+        L, D = problems[-1]
+        m = min(k + max(2, k // 2), L.shape[0] - 2)
+        eig_vals, X, info = _solve_eigsh(L, D, m, tol, maxiter, precond, verbose)
+        iterations = info['iterations']
+        timings.append({'level': len(prolongations), 'n': L.shape[0], 'iterations': iterations,
+                        'time': timeit.default_timer() - start})
+
+        for level in reversed(range(len(prolongations))):
+            start = timeit.default_timer()
+            L, D = problems[level]
+            X = prolongations[level] @ X
+            M = preconditioner(L, D, precond)
+            if level > 0:
+                eig_vals, X, n_iter, ok = _lobpcg(L, D, X, k, refine_tol, refine_iter, M, scale=eig_vals[k - 1])
+            else:
+                eig_vals, X, n_iter, ok = _lobpcg(L, D, X, k, tol, maxiter, M, scale=eig_vals[k - 1])
+            iterations += n_iter
+            timings.append({'level': level, 'n': L.shape[0], 'iterations': n_iter,
+                            'time': timeit.default_timer() - start})
+
+        if verbose:
+            for t in timings:
+                print('multilevel {level}: {n} vertices, {time:.2f} s'.format(**t))
+        if prolongations and not ok:
+            return _fallback(laplace, degree, k, tol, maxiter, precond, verbose, iterations)
+        return eig_vals[:k], X[:, :k], {'iterations': iterations, 'levels': timings, 'converged': True}
+
+
+def extend_spectrum(laplace, degree, eig_vals, eig_vecs, k, tol, maxiter, precond, verbose):
+        """
+        First k eigen pairs of L v = lambda D v (constant pair included) from the
+        known non trivial pairs, computing only the missing ones
+
+        The known eigen vectors and the constant vector are locked: LOBPCG
+        searches the missing pairs in their D-orthogonal complement (scipy's
+        constraints Y), with the preconditioner of the lobpcg solver, so no
+        shift-invert factorization is built. The new pairs are solved to a
+        residual relative to the eigen values (see _lobpcg); when they do not
+        converge, all k pairs are solved by eigsh instead.
+
+        eig_vals, eig_vecs : known pairs (m, n x m numpy), m + 1 < k
+        """
+        n = laplace.shape[0]
+        Y = np.hstack((np.full((n, 1), 1 / np.sqrt(n)), eig_vecs))
+        missing = k - Y.shape[1]
+        X = np.random.default_rng(0).standard_normal((n, missing + max(2, missing // 2)))
+        vals, vecs, iterations, ok = _lobpcg(laplace, degree, X, missing, tol, maxiter,
+                                             preconditioner(laplace, degree, precond), Y=Y)
+        if not ok:
+            eig_vals, eig_vecs, info = _fallback(laplace, degree, k, tol, maxiter, precond, verbose, iterations)
+            return eig_vals, eig_vecs, dict(info, reused=0)
+        if verbose:
+            print('Extending {} known eigen pairs by {}'.format(eig_vals.shape[0], missing))
+        return (np.concatenate(([0.0], eig_vals, vals[:missing])), np.hstack((Y, vecs[:, :missing])),
+                {'iterations': iterations, 'reused': eig_vals.shape[0], 'converged': True})
+
+
+# eigensolver backends: name -> f(laplace, degree, k, tol, maxiter, precond, verbose, **options)
+SOLVERS = {
+    'eigs': _solve_eigs,
+    'eigsh': _solve_eigsh,
+    'lobpcg': _solve_lobpcg,
+    'multilevel': _solve_multilevel,
+}
+
+
+def eigen_values_spectrum(laplace, degree, ne, solver='eigs', tol=1e-3, maxiter=5000, precond='amg', verbose=False, known=None,
+                          **options):
 
-def eigen_values_spectrum(laplace,ne):
-            
         """
         Computes the spectral decomposition of the graph laplcian (eigen values and eigen vectors)
 
-        inputs  : Graph Laplacian (Random walk/ normalized matrix)
+        The spectrum of the random walk Laplacian D^-1 L is the one of the
+        symmetric generalized problem L v = lambda D v; every backend returns
+        the same sorted, sign normalized, unit norm eigen vectors.
+
+        inputs  : Graph Laplacian L = D - W (scipy sparse, symmetric)
+        degree  : Degree matrix D (scipy sparse diagonal)
         ne      : number of eigen values
- 
-        returns: Sorted eigen values and eigen vectors
+        solver  : eigensolver backend, one of SOLVERS ('eigs', 'eigsh', 'lobpcg', 'multilevel')
+        tol     : relative accuracy (ARPACK) / residual tolerance relative to the eigen values (LOBPCG)
+        maxiter : maximum number of iterations
+        precond : LOBPCG preconditioner ('amg' or 'ilu')
+        known   : eigen values and vectors computed before for the same Laplacian (as
+                  returned, see utils.cache.SpectrumCache): sliced when they are at
+                  least ne, otherwise only the missing pairs are computed (extend_spectrum)
+        options : solver specific options (levels, refine_tol for 'multilevel')
+
+        returns: Sorted eigen values and eigen vectors, solver info (iterations, residuals)
 
         """
-        eig_vals, eig_vecs = eigs(laplace,k = ne+1,sigma = 0, maxiter= 5000,tol = 1e-3)
-        eig_vecs = np.real(eig_vecs[:, eig_vals.argsort()])
+        if known is not None:
+            known_vals, known_vecs = (np.asarray(x, dtype=np.float64) for x in known)
+        if known is not None and known_vals.shape[0] >= ne:
+            n = laplace.shape[0]
+            eig_vals = np.concatenate(([0.0], known_vals[:ne]))
+            eig_vecs = np.hstack((np.full((n, 1), 1 / np.sqrt(n)), known_vecs[:, :ne]))
+            info, solver = {'iterations': 0, 'reused': ne}, 'cached'
+        elif known is not None and known_vals.shape[0] > 0:
+            eig_vals, eig_vecs, info = extend_spectrum(laplace, degree, known_vals, known_vecs, ne + 1, tol, maxiter, precond, verbose)
+            solver = 'extend'
+        else:
+            eig_vals, eig_vecs, info = SOLVERS[solver](laplace, degree, ne + 1, tol, maxiter, precond, verbose, **options)
+        order = eig_vals.argsort()
+        eig_vals, eig_vecs = eig_vals[order], eig_vecs[:, order]
+        eig_vecs /= np.linalg.norm(eig_vecs, axis=0)
+
+        info['solver'] = solver
+        info['residuals'] = residuals(laplace, degree, eig_vals, eig_vecs)[1:]
+        if verbose:
+            print('{}: {} iterations, max residual {:.2e}'.format(solver, info['iterations'], info['residuals'].max()))
 
         signf = 1 - 2*(eig_vecs[0,:]<0)
         eig_vecs *= signf
 
-        eig_vals = eig_vals.real[1:]
+        eig_vals = eig_vals[1:]
         eig_vecs = eig_vecs[:,1:]
-        return torch.from_numpy(eig_vals), torch.from_numpy(eig_vecs)
\ No newline at end of file
+        return torch.from_numpy(eig_vals), torch.from_numpy(eig_vecs), info
@@ -0,0 +1,253 @@
+import timeit
+from collections import namedtuple
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+# same fields as pytorch3d.ops.points_alignment, so results are interchangeable
+SimilarityTransform = namedtuple('SimilarityTransform', 'R T s')
+ICPSolution = namedtuple('ICPSolution', 'converged rmse Xt RTs t_history')
+
+
+def similarity_transform(X, Y, estimate_scale=False, allow_reflection=False):
+        """
+        Least squares similarity transform (Umeyama) such that s * X @ R + T ~ Y
+
+        X, Y : corresponding points (n x d, numpy)
+
+        returns: R (d x d), T (d,), s
+        """
+        mx, my = X.mean(0), Y.mean(0)
+        Xc, Yc = X - mx, Y - my
+        U, S, Vt = np.linalg.svd(Xc.T @ Yc / X.shape[0])
+        E = np.ones(X.shape[1])
+        if not allow_reflection:
+            E[-1] = np.sign(np.linalg.det(U @ Vt))
+        R = (U * E) @ Vt
+        s = (S * E).sum() / (Xc ** 2).sum(1).mean() if estimate_scale else 1.0
+        T = my - s * mx @ R
+        return R, T, s
+
+
+def nearest_neighbours(tree, X, workers=-1, chunk_size=65536):
+        """
+        Nearest neighbour (distance, index) of every point of X in a KD-tree
+
+        Queries run on `workers` threads, chunk_size points at a time so that
+        the temporary buffers stay bounded.
+        """
+        dist = np.empty(X.shape[0])
+        idx = np.empty(X.shape[0], dtype=np.int64)
+        for i in range(0, X.shape[0], chunk_size):
+            dist[i:i + chunk_size], idx[i:i + chunk_size] = tree.query(X[i:i + chunk_size], k=1, workers=workers)
+        return dist, idx
+
+
+def build_trees(Y):
+        """
+        cKDTree of every target point set of a batch (B x m x d), one tree per
+        distinct target (batches often share the reference)
+        """
+        Yn = Y.detach().cpu().numpy().astype(np.float64) if torch.is_tensor(Y) else Y
+        trees = [cKDTree(Yn[0])]
+        for b in range(1, Yn.shape[0]):
+            trees.append(trees[0] if np.array_equal(Yn[b], Yn[0]) else cKDTree(Yn[b]))
+        return trees
+
+
+def kdtree_icp(X, Y, init_transform=None, max_iterations=100, relative_rmse_thr=1e-6, estimate_scale=False,
+               allow_reflection=False, verbose=False, workers=None, chunk_size=65536, trees=None, callback=None):
+        """
+        Iterative closest point with a KD-tree over the target points
+
+        Drop-in replacement of pytorch3d.ops.iterative_closest_point for CPU
+        nodes: the tree over Y is built once and reused by every iteration,
+        the nearest neighbour queries are multithreaded and chunked.
+
+        X, Y           : source and target point clouds (B x n x d, B x m x d tensors)
+        init_transform : initial SimilarityTransform (optional)
+        workers        : query threads (default torch.get_num_threads())
+        trees          : prebuilt cKDTree of each Y item (optional)
+        callback       : called after every iteration with its transform and RMSE (B numpy),
+                         stops the iterations when it returns True (optional)
+
+        returns: ICPSolution(converged, rmse, Xt, RTs, t_history) as pytorch3d
+        """
+        workers = workers or torch.get_num_threads()
+        dtype, device = X.dtype, X.device
+        Xn = X.detach().cpu().numpy().astype(np.float64)
+        Yn = Y.detach().cpu().numpy().astype(np.float64)
+        B, n, d = Xn.shape
+        if trees is None:
+            trees = build_trees(Yn)
+
+        R, T, s = np.tile(np.eye(d), (B, 1, 1)), np.zeros((B, d)), np.ones(B)
+        if init_transform is not None:
+            R = init_transform.R.detach().cpu().numpy().astype(np.float64)
+            T = init_transform.T.detach().cpu().numpy().astype(np.float64)
+            s = init_transform.s.detach().cpu().numpy().astype(np.float64)
+        Xt = s[:, None, None] * (Xn @ R) + T[:, None, :]
+
+        rmse = np.zeros(B)
+        prev_rmse = None
+        converged = False
+        t_history = []
+        for iteration in range(max_iterations):
+            for b in range(B):
+                _, idx = nearest_neighbours(trees[b if len(trees) > 1 else 0], Xt[b], workers, chunk_size)
+                Y_nn = Yn[b if Yn.shape[0] > 1 else 0][idx]
+                R[b], T[b], s[b] = similarity_transform(Xn[b], Y_nn, estimate_scale, allow_reflection)
+                Xt[b] = s[b] * Xn[b] @ R[b] + T[b]
+                rmse[b] = np.sqrt(((Xt[b] - Y_nn) ** 2).sum(1).mean())
+            t_history.append(_to_torch(R, T, s, dtype, device))
+
+            if verbose:
+                print('ICP iteration {}: mean rmse = {:.2e}'.format(iteration, rmse.mean()))
+            converged = prev_rmse is not None and ((prev_rmse - rmse) / np.maximum(prev_rmse, 1e-300)).max() <= relative_rmse_thr
+            if (callback is not None and callback(t_history[-1], rmse)) or converged:
+                break
+            prev_rmse = rmse.copy()
+
+        RTs = t_history[-1] if t_history else _to_torch(R, T, s, dtype, device)
+        return ICPSolution(converged, torch.from_numpy(rmse).to(dtype=dtype, device=device),
+                           torch.from_numpy(Xt).to(dtype=dtype, device=device), RTs, t_history)
+
+
+def _to_torch(R, T, s, dtype, device):
+        return SimilarityTransform(torch.from_numpy(R.copy()).to(dtype=dtype, device=device),
+                                   torch.from_numpy(T.copy()).to(dtype=dtype, device=device),
+                                   torch.from_numpy(s.copy()).to(dtype=dtype, device=device))
+
+
+def lift_transform(RTs, d, c=0):
+        """
+        Transform of the columns c:c+3 (e.g. the two_step alignment of the first
+        3 eigen vectors) as a transform of all d columns, the others unchanged
+
+        The scale is folded into the rotation block so that only the 3 columns are scaled.
+        """
+        R3, T3, s3 = RTs
+        B = R3.shape[0]
+        R = torch.eye(d, dtype=R3.dtype, device=R3.device).repeat(B, 1, 1)
+        R[:, c:c+3, c:c+3] = s3[:, None, None] * R3
+        T = torch.zeros((B, d), dtype=T3.dtype, device=T3.device)
+        T[:, c:c+3] = T3
+        return SimilarityTransform(R, T, torch.ones_like(s3))
+
+
+def transform_change(A, B):
+        """
+        Change between two batched similarity transforms (|R|_F + |T| + |s| of the
+        differences), per batch item; B None stands for the identity
+        """
+        R, T, s = A
+        if B is None:
+            dR = R - torch.eye(R.shape[1], dtype=R.dtype, device=R.device)
+            dT, ds = T, s - 1
+        else:
+            dR, dT, ds = R - B.R.to(R), T - B.T.to(T), s - B.s.to(s)
+        return dR.flatten(1).norm(dim=1) + dT.norm(dim=1) + ds.abs()
+
+
+class ICPController:
+    """
+    Convergence aware ICP with iteration and wall clock budgets
+
+    Wraps an ICP engine (see embedding.ICP_ENGINES) behind the same call. A
+    run stops when the relative RMSE improvement of every batch item falls
+    below relative_rmse_thr (converged), after max_iterations, or once the time
+    budget is spent. The budget is shared by all the runs of the controller
+    (the two_step and coarse-to-fine stages of one alignment), a run always
+    does at least one iteration.
+
+    kdtree_icp runs once per run, the controller checking the budget and
+    tracing every iteration from inside its loop. Other engines (pytorch3d)
+    are called for one iteration at a time, each call warm started from the
+    transform of the previous one. With chunk > 1 they run `chunk` iterations
+    per call instead, saving the setup of every call (conversions, initial
+    nearest neighbours) at the cost of a coarser trace and budget: one entry
+    and one budget check per chunk.
+
+    Every iteration (chunk) is appended to the trace: stage, iterations, RMSE
+    and transform change of every batch item, and elapsed time.
+    """
+
+    def __init__(self, icp, max_iterations=100, relative_rmse_thr=1e-6, time_budget=None, chunk=1):
+        self.icp = icp
+        self.max_iterations = max_iterations
+        self.relative_rmse_thr = relative_rmse_thr
+        self.time_budget = time_budget
+        self.chunk = max(1, chunk)
+        self.trace = []
+        self.iterations = 0
+        self.stop = None # why the last run stopped: converged, iterations or time
+        self.start = timeit.default_timer()
+
+    def elapsed(self):
+        return timeit.default_timer() - self.start
+
+    def __call__(self, X, Y, init_transform=None, max_iterations=None, verbose=False, stage=None, **kwargs):
+        max_iterations = max_iterations or self.max_iterations
+        if self.icp is kdtree_icp:
+            return self.run_kdtree(X, Y, init_transform, max_iterations, verbose, stage, **kwargs)
+        RTs, prev_rmse, solution = init_transform, None, None
+        t_history = []
+        while True:
+            n = min(self.chunk, max_iterations - len(t_history))
+            solution = self.icp(X, Y, init_transform=RTs, max_iterations=n,
+                                relative_rmse_thr=self.relative_rmse_thr, verbose=verbose, **kwargs)
+            t_history += solution.t_history
+            self.iterations += len(solution.t_history)
+            rmse = solution.rmse.detach().double().cpu()
+            self.record(stage, len(t_history), rmse, solution.RTs, RTs)
+            RTs = solution.RTs
+            if solution.converged or (prev_rmse is not None and
+                                      ((prev_rmse - rmse) / prev_rmse.clamp_min(1e-300)).max() <= self.relative_rmse_thr):
+                self.stop = 'converged'
+                break
+            if len(t_history) >= max_iterations:
+                self.stop = 'iterations'
+                break
+            if self.time_budget is not None and self.elapsed() >= self.time_budget:
+                self.stop = 'time'
+                break
+            prev_rmse = rmse
+        return ICPSolution(self.stop == 'converged', solution.rmse, solution.Xt, RTs, t_history)
+
+    def run_kdtree(self, X, Y, init_transform, max_iterations, verbose, stage, **kwargs):
+        """
+        One kdtree_icp run, traced and stopped by the budget from inside its loop
+        """
+        last = {'RTs': init_transform, 'iteration': 0}
+
+        def iteration(RTs, rmse):
+            last['iteration'] += 1
+            self.record(stage, last['iteration'], torch.from_numpy(rmse), RTs, last['RTs'])
+            last['RTs'] = RTs
+            return self.time_budget is not None and self.elapsed() >= self.time_budget
+
+        solution = self.icp(X, Y, init_transform=init_transform, max_iterations=max_iterations,
+                            relative_rmse_thr=self.relative_rmse_thr, verbose=verbose, callback=iteration, **kwargs)
+        self.iterations += len(solution.t_history)
+        if solution.converged:
+            self.stop = 'converged'
+        elif len(solution.t_history) >= max_iterations:
+            self.stop = 'iterations'
+        else:
+            self.stop = 'time'
+        return solution
+
+    def record(self, stage, iteration, rmse, RTs, prev):
+        """
+        Appends an iteration (a chunk of them with chunk > 1) to the trace, rmse
+        and the change from prev per batch item
+        """
+        self.trace.append({'stage': stage, 'iteration': iteration, 'rmse': rmse.detach().double().cpu().tolist(),
+                           'transform_change': transform_change(RTs, prev).detach().double().cpu().tolist(),
+                           'time': self.elapsed()})
+
+    def item_trace(self, b=0):
+        """
+        Trace of batch item b, with scalar RMSE and transform change
+        """
+        return [dict(entry, rmse=entry['rmse'][b], transform_change=entry['transform_change'][b]) for entry in self.trace]
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import fcntl
+import timeit
+import cProfile
+import threading
+from contextlib import contextmanager
+from utils.utils import peak_rss_mb, reset_peak_rss
+
+
+# stages open in the process, over all recorders and threads (peak memory is per process)
+_open = {'stages': 0, 'entries': 0}
+_open_lock = threading.Lock()
+
+
+class StageRecorder:
+    """
+    Timing and memory record of the pipeline stages of one subject
+
+    Every stage (load, spectral, align, save, ... and the nested flip_eigen_sign
+    and icp stages of the alignment) records its start time, wall time, CPU
+    time and peak resident memory, plus the metrics added by the caller
+    (eigensolver / ICP iterations, RMSE). The record is written as one JSON
+    line, so that the records of a cohort (and of concurrent workers) can be
+    appended to the same file.
+
+    The peak memory is the one of the process (VmHWM). It is reset at the
+    entry of a stage only while no stage of another recorder is open, so a
+    stage never wipes the peak of a concurrent one (--stream, the service,
+    cohort batches). A stage that overlapped a stage of another recorder
+    reports the peak of the process over its run, shared with that stage,
+    and is marked peak_rss_shared.
+
+    With profile_dir, every top level stage also runs under cProfile and its
+    statistics are saved as <profile_dir>/<name>.<stage>.prof (snakeviz,
+    pstats). Sampling profilers (py-spy) need no hook: the stage start times
+    of the record locate the stages in their recordings.
+    """
+
+    def __init__(self, name, profile_dir=None, **fields):
+        self.name = name
+        self.profile_dir = profile_dir
+        self.record = {'subject': name}
+        self.record.update(fields)
+        self.record['stages'] = {}
+        self._peaks = [] # running peak memory of the enclosing stages
+        self._entries = 0 # stages entered by this recorder
+
+    def update(self, **fields):
+        """
+        Adds top level fields to the record
+        """
+        self.record.update(fields)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Records a stage, yields its dict for extra metrics
+
+        Stages can be nested, the peak memory of a stage includes the ones of its
+        nested stages (cProfile is only enabled for the outermost stage).
+        """
+        stats = self.record['stages'].setdefault(name, {})
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak_rss_mb())
+        with _open_lock:
+            shared = _open['stages'] > len(self._peaks) # stages of other recorders are open
+            if not shared:
+                reset_peak_rss()
+            _open['stages'] += 1
+            _open['entries'] += 1
+            self._entries += 1
+            entries = _open['entries'] - self._entries
+        self._peaks.append(0.0)
+
+        profiler = None
+        if self.profile_dir is not None and len(self._peaks) == 1:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        stats['start'] = time.time()
+        wall, cpu = timeit.default_timer(), time.process_time()
+        try:
+            yield stats
+        finally:
+            stats['wall'] = timeit.default_timer() - wall
+            stats['cpu'] = time.process_time() - cpu
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, '{}.{}.prof'.format(self.name, name)))
+            stats['peak_rss_mb'] = max(self._peaks.pop(), peak_rss_mb())
+            with _open_lock:
+                _open['stages'] -= 1
+                # other recorders entered stages meanwhile
+                shared = shared or _open['entries'] - self._entries != entries
+            if shared:
+                stats['peak_rss_shared'] = True
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], stats['peak_rss_mb'])
+
+    def start(self):
+        """
+        Starts the run of the subject (see finish)
+        """
+        self.record['status'] = 'failed'
+        self._start = timeit.default_timer()
+
+    def finish(self, path=None, error=None):
+        """
+        Ends the run (status, error, total wall time) and writes the record to
+        the JSON lines file path
+        """
+        self.record['status'] = 'ok' if error is None else 'failed'
+        if error is not None:
+            self.record['error'] = repr(error)
+        self.record['wall'] = timeit.default_timer() - self._start
+        if path is not None:
+            self.write(path)
+
+    @contextmanager
+    def run(self, path=None):
+        """
+        Records the whole run and writes the record when it ends, even on failure
+        """
+        self.start()
+        try:
+            yield self
+        except BaseException as e:
+            self.finish(path, e)
+            raise
+        self.finish(path)
+
+    def write(self, path):
+        """
+        Appends the record as one JSON line (locked, safe for concurrent writers)
+        """
+        line = json.dumps(self.record, default=float) + '\n'
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def summary(self):
+        """
+        One line per stage: wall time, CPU time and peak memory
+        """
+        return ['{}: {:.2f} s wall, {:.2f} s cpu, peak RSS {:.0f} MB{}'.format(name, s['wall'], s['cpu'], s['peak_rss_mb'],
+                                                                              ' (process, shared)' if s.get('peak_rss_shared') else '')
+                for name, s in self.record['stages'].items() if 'wall' in s]
+
+
+@contextmanager
+def no_stage(name):
+    """
+    Stage context of uninstrumented runs (see StageRecorder.stage)
+    """
+    yield {}
@@ -1,77 +1,146 @@
 import os
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
 import nibabel.freesurfer.io as fsio
 from utils.utils import *
 
+
+def _read_white(path):
+        coords, faces = fsio.read_geometry(path)
+        return {'coords': coords, 'faces': faces.astype(np.int32)}
+
+
+def _read_morph(name):
+        def read(path):
+            return {name: fsio.read_morph_data(path).astype(np.float32)}
+        return read
+
+
+def _read_annot(path):
+        # compact labels into consecutive indices
+        labels, ctab, _ = fsio.read_annot(path)
+        labels = np.where(labels < 0, 0, labels)
+        lab_to_ind, ind_to_lab = rebase_labels(labels)
+        # annotation id (color table) of every index: a subject missing some
+        # labels numbers the others differently, the ids identify them
+        return {'P': lab_to_ind[labels].astype(np.float32), 'P_ids': ctab[ind_to_lab, 4].astype(np.int64)}
+
+
+# version of the converted arrays, part of the cache signature
+CACHE_FORMAT = 2
+
+# file -> (reader, message when missing)
+READERS = {
+    'white': (_read_white, 'Mesh File not found'),
+    'sulc': (_read_morph('depth'), 'Depth File not found'),
+    'thickness': (_read_morph('thickness'), 'Thickness File not found'),
+    'curv': (_read_morph('curv'), 'Curvature File not found'),
+    'annot': (_read_annot, 'Parcellation file not found'),
+}
+
+
 class LoadMesh:
-        
-    def load_mesh(self, main_path, id, hemi, device):
+
+    @staticmethod
+    def surface_files(main_path, id, hemi):
         """
-        Loads the mesh using free surfer
+        FreeSurfer files read by load_mesh for a subject
 
-        path    : path of the dataset
-        id      : patient id
-        hemi    : left/right hemisphere
-        
-        returns coordinates, faces, sulcal depth, cortical thickness, parcellation
+        returns dict of paths (white, sulc, thickness, curv, annot)
+        """
+        surf = os.path.join(main_path, id, 'surf', hemi + '.')
+        return {'white': surf + 'white',
+                'sulc': surf + 'sulc',
+                'thickness': surf + 'thickness',
+                'curv': surf + 'curv',
+                'annot': os.path.join(main_path, id, 'label', hemi + ".labels.DKT31.manual.2.annot")}
 
+    @staticmethod
+    def _signature(files):
         """
-        self.device = device
-    
-        #mesh
-        path = os.path.join(main_path,id,'surf',hemi+".white")
-        
-        try:
-            self.coords,self.faces = fsio.read_geometry(path)
-            self.coords = torch.from_numpy(self.coords).to(device=device)
-            self.faces = torch.from_numpy(self.faces.astype('float')).to(device=device)
-            
-        except FileNotFoundError:
-            print('Mesh File not found')
-
-        #Sulcal depth
-        path = path.replace('white','sulc')
-        try:
-            self.depth = fsio.read_morph_data(path)
-            self.depth = torch.from_numpy(self.depth.astype('float')).to(device=device)
-            
-            
-        except FileNotFoundError:
-            print('Depth File not found')
-        
-        #mesh cortical thickness
-        path = path.replace('sulc','thickness')
+        (mtime, size) of every input file, None when missing
+        """
+        signature = {'format': CACHE_FORMAT}
+        for name, path in files.items():
+            try:
+                st = os.stat(path)
+                signature[name] = [st.st_mtime_ns, st.st_size]
+            except FileNotFoundError:
+                signature[name] = None
+        return signature
 
+    @staticmethod
+    def _read_cache(path, signature):
         try:
-            self.thickness = fsio.read_morph_data(path)
-            self.thickness = torch.from_numpy(self.thickness.astype('float')).to(device=device)
-            
-        except FileNotFoundError:
-            print('Thickness File not found')
-        
-        path = path.replace('thickness','curv')
-        try:
-            self.curv = fsio.read_morph_data(path)
-            self.curv = torch.from_numpy(self.curv.astype('float')).to(device=device)
-            
-        except FileNotFoundError:
-            print('Thickness File not found')
-        
+            with np.load(path) as cached:
+                if json.loads(str(cached['signature'])) != signature:
+                    return None
+                return {key: cached[key] for key in cached.files if key != 'signature'}
+        except (FileNotFoundError, ValueError, KeyError, OSError):
+            return None
+
+    @staticmethod
+    def _write_cache(path, signature, arrays):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
         try:
-            path = os.path.join(main_path, id, 'label', hemi + ".labels.DKT31.manual.2.annot")
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, signature=json.dumps(signature), **arrays)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
 
-            # build lookup table to compact labels into consecutive indices
-            parcs = fsio.read_annot(path)
-            all_labels = flatten_lists([list(np.where(parcs[0]<0, 0, parcs[0]))])
-            al = [l if l >= 0 else 0 for l in all_labels]
-            lab_to_ind, ind_to_lab = rebase_labels(al)
-            parc = lab_to_ind[np.where(parcs[0]<0, 0, parcs[0])]
-            self.P  = torch.from_numpy(parc.astype('float32')).to(device=device)
+    def load_mesh(self, main_path, id, hemi, device, cache_dir=None, workers=5, dtype=None):
+        """
+        Loads the mesh using free surfer
+
+        The surface files are read concurrently and kept in compact native
+        dtypes (int32 faces, float32 surface data). With cache_dir, the
+        converted arrays are saved per subject and reused as long as the
+        mtime and size of every input file are unchanged.
+
+        path      : path of the dataset
+        id        : patient id
+        hemi      : left/right hemisphere
+        cache_dir : directory of the converted-array cache (None: no cache)
+        workers   : number of concurrent file reads
+        dtype     : floating point dtype of the vertex data (e.g. torch.float32,
+                    default: float64 coordinates, float32 surface data)
 
-        except FileNotFoundError:
-            print(id + ' - Parcellation file not found')
+        returns coordinates, faces, sulcal depth, cortical thickness, parcellation
+                (P, with the annotation id of every label index in P_ids)
 
+        """
+        self.device = device
+        files = self.surface_files(main_path, id, hemi)
 
+        arrays = None
+        if cache_dir is not None:
+            signature = self._signature(files)
+            cache_path = os.path.join(cache_dir, id + '_' + hemi + '.npz')
+            arrays = self._read_cache(cache_path, signature)
 
+        if arrays is None:
+            arrays = {}
+            with ThreadPoolExecutor(workers) as pool:
+                futures = {name: pool.submit(READERS[name][0], path) for name, path in files.items()}
+                for name, future in futures.items():
+                    try:
+                        arrays.update(future.result())
+                    except FileNotFoundError:
+                        if name == 'annot':
+                            print(id + ' - ' + READERS[name][1])
+                        else:
+                            print(READERS[name][1])
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                self._write_cache(cache_path, signature, arrays)
 
-  
+        for key, value in arrays.items():
+            value = torch.from_numpy(value)
+            if dtype is not None and key != 'P' and value.is_floating_point():
+                value = value.to(dtype)
+            setattr(self, key, value.to(device=device))
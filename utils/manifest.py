@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+from utils.cache import file_digest
+
+
+class Manifest:
+    """
+    Record of the inputs and parameters of every output of an output directory
+
+    For every output (<subject>_<hemi>) the manifest keeps the content hashes
+    of the subject files, the identity of the reference (id and content hashes
+    of its files) and the alignment parameters. A subject is up to date when
+    all of them are unchanged and its output files exist, so a re-run only
+    processes new or stale subjects.
+
+    File hashes are memoized by (mtime, size), an unchanged file is not read again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = {} # subject -> (name, entry) waiting for its output
+        state = self._read()
+        self.outputs = state.get('outputs', {})
+        self.digests = state.get('digests', {})
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def digest(self, path):
+        """
+        Content hash of a file, None when it is missing
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        memo = self.digests.get(path)
+        if memo is not None and memo[0:2] == [st.st_mtime_ns, st.st_size]:
+            return memo[2]
+        digest = file_digest(path)
+        self.digests[path] = [st.st_mtime_ns, st.st_size, digest]
+        return digest
+
+    def entry(self, files, reference, parameters, outputs):
+        """
+        Manifest entry of an output
+
+        files      : dict of input files of the subject (see LoadMesh.surface_files)
+        reference  : reference identity (see reference)
+        parameters : dict of the parameters changing the output
+        outputs    : output files, relative to the manifest directory
+        """
+        return {'inputs': {name: self.digest(path) for name, path in files.items()},
+                'reference': reference, 'parameters': parameters, 'outputs': outputs}
+
+    def reference(self, id, files):
+        """
+        Identity of the reference: id and content hashes of its files
+        """
+        return {'id': id, 'inputs': {name: self.digest(path) for name, path in files.items()}}
+
+    def stale(self, name, entry):
+        """
+        Why the output name has to be (re)computed, None when it is up to date
+        """
+        old = self.outputs.get(name)
+        if old is None:
+            return 'not in the manifest'
+        root = os.path.dirname(self.path)
+        missing = [path for path in entry['outputs'] if not os.path.exists(os.path.join(root, path))]
+        if missing:
+            return 'output missing ({})'.format(', '.join(missing))
+        changed = sorted(key for key in set(entry['inputs']) | set(old['inputs'])
+                         if entry['inputs'].get(key) != old['inputs'].get(key))
+        if changed:
+            return 'inputs changed ({})'.format(', '.join(changed))
+        if entry['reference'] != old['reference']:
+            return 'reference changed'
+        changed = sorted(key for key in set(entry['parameters']) | set(old['parameters'])
+                         if entry['parameters'].get(key) != old['parameters'].get(key))
+        if changed:
+            return 'parameters changed ({})'.format(', '.join(changed))
+        return None
+
+    def plan(self, subject, name, entry):
+        """
+        Keeps the entry of a subject to process, recorded by commit once its output is written
+        """
+        self.pending[subject] = (name, entry)
+
+    def commit(self, subject):
+        """
+        Records the pending entry of a processed subject (locked read-modify-write,
+        atomic replace of the manifest file)
+        """
+        if subject not in self.pending:
+            return
+        name, entry = self.pending.pop(subject)
+        entry = dict(entry, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = self._read()
+                state.setdefault('outputs', {})[name] = entry
+                self.outputs[name] = entry
+                state['digests'] = dict(state.get('digests', {}), **self.digests)
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(state, f, indent=1, sort_keys=True)
+                    os.replace(tmp, self.path)
+                except BaseException:
+                    os.remove(tmp)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,100 @@
+import numpy as np
+import scipy.sparse as sp
+
+
+def heavy_edge_matching(weights, rounds=100, seed=0):
+        """
+        Greedy heavy edge matching: every vertex is paired with its heaviest
+        unmatched neighbour when the choice is mutual (handshake), repeated
+        until no unmatched vertex has an unmatched neighbour
+
+        The rounds yield the matching of the greedy algorithm over the edges
+        sorted by weight, which leaves only a few percent of the vertices
+        unmatched. Equal weights (regular meshes) are ordered by a random
+        symmetric perturbation, so that ties cannot stall the handshakes.
+
+        weights : symmetric weight adjacency matrix (scipy csr, no diagonal)
+        rounds  : maximum number of matching rounds
+        seed    : seed of the tie-breaking
+
+        returns: aggregate index of each vertex (n,), number of aggregates
+        """
+        n = weights.shape[0]
+        ids = np.arange(n)
+        rows = np.repeat(ids, np.diff(weights.indptr))
+        cols = weights.indices
+        h = np.random.default_rng(seed).random(n)
+        data = weights.data * (1 + 1e-9 * (h[rows] + h[cols]))
+        mate = ids.copy()
+        for _ in range(rounds):
+            free = (mate == ids)
+            valid = free[rows] & free[cols]
+            if not valid.any():
+                break
+            r, c, w = rows[valid], cols[valid], data[valid]
+            heaviest = np.zeros(n)
+            np.maximum.at(heaviest, r, w)
+            hit = w == heaviest[r]
+
+            # first heaviest neighbour of each row (reversed writes keep the first)
+            best = ids.copy()
+            best[r[hit][::-1]] = c[hit][::-1]
+            mutual = (best[best] == ids) & (best != ids)
+            if not mutual.any():
+                break
+            mate[mutual] = best[mutual]
+
+        _, agg = np.unique(np.minimum(ids, mate), return_inverse=True)
+        return agg, agg.max() + 1
+
+
+def aggregation(weights, passes=2):
+        """
+        Vertex clustering of a weighted graph by repeated heavy edge matching
+
+        weights : symmetric weight adjacency matrix (scipy csr)
+        passes  : matching passes, each one about halves the vertices
+
+        returns: prolongation P (n x nc, scipy csr) with P[i, c] = 1 if vertex i is in cluster c
+        """
+        n = weights.shape[0]
+        agg = np.arange(n)
+        W = weights.tocsr()
+        for _ in range(passes):
+            W.setdiag(0)
+            W.eliminate_zeros()
+            sub, nc = heavy_edge_matching(W)
+            agg = sub[agg]
+            P = sp.csr_matrix((np.ones(len(sub)), (np.arange(len(sub)), sub)), shape=(len(sub), nc))
+            W = (P.T @ W @ P).tocsr()
+        return sp.csr_matrix((np.ones(n), (np.arange(n), agg)), shape=(n, agg.max() + 1))
+
+
+def hierarchy(laplace, degree, levels, min_size=100, min_ratio=3):
+        """
+        Galerkin hierarchy of the generalized problem L v = lambda D v
+
+        Each coarse level is L_c = P^T L P, D_c = P^T D P for the aggregation P
+        of the finer level, which keeps the constant vector in the null space.
+
+        laplace, degree : fine Laplacian L = D - W and degree matrix D
+        levels          : maximum number of coarsening steps
+        min_size        : stop coarsening below this number of vertices
+        min_ratio       : stop coarsening when a level does not shrink the
+                          graph by this factor (the level is dropped)
+
+        returns: list of (L, D) from fine to coarse, list of prolongations P
+        """
+        problems = [(laplace.tocsr(), degree.tocsr())]
+        prolongations = []
+        for _ in range(levels):
+            L, D = problems[-1]
+            if L.shape[0] <= min_size:
+                break
+            W = (sp.diags(L.diagonal()) - L).tocsr()
+            P = aggregation(W)
+            if P.shape[0] < min_ratio * P.shape[1]:
+                break
+            problems.append(((P.T @ L @ P).tocsr(), (P.T @ D @ P).tocsr()))
+            prolongations.append(P)
+        return problems, prolongations
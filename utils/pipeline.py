@@ -0,0 +1,121 @@
+import queue
+import threading
+
+# end of stream marker of the queues
+_DONE = object()
+
+
+class StreamingExecutor:
+    """
+    Three stage pipeline over a stream of items, overlapping I/O and compute
+
+    load    : prefetch threads read upcoming items, load(item) -> value
+    compute : the calling thread processes them in turn, compute(item, value) -> result
+    write   : background threads write the results, write(item, result)
+
+    The stages are connected by bounded queues: at most `prefetch` loaded
+    items wait for the compute stage and `pending` results wait for the
+    writers, so the loaders and the compute stage block (backpressure) instead
+    of holding the whole cohort in memory. A failure of any stage only drops
+    its item.
+    """
+
+    def __init__(self, load, compute, write, prefetch=2, pending=2, loaders=1, writers=1):
+        self.load = load
+        self.compute = compute
+        self.write = write
+        self.prefetch = max(1, prefetch)
+        self.pending = max(1, pending)
+        self.loaders = max(1, loaders)
+        self.writers = max(1, writers)
+
+    def run(self, items, done=None):
+        """
+        Processes the items, calling done(item, error) once per item (error is
+        None on success) from the thread that finished it
+
+        returns: list of (item, error) of the failed items
+        """
+        todo = queue.Queue()
+        for item in items:
+            todo.put(item)
+        loaded = queue.Queue(self.prefetch)
+        results = queue.Queue(self.pending)
+        stop = threading.Event()
+        failed = []
+        lock = threading.Lock()
+
+        def finish(item, error):
+            with lock:
+                if error is not None:
+                    failed.append((item, error))
+                if done is not None:
+                    done(item, error)
+
+        def put(q, job):
+            # blocking put that gives up when the run is aborted
+            while not stop.is_set():
+                try:
+                    q.put(job, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def loader():
+            while not stop.is_set():
+                try:
+                    item = todo.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    put(loaded, (item, self.load(item), None))
+                except Exception as e:
+                    put(loaded, (item, None, e))
+            put(loaded, _DONE)
+
+        def writer():
+            while True:
+                job = results.get()
+                if job is _DONE:
+                    break
+                item, result = job
+                try:
+                    self.write(item, result)
+                except Exception as e:
+                    finish(item, e)
+                else:
+                    finish(item, None)
+
+        loaders = [threading.Thread(target=loader, daemon=True) for _ in range(self.loaders)]
+        writers = [threading.Thread(target=writer, daemon=True) for _ in range(self.writers)]
+        for thread in loaders + writers:
+            thread.start()
+
+        try:
+            remaining = len(loaders)
+            while remaining:
+                job = loaded.get()
+                if job is _DONE:
+                    remaining -= 1
+                    continue
+                item, value, error = job
+                if error is not None:
+                    finish(item, error)
+                    continue
+                try:
+                    result = self.compute(item, value)
+                except Exception as e:
+                    finish(item, e)
+                    continue
+                del value
+                results.put((item, result))
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            # writers finish the pending results before returning
+            for _ in writers:
+                results.put(_DONE)
+            for thread in writers:
+                thread.join()
+        return failed
@@ -0,0 +1,111 @@
+from functools import partial
+import numpy as np
+import torch
+
+
+def random_order(coords, faces, curv, n, generator):
+        """
+        Uniformly random vertices (previous partial matching behaviour)
+        """
+        return torch.randperm(coords.shape[0], generator=generator)[:n]
+
+
+def farthest_point_order(coords, faces, curv, n, generator, candidates=2):
+        """
+        Farthest point sampling over an area stratified subset of the vertices
+
+        Farthest point sampling costs one distance update over the points per
+        sample, O(n x points): it runs over candidates x n vertices drawn by
+        stratified_order (about uniform over the surface) instead of the whole
+        mesh, so its cost only depends on n (under a second for n = 10000,
+        independent of the mesh size).
+
+        candidates : size of the candidate subset, in multiples of n
+        """
+        cand = stratified_order(coords, faces, curv, min(coords.shape[0], candidates * n), generator)
+        X = coords.detach().cpu()[cand].numpy().astype(np.float32)
+        X -= X.mean(0)
+        sq = (X ** 2).sum(1)
+        order = np.empty(n, dtype=np.int64)
+        order[0] = torch.randint(X.shape[0], (1,), generator=generator).item()
+        dist = np.full(X.shape[0], np.inf, dtype=np.float32)
+        for i in range(1, n):
+            # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, one matrix vector product per sample
+            c = X[order[i - 1]]
+            np.minimum(dist, sq - 2 * (X @ c) + sq[order[i - 1]], out=dist)
+            order[i] = dist.argmax()
+        return cand[torch.from_numpy(order)]
+
+
+def vertex_areas(coords, faces):
+        """
+        Area of each vertex (one third of the area of its triangles)
+        """
+        X = coords.detach().cpu().to(torch.float64)
+        F = faces.detach().cpu().long()
+        area = torch.linalg.cross(X[F[:, 1]] - X[F[:, 0]], X[F[:, 2]] - X[F[:, 0]]).norm(dim=1) / 2
+        return torch.zeros(X.shape[0], dtype=torch.float64).index_add_(0, F.reshape(-1), area.repeat_interleave(3)) / 3
+
+
+def stratified_order(coords, faces, curv, n, generator, curvature=False):
+        """
+        Area (optionally curvature) weighted sampling stratified over a voxel grid
+
+        The surface is split into about n/4 cells of equal area. Inside every
+        cell vertices are ranked by a weighted random key (area x (1 + |curv|)),
+        and cells are visited in proportion to their weight, so every prefix of
+        the returned order is itself a stratified sample.
+        """
+        X = coords.detach().cpu().to(torch.float64)
+        area = vertex_areas(coords, faces)
+        weight = area
+        if curvature:
+            c = curv.detach().cpu().abs().to(torch.float64)
+            weight = weight * (1 + c / c.mean().clamp(min=1e-12))
+
+        # cells of equal area, about n / 4 of them over the surface
+        size = (area.sum() / max(1, n // 4)).sqrt()
+        cell = ((X - X.min(0).values) / size).long()
+        cell = torch.unique(cell, dim=0, return_inverse=True)[1]
+        cell_weight = torch.zeros(int(cell.max()) + 1, dtype=torch.float64).index_add_(0, cell, weight)
+
+        # weighted random rank inside each cell (Efraimidis-Spirakis keys)
+        u = torch.rand(X.shape[0], generator=generator, dtype=torch.float64)
+        key = u.log() / weight.clamp(min=1e-12)
+        by_key = torch.argsort(-key)
+        by_cell = by_key[torch.sort(cell[by_key], stable=True).indices]
+        start = torch.zeros_like(cell_weight, dtype=torch.long)
+        start[1:] = torch.cumsum(torch.bincount(cell, minlength=len(cell_weight)), 0)[:-1]
+        rank = torch.empty(X.shape[0], dtype=torch.float64)
+        rank[by_cell] = (torch.arange(X.shape[0]) - start[cell[by_cell]]).to(torch.float64)
+
+        # visit cells in proportion to their weight
+        visit = (rank + u) / (cell_weight[cell] / cell_weight.sum())
+        return torch.argsort(visit)[:n]
+
+
+# vertex sampling methods for partial matching: name -> f(coords, faces, curv, n, generator)
+SAMPLERS = {
+    'random': random_order,
+    'fps': farthest_point_order,
+    'area': stratified_order,
+    'curvature': partial(stratified_order, curvature=True),
+}
+
+
+def sample_order(coords, faces, curv, n, method='random', seed=0):
+        """
+        Reproducible order of n mesh vertices for partial matching
+
+        Every prefix of the order is a valid sample, so a coarse-to-fine
+        schedule (e.g. 1000, 4000, 10000 points) uses nested samples.
+
+        coords, faces, curv : mesh vertices, triangles and curvature
+        n                   : number of vertices
+        method              : one of SAMPLERS ('random', 'fps', 'area', 'curvature')
+        seed                : random seed
+
+        returns: vertex indices (n, torch long, cpu)
+        """
+        generator = torch.Generator().manual_seed(seed)
+        return SAMPLERS[method](coords, faces, curv, min(n, coords.shape[0]), generator)
@@ -0,0 +1,184 @@
+import os
+import json
+import queue
+import socket
+import threading
+import timeit
+import socketserver
+from collections import deque
+
+# end of service marker of the job queue
+_STOP = object()
+
+
+class Job:
+    """
+    Request waiting in the queue of an AlignmentService, with its timings
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.result = None
+        self.submitted = timeit.default_timer()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def stats(self):
+        return {'wait': self.started - self.submitted, 'run': self.finished - self.started,
+                'latency': self.finished - self.submitted}
+
+
+class AlignmentService:
+    """
+    Bounded job queue in front of a fixed number of worker threads
+
+    handler(request) -> result dict runs every job. At most max_queue jobs
+    wait and `concurrency` run at once, a submission to a full queue is
+    rejected instead of piling up. The service keeps the queue depth and the
+    wait / run / total latency of the recent jobs.
+    """
+
+    def __init__(self, handler, max_queue=16, concurrency=1, history=1000):
+        self.handler = handler
+        self.jobs = queue.Queue(max(1, max_queue))
+        self.lock = threading.Lock()
+        self.counts = {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0}
+        self.running = 0
+        self.max_depth = 0
+        self.history = deque(maxlen=history)
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, concurrency))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, request):
+        """
+        Queues a request, returns its Job (wait on job.done) or None when the queue is full
+        """
+        job = Job(request)
+        with self.lock:
+            try:
+                self.jobs.put_nowait(job)
+            except queue.Full:
+                self.counts['rejected'] += 1
+                return None
+            self.counts['submitted'] += 1
+            self.max_depth = max(self.max_depth, self.jobs.qsize())
+        return job
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is _STOP:
+                break
+            job.started = timeit.default_timer()
+            with self.lock:
+                self.running += 1
+            try:
+                job.result = self.handler(job.request)
+            except Exception as e:
+                job.result = {'status': 1, 'error': repr(e)}
+            job.finished = timeit.default_timer()
+            with self.lock:
+                self.running -= 1
+                self.counts['completed' if job.result.get('status') == 0 else 'failed'] += 1
+                self.history.append(job.stats())
+            job.done.set()
+
+    def stats(self):
+        """
+        Job counts, queue depth and wait / run / total latency percentiles of the recent jobs
+        """
+        with self.lock:
+            stats = dict(self.counts, queue_depth=self.jobs.qsize(), max_queue_depth=self.max_depth,
+                         running=self.running, concurrency=len(self.threads))
+            history = list(self.history)
+        for key in ('wait', 'run', 'latency'):
+            values = sorted(s[key] for s in history)
+            if values:
+                stats[key] = {'mean': sum(values) / len(values), 'p50': values[len(values) // 2],
+                              'p95': values[min(len(values) - 1, int(0.95 * len(values)))], 'max': values[-1]}
+        return stats
+
+    def close(self):
+        """
+        Stops the workers once the queued jobs are done
+        """
+        for _ in self.threads:
+            self.jobs.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # one JSON request line per connection, answered by one JSON line
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+        except ValueError as e:
+            return self._reply({'status': 1, 'error': 'invalid request: {}'.format(e)})
+        service = self.server.service
+        op = message.get('op')
+        if op == 'align':
+            job = service.submit(message)
+            if job is None:
+                return self._reply({'status': 1, 'error': 'queue full', 'queue_depth': service.jobs.qsize()})
+            job.done.wait()
+            return self._reply(dict(job.result, **job.stats()))
+        if op == 'stats':
+            return self._reply(dict(service.stats(), status=0))
+        if op == 'shutdown':
+            self._reply({'status': 0})
+            # shutdown waits for serve_forever, which runs in another thread
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        self._reply({'status': 1, 'error': 'unknown operation {!r}'.format(op)})
+
+    def _reply(self, response):
+        self.wfile.write((json.dumps(response, default=float) + '\n').encode())
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path, service):
+    """
+    Answers the requests of a Unix socket until a shutdown request, then lets
+    the queued jobs finish
+
+    Requests are JSON lines: {"op": "align", ...} (passed to the service
+    handler, answered with its result and the job latency), {"op": "stats"}
+    and {"op": "shutdown"}.
+    """
+    if os.path.exists(path): # left over by a service that did not shut down
+        try:
+            request(path, {'op': 'stats'}, timeout=1)
+        except OSError:
+            os.remove(path)
+        else:
+            raise RuntimeError('a service is already listening on {}'.format(path))
+    server = _Server(path, _Handler)
+    server.service = service
+    try:
+        server.serve_forever()
+    finally:
+        service.close()
+        server.server_close()
+        os.remove(path)
+
+
+def request(path, message, timeout=None):
+    """
+    Sends one request to the service listening on the Unix socket path, returns its answer
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall((json.dumps(message) + '\n').encode())
+        with s.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('no answer from {}'.format(path))
+    return json.loads(line)
@@ -0,0 +1,148 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from collections.abc import Mapping
+import numpy as np
+import torch
+
+
+class LazyRecord(Mapping):
+    """
+    Read-only mapping of field name -> tensor, memory-mapping each field on first access
+
+    The arrays are mapped copy-on-write, so the returned tensors share memory
+    with the page cache (zero-copy) and writing to them never touches the files.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields # name -> (path, dtype, shape)
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            path = self.fields[name][0]
+            self.loaded[name] = torch.from_numpy(np.load(path, mmap_mode='c'))
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+
+class SpectralStore:
+    """
+    Columnar, memory-mappable output store
+
+    root/
+        mesh/<hash>/      mesh data (topology, coordinates, surface data), stored
+                          once per content hash and shared by every run on that mesh
+        spectral/<name>/  spectral data of one run, with index.json pointing to its mesh
+
+    Every field is one .npy file, and index.json lists the fields with their
+    dtype and shape, so a single field can be read without touching the others.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'mesh'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'spectral'), exist_ok=True)
+
+    @staticmethod
+    def _arrays(fields):
+        arrays = {}
+        for key, value in fields.items():
+            if torch.is_tensor(value):
+                arrays[key] = np.ascontiguousarray(value.detach().cpu().numpy())
+        return arrays
+
+    @staticmethod
+    def _write(directory, arrays, meta=None):
+        index = {'fields': {}}
+        index.update(meta or {})
+        for key, array in arrays.items():
+            np.save(os.path.join(directory, key + '.npy'), array)
+            index['fields'][key] = {'file': key + '.npy', 'dtype': str(array.dtype), 'shape': list(array.shape)}
+        with open(os.path.join(directory, 'index.json'), 'w') as f:
+            json.dump(index, f, indent=1)
+
+    def _publish(self, arrays, target, meta=None, replace=True):
+        """
+        Writes the arrays to a temporary directory and renames it to target
+        """
+        parent = os.path.dirname(target)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+        try:
+            self._write(tmp, arrays, meta)
+            if os.path.exists(target):
+                if not replace:
+                    shutil.rmtree(tmp)
+                    return
+                old = tempfile.mkdtemp(dir=parent, prefix='.old')
+                os.rename(target, os.path.join(old, 'data'))
+                os.rename(tmp, target)
+                shutil.rmtree(old)
+            else:
+                os.rename(tmp, target)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def save_mesh(self, mesh_data):
+        """
+        Stores the mesh data once per content hash
+
+        returns: content hash of the mesh data
+        """
+        arrays = self._arrays(mesh_data)
+        h = hashlib.sha1()
+        for key in sorted(arrays):
+            h.update(key.encode())
+            h.update(str(arrays[key].dtype).encode())
+            h.update(arrays[key].tobytes())
+        key = h.hexdigest()
+        target = os.path.join(self.root, 'mesh', key)
+        if not os.path.exists(target):
+            try:
+                self._publish(arrays, target, replace=False)
+            except OSError:
+                # written concurrently by another job
+                if not os.path.exists(target):
+                    raise
+        return key
+
+    def save(self, name, spec_data, mesh_data):
+        """
+        Stores the spectral data of a run and (once) its mesh data
+
+        name      : run name, e.g. <subject>_<hemi>
+        spec_data : mapping of spectral fields (eig_vec, eig_val, ali_spe, ...)
+        mesh_data : mapping of mesh fields (faces, coords, edge_index, ...)
+        """
+        mesh = self.save_mesh(mesh_data)
+        self._publish(self._arrays(spec_data), os.path.join(self.root, 'spectral', name), meta={'mesh': mesh})
+
+    def names(self):
+        """
+        Names of the stored runs
+        """
+        return sorted(n for n in os.listdir(os.path.join(self.root, 'spectral')) if not n.startswith('.'))
+
+    def _fields(self, directory):
+        with open(os.path.join(directory, 'index.json')) as f:
+            index = json.load(f)
+        fields = {key: (os.path.join(directory, v['file']), v['dtype'], tuple(v['shape']))
+                  for key, v in index['fields'].items()}
+        return index, fields
+
+    def load(self, name):
+        """
+        Lazy record of a run: spectral and mesh fields, memory-mapped on access
+        """
+        index, fields = self._fields(os.path.join(self.root, 'spectral', name))
+        _, mesh_fields = self._fields(os.path.join(self.root, 'mesh', index['mesh']))
+        mesh_fields.update(fields)
+        return LazyRecord(mesh_fields)
@@ -57,8 +57,36 @@ def rebase_labels(labels):
     labels = np.unique(labels) # Sorted.
     assert np.issubdtype(labels.dtype, np.integer), 'non-integer data'
     lab_to_ind = np.zeros(np.max(labels) + 1, dtype='int_')
-    for i, lab in enumerate(labels):
-        lab_to_ind[ lab ] = i
+    lab_to_ind[labels] = np.arange(len(labels))
     ind_to_lab = labels
     return lab_to_ind, ind_to_lab    
 
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the process in MB (VmHWM on Linux, ru_maxrss otherwise)
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    import sys
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 1024
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory to the current one, so that peak_rss_mb
+    measures a single stage (Linux only, no effect elsewhere)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass